@@ -0,0 +1,411 @@
+"""
+The benchmark.py file measures transfers through a real server and cache on localhost.
+1. Every combination of protocol, operation, file size, hit ratio and concurrency is a scenario with a fresh server and cache.
+2. A hit ratio of 0.75 makes 3 of 4 gets ask for a file that was fetched into the cache before the measurement.
+3. UDP traffic can go through netem proxies (--loss, --delay, --jitter, --duplicate, --reorder).
+4. Every scenario is written as a JSON line: throughput, p50/p99 latency and CPU time per transfer.
+Usage: python benchmark.py [--protocols tcp,snw] [--sizes 16K,1M] [--hit-ratios 0,1] [--concurrency 1,4] [--requests 20]
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import queue
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import file_utils
+import netem_proxy
+import snw_transport
+import sr_transport
+import tcp_transport
+
+UDP_TRANSPORTS = {"snw": snw_transport, "sr": sr_transport}
+HERE = os.path.dirname(os.path.abspath(__file__))
+HOST = "localhost"
+STARTUP_TIMEOUT = 10     #seconds server and cache may take to start listening
+HOT_FILES = 4            #files the cache holds before a get scenario with hits starts
+WARM_UP_ATTEMPTS = 3     #tries to fetch a file of the hits into the cache before the scenario goes on without it
+WRITE_BLOCK = 1024 * 1024
+
+def free_port():  #a port that is free for both TCP and UDP at the moment
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp, socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+            tcp.bind(("127.0.0.1", 0))
+            port = tcp.getsockname()[1]
+            try:
+                udp.bind(("127.0.0.1", port))
+            except OSError:
+                continue
+            return port
+
+def process_cpu(pid):  #seconds of CPU a process has used so far, None where /proc is not available
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")   #utime and stime
+
+def percentile(values, p):  #nearest-rank percentile of a list of numbers
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def write_random_file(path, size):
+    with open(path, 'wb') as f:
+        for start in range(0, size, WRITE_BLOCK):
+            f.write(os.urandom(min(WRITE_BLOCK, size - start)))
+
+class Sink:  #write function that only counts the received bytes
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, data):
+        self.count += len(data)
+
+class Deployment:  #server and cache running in a temporary directory, UDP optionally behind netem proxies
+    def __init__(self, protocol, files, impairment=None, server_args=(), cache_args=()):
+        self.protocol = protocol
+        self.files = files   #filename -> size, created in server_files
+        self.impairment = impairment   #keyword arguments of netem_proxy.Impairment, or None
+        self.server_args = list(server_args)
+        self.cache_args = list(cache_args)
+        self.directory = None
+        self.processes = {}   #"server"/"cache" -> Popen
+        self.proxies = []
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix="benchmark-")
+        try:
+            self.start()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        os.makedirs(os.path.join(self.directory, "server_files"))
+        for filename, size in self.files.items():
+            write_random_file(os.path.join(self.directory, "server_files", filename), size)
+        emulated = self.impairment is not None and self.protocol in UDP_TRANSPORTS
+        server_port = free_port()
+        self._launch("server", server_port, self.protocol, *self.server_args)
+        self.server_port = self._proxy(server_port) if emulated else server_port   #used by the cache and by put
+        cache_port = free_port()
+        self._launch("cache", cache_port, HOST, self.server_port, self.protocol, *self.cache_args)
+        self.cache_port = self._proxy(cache_port) if emulated else cache_port
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        for proxy in self.proxies:
+            proxy.shutdown()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def cpu(self):  #CPU seconds used by server and cache so far
+        return {name: process_cpu(process.pid) for name, process in self.processes.items()}
+
+    def _launch(self, name, *args):  #start server.py or cache.py and wait until it listens
+        log_path = os.path.join(self.directory, f"{name}.log")
+        with open(log_path, 'w') as log:
+            process = subprocess.Popen([sys.executable, "-u", os.path.join(HERE, f"{name}.py")] + [str(arg) for arg in args],
+                                       cwd=self.directory, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        self.processes[name] = process
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            with open(log_path) as log:
+                output = log.read()
+            if "listening" in output:
+                return
+            if process.poll() is not None:
+                raise RuntimeError(f"{name} exited during startup:\n{output}")
+            time.sleep(0.05)
+        raise RuntimeError(f"{name} did not start listening within {STARTUP_TIMEOUT} seconds")
+
+    def _proxy(self, target_port):  #start an in-process netem proxy in front of a port, return the port of the proxy
+        port = free_port()
+        impairment = netem_proxy.Impairment(**self.impairment)
+        proxy = netem_proxy.NetemProxy(port, (HOST, target_port), impairment, host="127.0.0.1")
+        threading.Thread(target=proxy.serve_forever, daemon=True).start()
+        self.proxies.append(proxy)
+        return port
+
+class TCPClient:  #persistent connections to cache and server, like the client keeps them
+    def __init__(self, deployment):
+        self.cache_pool = tcp_transport.ConnectionPool(HOST, deployment.cache_port, 1)
+        self.server_pool = tcp_transport.ConnectionPool(HOST, deployment.server_port, 1)
+
+    def get(self, filename):  #download a file through the cache, return the number of bytes received
+        client_socket, response = self.cache_pool.request(f"get {filename}")
+        try:
+            if not response.startswith("File delivered"):
+                raise ConnectionError(f"Unexpected response: {response}")
+            sink = Sink()
+            if not tcp_transport.receive_stream(client_socket, sink):
+                raise ConnectionError(f"Connection lost while receiving {filename}")
+        except BaseException:
+            self.cache_pool.discard(client_socket)
+            raise
+        self.cache_pool.release(client_socket)
+        return sink.count
+
+    def put(self, filename, source_path):  #upload a file to the server, return the number of bytes sent
+        client_socket, response = self.server_pool.request(
+            f"put {filename}", send_body=lambda s: tcp_transport.send_file(s, source_path))
+        self.server_pool.release(client_socket)
+        if "successfully" not in response:
+            raise ConnectionError(f"Unexpected response: {response}")
+        return os.path.getsize(source_path)
+
+    def close(self):
+        self.cache_pool.close()
+        self.server_pool.close()
+
+class UDPClient:  #one UDP socket for the commands of a worker, replaced after an error
+    def __init__(self, deployment):
+        self.transport = UDP_TRANSPORTS[deployment.protocol]
+        self.cache_address = (HOST, deployment.cache_port)
+        self.server_address = (HOST, deployment.server_port)
+        self.sock = None
+        self._open()
+
+    def get(self, filename):
+        try:
+            length_info, _ = self.transport.request(self.sock, f"GET:{filename}", self.cache_address)
+            if not length_info.startswith("LEN:"):
+                raise ConnectionError(f"Unexpected response: {length_info}")
+            length = int(length_info.split(":")[1])
+            sink = Sink()
+            self.transport.receive_stream(self.sock, length, sink)
+            self._expect_message(self.transport.send_fin(self.sock, self.cache_address))
+        except BaseException:
+            self._open()   #late datagrams of the failed command must not reach the next one
+            raise
+        return sink.count
+
+    def put(self, filename, source_path):
+        try:
+            with open(source_path, 'rb') as f:
+                length = os.fstat(f.fileno()).st_size
+                self.transport.request(self.sock, f"PUT:{filename}:{length}", self.server_address)
+                self.transport.send_from_file(self.sock, f, length, self.server_address)
+            self._expect_message(self.transport.send_fin(self.sock, self.server_address))
+        except BaseException:
+            self._open()
+            raise
+        return length
+
+    def close(self):
+        self.sock.close()
+
+    def _open(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = self.transport.create_udp_socket()
+
+    def _expect_message(self, reply):
+        message, _ = reply
+        if not message.startswith("Message:"):
+            raise ConnectionError(f"Unexpected response: {message}")
+
+def make_client(deployment):
+    return TCPClient(deployment) if deployment.protocol == "tcp" else UDPClient(deployment)
+
+def plan_requests(operation, size, hit_ratio, requests, rng):  #files to create on the server and the list of requests
+    if operation == "put":
+        return {}, [f"put-{size}-{i}.bin" for i in range(requests)]
+    files, plan, misses = {}, [], 0
+    hot = [f"hot-{size}-{i}.bin" for i in range(HOT_FILES)]
+    for _ in range(requests):
+        if rng.random() < hit_ratio:
+            filename = rng.choice(hot)
+        else:
+            filename = f"miss-{size}-{misses}.bin"   #every miss asks for a file of its own
+            misses += 1
+        files[filename] = size
+        plan.append(filename)
+    return files, plan
+
+def warm_up(deployment, hot):  #fetch the files of the hits into the cache, return the errors of the files that failed
+    failed = []
+    client = make_client(deployment)
+    try:
+        for filename in hot:
+            for _ in range(WARM_UP_ATTEMPTS):
+                try:
+                    client.get(filename)
+                    break
+                except (OSError, ValueError) as e:
+                    error = e
+            else:
+                failed.append(f"warm-up {filename}: {error}")
+    finally:
+        client.close()
+    return failed
+
+def run_scenario(args, protocol, operation, size, hit_ratio, concurrency):  #run one scenario and return its result
+    rng = random.Random(args.seed)
+    files, plan = plan_requests(operation, size, hit_ratio, args.requests, rng)
+    hot = sorted(filename for filename in set(plan) if filename.startswith("hot-"))
+    impairment = None
+    if args.loss or args.delay or args.jitter or args.duplicate or args.reorder:
+        impairment = {"loss": args.loss, "delay": args.delay, "jitter": args.jitter, "duplicate": args.duplicate,
+                      "reorder": args.reorder, "seed": args.seed}
+    window_args = ["--window", str(args.window)]
+    source_dir = tempfile.mkdtemp(prefix="benchmark-client-")
+    source_path = os.path.join(source_dir, "upload.bin")
+    if operation == "put":
+        write_random_file(source_path, size)
+    latencies, errors = [], []
+    transferred = 0
+    lock = threading.Lock()
+    try:
+        with Deployment(protocol, files, impairment, window_args + shlex.split(args.server_args),
+                        window_args + shlex.split(args.cache_args)) as deployment:
+            warm_up_errors = warm_up(deployment, hot)   #fill the cache with the files the hits ask for, not measured
+
+            requests = queue.Queue()
+            for filename in plan:
+                requests.put(filename)
+
+            def worker():
+                nonlocal transferred
+                client = make_client(deployment)
+                try:
+                    while True:
+                        try:
+                            filename = requests.get_nowait()
+                        except queue.Empty:
+                            return
+                        start = time.perf_counter()
+                        try:
+                            count = client.get(filename) if operation == "get" else client.put(filename, source_path)
+                        except (OSError, ValueError) as e:
+                            with lock:
+                                errors.append(f"{filename}: {e}")
+                            continue
+                        elapsed = time.perf_counter() - start
+                        with lock:
+                            latencies.append(elapsed)
+                            transferred += count
+                finally:
+                    client.close()
+
+            cpu_before = deployment.cpu()
+            client_cpu = time.process_time()
+            start = time.perf_counter()
+            threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            seconds = time.perf_counter() - start
+            client_cpu = time.process_time() - client_cpu
+            cpu_after = deployment.cpu()
+    finally:
+        shutil.rmtree(source_dir, ignore_errors=True)
+
+    completed = len(latencies)
+
+    def per_transfer(seconds_used):
+        return None if seconds_used is None or not completed else round(seconds_used / completed * 1000, 3)
+
+    cpu = {"client": per_transfer(client_cpu)}   #includes the proxies, they run in the benchmark process
+    for name in cpu_before:
+        used = None if cpu_before[name] is None or cpu_after[name] is None else cpu_after[name] - cpu_before[name]
+        cpu[name] = per_transfer(used)
+    return {
+        "protocol": protocol,
+        "operation": operation,
+        "size": size,
+        "hit_ratio": hit_ratio if operation == "get" else None,
+        "concurrency": concurrency,
+        "requests": len(plan),
+        "completed": completed,
+        "errors": len(errors),
+        "warm_up_errors": len(warm_up_errors),
+        "bytes": transferred,
+        "seconds": round(seconds, 6),
+        "throughput_bps": round(transferred * 8 / seconds) if seconds else None,
+        "latency_ms": {
+            "p50": None if not latencies else round(percentile(latencies, 50) * 1000, 3),
+            "p99": None if not latencies else round(percentile(latencies, 99) * 1000, 3),
+            "mean": None if not latencies else round(sum(latencies) / completed * 1000, 3),
+        },
+        "cpu_ms_per_transfer": cpu,
+        "network": impairment and {key: impairment[key] for key in ("loss", "delay", "jitter", "duplicate", "reorder")},
+        "error_samples": (warm_up_errors + errors)[:3],
+    }
+
+def parse_list(text, convert):
+    return [convert(item) for item in text.split(",") if item.strip()]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measure transfers through a local server and cache")
+    parser.add_argument("--protocols", default="tcp,snw", help="comma separated: tcp, snw, sr (default: %(default)s)")
+    parser.add_argument("--operations", default="get,put", help="comma separated: get, put (default: %(default)s)")
+    parser.add_argument("--sizes", default="16K,1M", help="comma separated file sizes, e.g. 16K,1M,64M (default: %(default)s)")
+    parser.add_argument("--hit-ratios", default="0,1", help="comma separated cache hit ratios of get (default: %(default)s)")
+    parser.add_argument("--concurrency", default="1,4", help="comma separated numbers of concurrent clients (default: %(default)s)")
+    parser.add_argument("--requests", type=int, default=20, help="requests per scenario (default: %(default)s)")
+    parser.add_argument("--window", type=int, default=sr_transport.WINDOW_SIZE,
+                        help="packets in flight for the sr protocol (default: %(default)s)")
+    parser.add_argument("--loss", type=float, default=0.0, help="UDP only: probability that a datagram is dropped")
+    parser.add_argument("--delay", type=float, default=0.0, help="UDP only: seconds every datagram is delayed")
+    parser.add_argument("--jitter", type=float, default=0.0, help="UDP only: random extra delay of up to this many seconds")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="UDP only: probability that a datagram is delivered twice")
+    parser.add_argument("--reorder", type=float, default=0.0, help="UDP only: probability that a datagram is held back behind later ones")
+    parser.add_argument("--server-args", default="", help="extra arguments of server.py, e.g. \"--idle-timeout 60\"")
+    parser.add_argument("--cache-args", default="", help="extra arguments of cache.py, e.g. \"--max-bytes 1G\"")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the request mix and the network emulation")
+    parser.add_argument("--output", help="also append the results to this file (JSON lines)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    sr_transport.WINDOW_SIZE = args.window
+    scenarios = []
+    for protocol, operation, size, concurrency in itertools.product(
+            parse_list(args.protocols, str.strip), parse_list(args.operations, str.strip),
+            parse_list(args.sizes, file_utils.parse_size), parse_list(args.concurrency, int)):
+        hit_ratios = parse_list(args.hit_ratios, float) if operation == "get" else [None]
+        scenarios.extend((protocol, operation, size, hit_ratio, concurrency) for hit_ratio in hit_ratios)
+
+    output = open(args.output, 'a') if args.output else None
+    try:
+        for number, scenario in enumerate(scenarios, 1):
+            protocol, operation, size, hit_ratio, concurrency = scenario
+            print(f"[{number}/{len(scenarios)}] {protocol} {operation} size={size} hit_ratio={hit_ratio} "
+                  f"concurrency={concurrency}", file=sys.stderr)
+            result = run_scenario(args, protocol, operation, size, hit_ratio or 0.0, concurrency)
+            line = json.dumps(result)
+            print(line, flush=True)
+            if output is not None:
+                output.write(line + "\n")
+                output.flush()
+    finally:
+        if output is not None:
+            output.close()
+
+if __name__ == "__main__":
+    main()
@@ -3,19 +3,56 @@ The cache.py acts as an intermediatory service between client and server applica
 The cache listens to the client requests to GET a file. The cache checks its availability in the cache files and sends it to the client.
 If the requested file is not available, it requests the file from server, saves it in cache files and sends the file to client.
 This functionality is implemented using 2 protocols. Either of TCP or snw can be invoked.
+1. Concurrent misses on a file share one fetch, which is streamed to the clients while it arrives.
+2. The cache files are kept within --max-bytes and --max-entries (cache_manager.py), small hot files also in memory.
+3. Files older than --ttl are revalidated by etag, with --subscribe the server invalidates files that are put.
+4. TCP: persistent, pipelined connections, ranged gets, compression (--compress) and delta refetches (--delta).
+5. Gets are logged for warming up (--warm) and prefetching (prefetch.py).
+6. Several caches can share the files as a cluster (--peers, cluster.py), misses can go to a --parent cache.
+7. Metrics are served on --metrics-port, --trace prints one line per command (metrics.py).
 
 Cache operation can happen using tcp or snw protocols:
 In TCP mode: The cache server establishes a TCP connection with client and server to process the file requests.
 
 In SNW mode: The cache server communicates to server and client using UDP and implements stop and wait protocol for data transfer.
 
+In SR mode: Same as SNW mode, but chunks are sent with a selective repeat sliding window of --window chunks.
+
 """
 import sys   #Import necessary libraries
+import argparse
 sys.path.append("..")
 import tcp_transport    #Import TCP related funcitons
-import snw_transport as udp_transport   #Import SNW over UDP related funcitons
+import file_utils       #Import etag and temporary file helpers
+import cache_manager    #Import the index and eviction of the cache files
+import chunk_store      #Import the content-defined chunking used for delta transfers
+import compression_utils  #Import the compression used on the wire
+import snw_transport   #Import SNW over UDP related funcitons
+import sr_transport    #Import selective repeat over UDP related functions
+import udp_dispatcher  #Import the dispatcher that serves many UDP clients at once
+import metrics         #Import the counters and request traces exposed on --metrics-port
+import prefetch        #Import the access log and the background prefetching
+import cluster         #Import the consistent hashing of files onto the caches of a cluster
 import os
+import queue
 import socket
+import hashlib
+import threading
+import time
+import weakref
+
+UDP_TRANSPORTS = {"snw": snw_transport, "sr": sr_transport}   #reliable UDP transports selectable by the protocol argument
+IDLE_TIMEOUT = 30   #seconds a persistent client connection may wait for its next command (--idle-timeout)
+CHUNKS = None       #chunk store of the cache files if changed files are refetched as deltas (--delta)
+COMPRESS = False    #fetch files compressed and store them compressed (--compress)
+PREFETCHER = None   #access log and background prefetching, unless --no-prefetch
+RING = None         #cluster.HashRing of the caches (--peers), None for a cache of its own
+NODE = None         #address of this cache on the ring (--node)
+PEER_POOLS = {}     #address of a peer -> ConnectionPool to it (TCP)
+PEER_TIMEOUT = 2    #seconds to wait for a connection to a peer
+PEER_RETRY = 5      #seconds a peer that could not be reached is not asked again
+RELAY_CHUNKS = 64   #chunks buffered between the owner and the client while a UDP get is relayed
+_peers_down = {}    #address of a peer -> time.monotonic() until which it is not asked
 
 CACHE_DIR = "cache_files"   #cache stores and retrives files to this directory
 
@@ -23,114 +60,734 @@ CACHE_DIR = "cache_files"   #cache stores and retrives files to this directory
 if not os.path.exists(CACHE_DIR):
     os.makedirs(CACHE_DIR)
 
-def handle_client_request(client_socket, SERVER_HOST, SERVER_PORT):  #funciton to handle client requests
+class GrowingFile:  #a cache file that is being fetched from the server while clients already read it
+    def __init__(self, filepath, on_finish=None):
+        self.filepath = filepath
+        self.on_finish = on_finish   #called with the GrowingFile once the fetch is over
+        self.file, self.temp_path = file_utils.create_temp_file(filepath)   #hidden until complete
+        self._close_source = None
+        self._read_from(self.temp_path)
+        self.digest = hashlib.sha256()   #etag of the file, computed while it arrives
+        self.found = None   #None until the server answered, then whether it has the file
+        self.unchanged = False   #the server confirmed that the cached copy is still up to date
+        self.length = None  #file length, if the server announced it
+        self.encoding = None  #compression of the received (and stored) data
+        self.decoder = None   #decompresses the received data for the etag
+        self.error = None   #why the fetch failed before the server answered
+        self.urgent = False   #a client waits for the file, a background fetch stops throttling
+        self.stale = False   #invalidated during the fetch, it is not kept
+        self.size = 0   #bytes written so far
+        self.done = False
+        self.complete = False
+        self.condition = threading.Condition()
+
+    def _read_from(self, path):  #descriptor the readers read from, it survives an eviction of the file
+        source = file_utils.open_for_reading(path)
+        if self._close_source is not None:
+            self._close_source()
+        self.source = source
+        self._close_source = weakref.finalize(self, os.close, source)   #closed once no reader refers to the fetch any more
+
+    def start(self, length=None, encoding=None):  #the server has the file and is about to send it
+        if encoding is not None:   #the etag is the hash of the uncompressed contents
+            self.decoder = compression_utils.Decoder(encoding, self.digest.update)
+        with self.condition:
+            self.found = True
+            self.length = length
+            self.encoding = encoding
+            self.condition.notify_all()
+
+    def not_modified(self):  #the cached copy is up to date, readers are served from it
+        self._read_from(self.filepath)
+        with self.condition:
+            self.found = True
+            self.unchanged = True
+            self.length = os.fstat(self.source).st_size
+            self.condition.notify_all()
+
+    def wait_found(self):  #wait for the answer of the server, True if it has the file
+        with self.condition:
+            while self.found is None and not self.done:
+                self.condition.wait()
+            if self.found is None:
+                raise ConnectionError(f"Could not fetch file from server: {self.error}")
+            return self.found
+
+    def write(self, chunk):  #append a chunk received from the server and wake up the readers
+        if self.decoder is not None:
+            self.decoder(chunk)
+        else:
+            self.digest.update(chunk)
+        self.file.write(chunk)
+        self.file.flush()
+        with self.condition:
+            self.size += len(chunk)
+            self.condition.notify_all()
+
+    def finish(self, complete, error=None):  #publish the file if it arrived completely, otherwise throw it away
+        self.file.close()
+        if complete and self.decoder is not None:
+            try:
+                self.decoder.finish()
+            except Exception as e:   #the compressed data is damaged
+                complete, error = False, e
+        with self.condition:
+            if complete and not self.stale:
+                os.replace(self.temp_path, self.filepath)
+            else:
+                os.remove(self.temp_path)
+            if self.found is None and error is None:   #the server answered that it does not have the file
+                self.found = False
+            self.error = error
+            self.done = True
+            self.complete = complete
+            if self.on_finish is not None:
+                self.on_finish(self)
+            self.condition.notify_all()
+
+    def wait_done(self):  #wait until the fetch is over, True if the file arrived completely
+        with self.condition:
+            while not self.done:
+                self.condition.wait()
+            return self.complete
+
+    @property
+    def etag(self):
+        return self.digest.hexdigest()
+
+    def chunks(self, chunk_size):  #yield the file contents as they arrive, raise if the server transfer fails
+        with self.condition:
+            if self.done and not self.complete and not self.unchanged:
+                raise ConnectionError("Transfer from server failed")
+        position = 0
+        while True:
+            with self.condition:
+                if self.unchanged:   #nothing was fetched, the cached copy is served
+                    available, complete = self.length - position, True
+                else:
+                    while position == self.size and not self.done:
+                        self.condition.wait()
+                    available = self.size - position
+                    complete = self.complete
+            if available:
+                data = file_utils.read_at(self.source, min(available, chunk_size), position)
+                if not data:
+                    raise ConnectionError("Cached file was truncated while it was sent")
+                position += len(data)
+                yield data
+            elif not complete:
+                raise ConnectionError("Transfer from server ended prematurely")
+            else:
+                return
+
+_fetches = {}   #filename -> GrowingFile of the fetch from the server that is in progress
+_fetches_lock = threading.Lock()
+
+def fetch_once(manager, filename, fetch):  #fetch a missing file from the server unless a fetch of it is already running
+    with _fetches_lock:   #concurrent misses on the same file share one fetch (single flight)
+        growing = _fetches.get(filename)
+        if growing is not None:
+            growing.urgent = True
+            return growing
+
+        def on_finish(growing):
+            if growing.stale:   #invalidate already removed the cached copy
+                if CHUNKS is not None:   #a delta fetch recorded the manifest of the file it threw away
+                    CHUNKS.discard(filename)
+            elif growing.complete:
+                manager.admit(filename, growing.etag, growing.encoding)
+            elif growing.unchanged:
+                manager.mark_validated(filename)
+            elif growing.found is False:   #the server no longer has the file
+                manager.remove(filename)
+            with _fetches_lock:
+                if _fetches.get(filename) is growing:
+                    del _fetches[filename]
+
+        growing = GrowingFile(manager.path(filename), on_finish)
+        _fetches[filename] = growing
+
+    def run():   #fetch(growing) returns True once the file is complete
+        complete, error = False, None
+        try:
+            complete = fetch(growing)
+        except Exception as e:
+            error = e
+            print(f"Error while fetching file from server: {e}")
+        finally:
+            growing.finish(complete, error)
+            metrics.BYTES_RECEIVED.inc(growing.size, source="origin")
+
+    threading.Thread(target=run, daemon=True).start()
+    return growing
+
+def invalidate(manager, filename):  #drop the cached copy of a changed file and the one being fetched
+    with _fetches_lock:
+        growing = _fetches.pop(filename, None)   #the next miss starts a fetch of the new version
+        if growing is not None:
+            growing.stale = True
+    manager.remove(filename)
+    print(f"Invalidated {filename}")
+
+def throttled(growing, bucket):  #write of a background fetch, throttled until a client waits
+    def write(chunk):
+        if not growing.urgent:
+            bucket.consume(len(chunk))
+        growing.write(chunk)
+    return write
+
+def prefetch_file(manager, filename, reason, bucket, fetch):  #fetch a file no client asked for yet, True if it was stored
+    if reason == "warm" and manager.is_full():   #warming up must not evict what is already cached
+        return False
+    if owner_peer(filename) is not None:   #cached by another cache of the cluster
+        return False
+    etag = manager.etag(filename)
+    growing = fetch_once(manager, filename, lambda growing: fetch(growing, filename, etag, throttled(growing, bucket)))
+    return growing.wait_done()
+
+def fetch_tcp(growing, filename, etag, origin_pool, delta=False, write=None):  #fetch a file over a pooled TCP connection, unless it still has etag
+    write = write or growing.write
+    command = f"get {filename} etag={etag}" if etag else f"get {filename}"
+    if COMPRESS:
+        command += f" accept={','.join(compression_utils.available())}"
+    if etag and delta:
+        try:
+            CHUNKS.manifest(filename)   #index the chunks of the cached copy, they are not fetched again
+            command += " delta=1"
+        except OSError:   #evicted meanwhile
+            pass
+    server_socket_tcp, response = origin_pool.request(command)
+    reusable = False   #whether the connection can serve the next fetch
+    try:
+        if response == "FileNotFound":
+            reusable = True
+            return False
+        if response == "NotModified":
+            reusable = True
+            growing.not_modified()
+            return False
+        if response == "Manifest":   #the file changed, only the chunks the cache does not have are sent
+            reusable = fetch_tcp_delta(server_socket_tcp, growing, filename, write)
+            return reusable
+        header = tcp_transport.receive_file_header(server_socket_tcp)
+        if header is None:
+            raise ConnectionError("Connection to server lost")
+        length, encoding = header
+        growing.start(None if length == tcp_transport.CHUNKED else length, encoding)   #stored in the encoding it arrives in
+        reusable = tcp_transport.receive_body(server_socket_tcp, length, write)
+        return reusable
+    finally:
+        if reusable:
+            origin_pool.release(server_socket_tcp)
+        else:
+            origin_pool.discard(server_socket_tcp)
+
+def fetch_tcp_delta(server_socket_tcp, growing, filename, write):  #receive a changed file as its manifest and the missing chunks
+    manifest = chunk_store.parse_manifest(tcp_transport.receive_data(server_socket_tcp, chunk_store.MAX_MANIFEST))
+    missing = chunk_store.missing_digests(manifest, CHUNKS.has)
+    tcp_transport.send_data(server_socket_tcp, " ".join(["Missing"] + missing))
+    sizes = dict(manifest)
+    length = tcp_transport.receive_file_length(server_socket_tcp)
+    if length is None or length != sum(sizes[digest] for digest in missing):
+        raise ConnectionError("Connection to server lost")
+    growing.start(sum(size for _, size in manifest))
+    chunk_store.assemble(manifest, missing, CHUNKS.read_chunk,
+                         lambda size: tcp_transport.receive_bytes(server_socket_tcp, size), write)
+    CHUNKS.record(filename, os.stat(growing.temp_path), manifest)   #the file keeps its size and mtime when it is renamed
+    print(f"Fetched {filename} as a delta ({length} of {growing.length} bytes transferred)")
+    return True
+
+def fetch_udp(udp_transport, growing, filename, etag, SERVER_HOST, SERVER_PORT, write=None):  #fetch a file from the server over snw or sr
+    server_socket_udp = udp_transport.create_udp_socket()   #separate socket, so server and client packets do not mix
+    server_socket_udp.settimeout(1)
+    try:
+        length_info, _ = udp_transport.request(server_socket_udp, f"GET:{filename}:{etag}" if etag else f"GET:{filename}",
+                                               (SERVER_HOST, SERVER_PORT))
+        if length_info == "NotModified":
+            growing.not_modified()
+            return False
+        if not length_info.startswith("LEN:"):
+            return False
+        length = int(length_info.split(":")[1])
+        growing.start(length)
+        udp_transport.receive_stream(server_socket_udp, length, write or growing.write)
+        try:
+            udp_transport.send_fin(server_socket_udp, (SERVER_HOST, SERVER_PORT))
+        except socket.timeout:   #the file is complete, only the goodbye was lost
+            pass
+        return True
+    finally:
+        server_socket_udp.close()
+
+def relay_udp_to_peer(udp_transport, session, filename, peer, client_address, trace):  #serve a get from the owner without keeping a copy, False if it is down
+    peer_socket = udp_transport.create_udp_socket()
+    try:
+        answer, _ = udp_transport.request(peer_socket, f"PEERGET:{filename}", peer, PEER_TIMEOUT)
+    except socket.timeout as e:   #nothing was sent to the client yet, it is served locally
+        peer_socket.close()
+        peer_down(peer, e)
+        return False
+    trace.result = "peer"
+    metrics.CACHE_LOOKUPS.inc(result="peer")
+    if not answer.startswith("LEN:"):
+        peer_socket.close()
+        udp_transport.send_data(session, answer, client_address)
+        return True
+    length = int(answer.split(":")[1])
+    chunks = queue.Queue(RELAY_CHUNKS)
+
+    def receive():   #receives from the peer in a thread of its own
+        try:
+            udp_transport.receive_stream(peer_socket, length,
+                                         lambda chunk: chunks.put(bytes(chunk), timeout=udp_transport.IDLE_TIMEOUT))
+            chunks.put(None)
+            udp_transport.send_fin(peer_socket, peer)
+        except Exception as e:   #queue.Full if the client stopped taking the chunks
+            try:
+                chunks.put(e, timeout=udp_transport.TIMEOUT)
+            except queue.Full:
+                pass
+        finally:
+            peer_socket.close()
+
+    def relayed():
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise ConnectionError(f"Transfer from peer failed: {chunk}")
+            yield chunk
+
+    udp_transport.send_data(session, answer, client_address)
+    threading.Thread(target=receive, daemon=True).start()
+    with trace.phase("send"):
+        udp_transport.send_stream(session, relayed(), client_address)
+        trace.sent(length, "peer")
+    fin_message, _ = udp_transport.receive_data(session)
+    if fin_message == "FIN":
+        udp_transport.send_data(session, "Message:File delivered from peer", client_address)
+    return True
+
+def owner_peer(filename):  #address of the peer that owns a file, None if this cache owns it or the owner is down
+    if RING is None:
+        return None
+    owner = RING.owner(filename)
+    if owner == NODE or _peers_down.get(owner, 0) > time.monotonic():
+        return None
+    return owner
+
+def peer_down(peer, error):  #serve the files of a peer locally for a while
+    print(f"Peer {peer[0]}:{peer[1]} unreachable, serving its files locally: {error}")
+    _peers_down[peer] = time.monotonic() + PEER_RETRY
+
+def handle_client_request(client_socket, origin_pool, manager):  #funciton to handle the next request of a client connection, False to close it
     try:
         command = tcp_transport.receive_data(client_socket)   #receive command from client
+        if not command:   #the client closed the connection
+            return False
+        handle_command(client_socket, command, origin_pool, manager, client_socket.getpeername())
+        return True
+    except socket.timeout:
+        print("Client stopped sending in the middle of a command")
+    except Exception as e:
+        print(f"Error while handling client request: {e}")
+    return False
+
+def handle_command(client_socket, command, origin_pool, manager, peer=None):  #funciton to handle one client command and record its metrics
+    with metrics.RequestTrace(command, peer) as trace:
+        serve_command(client_socket, command, origin_pool, manager, trace)
+
+def serve_command(client_socket, command, origin_pool, manager, trace):
+    words, options = tcp_transport.parse_command(command)
+    if command.startswith('get') and len(words) > 3:  #ranged get: get <file> <offset> <length> [match=<etag>]
+        send_range(client_socket, command, words, options, origin_pool, manager, trace)
+
+    elif command.startswith('stat'):  #metadata of a fresh cached copy, otherwise of the file on the server
+        filename = words[1]
+        try:
+            plain = manager.is_fresh(filename) and manager.encoding(filename) is None   #the size of a compressed copy is not the file size
+            stat = os.stat(manager.path(filename)) if plain else None
+        except FileNotFoundError:
+            stat = None
+        if stat is not None:
+            tcp_transport.send_data(client_socket, f"Stat:{stat.st_size}:{stat.st_mtime_ns}:{manager.etag(filename)}")
+        else:
+            cache_in_background(manager, filename, origin_pool)   #a stat usually precedes ranged gets of the whole file
+            relay_request(client_socket, command, origin_pool)
 
-        if command.startswith('get'):  #If get method is invoked, check the availability in cache, if required connect to server to get the file required
-            filename = command.split(' ')[1]
-            filepath = os.path.join(CACHE_DIR, filename)  # Use filepath inside 'cache_files' directory
+    elif command.startswith('get'):  #If get method is invoked, serve it from cache or from the server
+        filename = command.split(' ')[1]
+        peer = None if options.get('forwarded') else owner_peer(filename)   #gets passed on by a peer are never passed on again
+        if peer is not None and relay_to_peer(client_socket, command, peer, trace):
+            return
+        with trace.phase("disk"):
+            filepath = manager.lookup(filename)  #path inside 'cache_files' if the file is cached
+            fresh = filepath is not None and manager.is_fresh(filename)
+            stored = manager.encoding(filename)
+            accepted = options.get('accept')   #encodings the client can decompress
+            encoding = compression_utils.choose_for_file(accepted, filepath, stored) if fresh else None   #encoding the client gets
+            data = manager.read(filename) if fresh and encoding == stored else None   #held in memory as stored
 
-            if os.path.exists(filepath):  #to check if the file is present in cache
+        if fresh and options.get('etag') is not None and options['etag'] == manager.etag(filename):  #a child cache revalidates its copy
+            trace.result = "not_modified"
+            metrics.CACHE_LOOKUPS.inc(result="hit")
+            tcp_transport.send_data(client_socket, "NotModified")
+            log_access(filename, trace.peer, trace)
+            return
+
+        if data is not None:  #the file is in the memory tier
+            trace.result = "hit"
+            with trace.phase("send"):
+                trace.sent(tcp_transport.send_file_bytes(client_socket, data, stored, "File delivered from Cache"), "memory")
+
+        elif fresh:  #to check if the file is present in cache
+            trace.result = "hit"
+            with trace.phase("send"):
                 tcp_transport.send_data(client_socket, "File delivered from Cache")
-                tcp_transport.send_file(client_socket, filepath)
-
-            else:  #if the file is not found in cache, fetch from server
-                print("File not found in cache, trying to get from server!")
-                server_socket_tcp = tcp_transport.create_tcp_socket()
-                tcp_transport.connect_to_host(server_socket_tcp, SERVER_HOST, SERVER_PORT)
-                tcp_transport.send_data(server_socket_tcp, command)
-                response = tcp_transport.receive_data(server_socket_tcp)
-                
-                if response == "FileNotFound":  #If file found over server, send to client and cache it
-                    tcp_transport.send_data(client_socket, "FileNotFound")
-                else:
+                trace.sent(tcp_transport.send_file(client_socket, filepath, encoding, stored), "cache")
+
+        else:  #if the file is not found in cache or has expired, fetch from server
+            etag = manager.etag(filename) if filepath is not None else None
+            delta = CHUNKS is not None and manager.encoding(filename) is None   #chunks are only known for uncompressed files
+            print("Cached file expired, revalidating with server!" if etag else "File not found in cache, trying to get from server!")
+            growing = fetch_once(manager, filename, lambda growing: fetch_tcp(growing, filename, etag, origin_pool, delta))
+
+            with trace.phase("origin"):
+                found = growing.wait_found()
+            trace.result = "not_found" if not found else "revalidated" if growing.unchanged else "miss"
+            if not found:
+                tcp_transport.send_data(client_socket, "FileNotFound")
+            elif growing.unchanged:  #the cached copy is still up to date
+                stored = manager.encoding(filename)
+                encoding = compression_utils.choose_for_file(accepted, growing.filepath, stored)
+                with trace.phase("send"):
+                    tcp_transport.send_data(client_socket, "File delivered from Cache")
+                    trace.sent(tcp_transport.send_file(client_socket, growing.filepath, encoding, stored), "cache")
+            elif growing.encoding is None or compression_utils.choose(accepted, growing.encoding) == growing.encoding:  #send to client while it is being cached
+                with trace.phase("send"):   #includes waiting for the data that is still arriving from the server
                     tcp_transport.send_data(client_socket, "File delivered from Server")
-                    tcp_transport.receive_file(server_socket_tcp, filepath)
-                    tcp_transport.send_file(client_socket, filepath)
+                    trace.sent(tcp_transport.send_stream(client_socket, growing.chunks(tcp_transport.BUFFER_SIZE), growing.length, growing.encoding), "origin")
+            else:   #the client needs another encoding, convert the file once it is complete
+                with trace.phase("origin"):
+                    complete = growing.wait_done()
+                if not complete:
+                    raise ConnectionError("Transfer from server failed")
+                with trace.phase("send"):
+                    tcp_transport.send_data(client_socket, "File delivered from Server")
+                    trace.sent(tcp_transport.send_transcoded(client_socket, growing.chunks(compression_utils.BLOCK_SIZE), growing.encoding, compression_utils.choose(accepted)), "origin")
+        metrics.CACHE_LOOKUPS.inc(result="miss" if trace.result == "not_found" else trace.result)
+        log_access(filename, trace.peer, trace)
 
-                server_socket_tcp.close()  #close the client connection after handling request
+    elif command.startswith('invalidate'):  #the server tells that a file changed, drop the cached copy
+        invalidate(manager, command.split(' ')[1])
 
-    except Exception as e:
-        print(f"Error while handling client request: {e}")
+    else:
+        trace.result = "invalid"
+        tcp_transport.send_data(client_socket, "InvalidCommand")
+
+def send_range(client_socket, command, words, options, origin_pool, manager, trace):  #serve a range from a fresh cached copy or from the server
+    filename, offset, length = words[1], int(words[2]), int(words[3])
+    filepath = manager.lookup(filename)
+    if (filepath is not None and manager.is_fresh(filename) and manager.encoding(filename) is None and
+            options.get('match', manager.etag(filename)) == manager.etag(filename)):
+        try:
+            f = open(filepath, 'rb')
+        except FileNotFoundError:   #evicted meanwhile
+            f = None
+        if f is not None:
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                offset = min(offset, size)
+                tcp_transport.send_data(client_socket, "File delivered from Cache")
+                trace.sent(tcp_transport.send_file_ranges(client_socket, f, [(offset, max(0, min(length, size - offset)))]), "cache")
+            return
+    cache_in_background(manager, filename, origin_pool)
+    relay_request(client_socket, command, origin_pool)   #ranges of files that are not cached yet are passed through
+
+def cache_in_background(manager, filename, origin_pool):  #fetch the whole file while parts of it are passed through
+    if manager.is_fresh(filename) or owner_peer(filename) is not None:   #cached here or by another cache of the cluster
+        return
+    etag = manager.etag(filename)   #revalidates an expired copy
+    delta = CHUNKS is not None and manager.encoding(filename) is None
+    fetch_once(manager, filename, lambda growing: fetch_tcp(growing, filename, etag, origin_pool, delta))   #shared by the ranged gets of all streams
+
+def relay_to_peer(client_socket, command, peer, trace):  #serve a get from the cache that owns the file, False if it can not be reached
+    pool = PEER_POOLS[peer]
+    try:
+        peer_socket, response = pool.request(command + " forwarded=1")
+    except OSError as e:   #nothing was sent to the client yet, it is served locally
+        peer_down(peer, e)
+        return False
+    trace.result = "peer"
+    metrics.CACHE_LOOKUPS.inc(result="peer")
+    with trace.phase("send"):
+        relay_answer(client_socket, peer_socket, response, pool, "Peer")
+    return True
+
+def relay_request(client_socket, command, origin_pool):  #forward a command to the server and its answer to the client
+    server_socket_tcp, response = origin_pool.request(command)
+    relay_answer(client_socket, server_socket_tcp, response, origin_pool, "Server")
+
+def relay_answer(client_socket, server_socket_tcp, response, pool, source):  #forward an answer (and file) of the server or a peer to the client
+    try:
+        if response.startswith("File delivered"):
+            tcp_transport.send_data(client_socket, f"File delivered from {source}")
+            if not tcp_transport.relay_file(server_socket_tcp, client_socket):
+                raise ConnectionError(f"Connection to {source.lower()} lost")
+        else:
+            tcp_transport.send_data(client_socket, response)
+    except BaseException:
+        pool.discard(server_socket_tcp)
+        raise
+    pool.release(server_socket_tcp)
+
+def subscribe_tcp(CACHE_PORT, SERVER_HOST, SERVER_PORT):  #ask the server to send invalidate commands to this cache
+    server_socket_tcp = tcp_transport.create_tcp_socket()
+    try:
+        tcp_transport.connect_to_host(server_socket_tcp, SERVER_HOST, SERVER_PORT)
+        tcp_transport.send_data(server_socket_tcp, f"subscribe {CACHE_PORT}")
+        print(f"Subscribed to invalidations: {tcp_transport.receive_data(server_socket_tcp)}")
+    except OSError as e:
+        print(f"Could not subscribe to invalidations: {e}")
     finally:
-        tcp_transport.close_connection(client_socket)
+        server_socket_tcp.close()
+
+def handle_udp_session(udp_transport, session, SERVER_HOST, SERVER_PORT, manager):  #serve the next command of a UDP session if one arrived
+    session.settimeout(0)   #only datagrams that already arrived
+    try:
+        command, client_address = udp_transport.receive_data(session)
+    except socket.timeout:   #a late packet of a finished transfer, not a command
+        return
+    session.settimeout(udp_transport.TIMEOUT)   #the rest of the command (FIN) may still be on its way
+    try:
+        with metrics.RequestTrace(command, client_address) as trace:
+            handle_udp_command(udp_transport, session, command, client_address, SERVER_HOST, SERVER_PORT, manager, trace)
+    except ConnectionError as e:   #the server transfer broke off while it was being forwarded
+        print(f"Error while handling client request: {e}")
+
+def log_access(filename, client, trace):  #record a get that delivered the file for the prefetcher
+    if PREFETCHER is not None and trace.result != "not_found":
+        PREFETCHER.accessed(filename, client)
+
+def handle_udp_command(udp_transport, session, command, client_address, SERVER_HOST, SERVER_PORT, manager, trace):  #handle one GET, PEERGET or INVALIDATE
+    if command.startswith('GET:') or command.startswith('PEERGET:'):  #Handle GET method: check cache first and fetch from server if needed
+        filename = command.split(':')[1]
+        peer = None if command.startswith('PEERGET:') else owner_peer(filename)   #a PEERGET is never passed on again
+        if peer is not None and relay_udp_to_peer(udp_transport, session, filename, peer, client_address, trace):
+            return
+        with trace.phase("disk"):
+            if manager.encoding(filename) is not None:   #stored compressed by a TCP cache, fetch it again uncompressed
+                manager.remove(filename)
+            filepath = manager.lookup(filename)  #path inside 'cache_files' if the file is cached
+            fresh = filepath is not None and manager.is_fresh(filename)
+            data = manager.read(filename) if fresh else None
+
+        if data is not None:  #the file is in the memory tier, its chunks are slices of it
+            trace.result = "hit"
+            metrics.CACHE_LOOKUPS.inc(result="hit")
+            with trace.phase("send"):
+                view, size = memoryview(data), udp_transport.CHUNK_SIZE
+                udp_transport.send_data(session, f"LEN:{len(view)}", client_address)
+                udp_transport.send_stream(session, (view[i:i + size] for i in range(0, len(view), size)), client_address)
+                trace.sent(len(view), "memory")
+            fin_message, _ = udp_transport.receive_data(session)
+            if fin_message == "FIN":
+                print("File sent to client completed successfully.")
+                udp_transport.send_data(session, "Message:File delivered from cache", client_address)
+        elif fresh:  #Check if the file is present in cache
+            trace.result = "hit"
+            metrics.CACHE_LOOKUPS.inc(result="hit")
+            with trace.phase("send"), open(filepath, 'rb') as f:   #the file is read one chunk at a time while it is sent
+                length = os.fstat(f.fileno()).st_size
+                udp_transport.send_data(session, f"LEN:{length}", client_address)
+                udp_transport.send_from_file(session, f, length, client_address)
+                trace.sent(length, "cache")
+            fin_message, _ = udp_transport.receive_data(session)
+            if fin_message == "FIN":
+                print("File sent to client completed successfully.")
+                udp_transport.send_data(session, "Message:File delivered from cache", client_address)
+        else:   #if the requested file is not in cache or has expired, fetch from server and cache it
+            etag = manager.etag(filename) if filepath is not None else None
+            growing = fetch_once(manager, filename,
+                                 lambda growing: fetch_udp(udp_transport, growing, filename, etag, SERVER_HOST, SERVER_PORT))
+            with trace.phase("origin"):
+                found = growing.wait_found()
+            trace.result = "not_found" if not found else "revalidated" if growing.unchanged else "miss"
+            metrics.CACHE_LOOKUPS.inc(result="miss" if trace.result == "not_found" else trace.result)
+            if found:
+                with trace.phase("send"):   #includes waiting for the data that is still arriving from the server
+                    udp_transport.send_data(session, f"LEN:{growing.length}", client_address)
+                    udp_transport.send_stream(session, growing.chunks(udp_transport.CHUNK_SIZE), client_address)
+                    trace.sent(growing.length, "cache" if growing.unchanged else "origin")
+                fin_message, _ = udp_transport.receive_data(session)
+                if fin_message == "FIN":
+                    print("File sent to client completed successfully.")
+                    source = "cache" if growing.unchanged else "server"
+                    udp_transport.send_data(session, f"Message:File delivered from {source}", client_address)
+            else:
+                udp_transport.send_data(session, "FileNotFound", client_address)
+        log_access(filename, client_address, trace)
+
+    elif command.startswith('INVALIDATE:'):  #the server tells that a file changed, drop the cached copy
+        invalidate(manager, command.split(':')[1])
+
+    elif command == 'FIN':  #the FIN of a transfer that arrived after the handler stopped waiting for it
+        udp_transport.send_data(session, "Message:Transfer finished", client_address)
+
+def parse_args():  #parse the command line arguments of the cache
+    parser = argparse.ArgumentParser(usage="python cache.py <CACHE_PORT> <SERVER_HOST> <SERVER_PORT> <PROTOCOL> [options]")
+    parser.add_argument("cache_port", type=int)
+    parser.add_argument("server_host")
+    parser.add_argument("server_port", type=int)
+    parser.add_argument("protocol", choices=["tcp", "snw", "sr"])
+    parser.add_argument("--concurrency", choices=tcp_transport.SERVING_MODES, default="thread",
+                        help="how TCP client connections are served (default: thread)")
+    parser.add_argument("--max-connections", type=int, default=64,
+                        help="maximum number of TCP commands or UDP sessions handled at once, idle connections do not count (default: 64)")
+    parser.add_argument("--max-open-connections", type=int, default=None,
+                        help="maximum number of TCP connections kept open, idle ones included (default: 1024, less with a low file descriptor limit)")
+    parser.add_argument("--window", type=int, default=sr_transport.WINDOW_SIZE,
+                        help="packets in flight for the sr protocol (default: %(default)s)")
+    parser.add_argument("--max-bytes", type=file_utils.parse_size, default=None,
+                        help="byte budget of the cache files, e.g. 500M (default: unlimited)")
+    parser.add_argument("--max-entries", type=int, default=None,
+                        help="maximum number of cached files (default: unlimited)")
+    parser.add_argument("--policy", choices=sorted(cache_manager.POLICIES), default="lru",
+                        help="eviction policy (default: lru)")
+    parser.add_argument("--memory-bytes", type=file_utils.parse_size, default=64 * 1024 ** 2,
+                        help="byte budget of the in-memory tier of small hot files, 0 turns it off (default: 64M)")
+    parser.add_argument("--memory-file-size", type=file_utils.parse_size, default=256 * 1024,
+                        help="largest file held in the in-memory tier (default: 256K)")
+    parser.add_argument("--ttl", type=float, default=None,
+                        help="seconds a cached file is served before it is revalidated with the server (default: forever)")
+    parser.add_argument("--subscribe", action="store_true",
+                        help="ask the server to send invalidations when files are put")
+    parser.add_argument("--compress", action="store_true",
+                        help="fetch files from the server compressed over TCP and store them compressed")
+    parser.add_argument("--delta", action="store_true",
+                        help="refetch changed files over TCP as deltas, sending only the chunks the cache does not have")
+    parser.add_argument("--peers", type=cluster.parse_nodes, default=None,
+                        help="host:port of every cache of the cluster, e.g. localhost:8001,localhost:8002")
+    parser.add_argument("--node", type=cluster.parse_address, default=None,
+                        help="host:port of this cache in --peers (default: localhost:<CACHE_PORT>)")
+    parser.add_argument("--parent", type=cluster.parse_address, default=None,
+                        help="host:port of a parent cache that misses are fetched from instead of the server")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds an idle client connection is kept open (default: %(default)s)")
+    parser.add_argument("--origin-connections", type=int, default=8,
+                        help="idle connections to the server kept for reuse (default: %(default)s)")
+    parser.add_argument("--buffer-size", type=file_utils.parse_size, default=tcp_transport.BUFFER_SIZE,
+                        help="TCP read/receive buffer size, e.g. 1M (default: %(default)s)")
+    parser.add_argument("--no-sendfile", action="store_true",
+                        help="send TCP file data from a Python buffer instead of with os.sendfile")
+    parser.add_argument("--warm", type=int, default=100,
+                        help="most requested files of the access log fetched again on startup (default: %(default)s)")
+    parser.add_argument("--prefetch-rate", type=file_utils.parse_size, default=1024 ** 2,
+                        help="bytes per second read from the server by warm-up and prefetching, e.g. 10M (default: 1M)")
+    parser.add_argument("--no-prefetch", action="store_true",
+                        help="do not log the gets of the clients, warm up or prefetch")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve metrics in the Prometheus format on http://localhost:<port>/metrics")
+    parser.add_argument("--trace", action="store_true",
+                        help="print the phases, result and bytes of every command")
+    return parser.parse_args()
+
+def start_prefetcher(manager, fetch, args):  #log the gets of the clients, warm up and prefetch in the background
+    global PREFETCHER
+    if args.no_prefetch:
+        return
+    PREFETCHER = prefetch.Prefetcher(
+        prefetch.AccessLog(CACHE_DIR), lambda filename, reason, bucket: prefetch_file(manager, filename, reason, bucket, fetch),
+        manager.is_fresh, args.prefetch_rate)
+    PREFETCHER.warm(args.warm)
+
+def stop_prefetcher():  #write the gets that are still buffered to the access log
+    if PREFETCHER is not None:
+        PREFETCHER.log.close()
 
 def main():  #main function to start the cache server and listen for client requests
-    if len(sys.argv) != 5:
-        print("Usage: python cache.py <CACHE_PORT> <SERVER_HOST> <SERVER_PORT> <PROTOCOL>")
-        sys.exit(1)
+    global IDLE_TIMEOUT, CHUNKS, COMPRESS, RING, NODE
+    args = parse_args()
 
-    CACHE_PORT = int(sys.argv[1])
+    CACHE_PORT = args.cache_port
     CACHE_HOST="localhost"
-    SERVER_HOST = sys.argv[2]
-    SERVER_PORT = int(sys.argv[3])
-    PROTOCOL = sys.argv[4]
+    SERVER_HOST = args.server_host
+    SERVER_PORT = args.server_port
+    PROTOCOL = args.protocol
+    sr_transport.WINDOW_SIZE = args.window
+    tcp_transport.BUFFER_SIZE = args.buffer_size
+    tcp_transport.USE_SENDFILE = tcp_transport.USE_SENDFILE and not args.no_sendfile
+    IDLE_TIMEOUT = args.idle_timeout
+    if args.delta:
+        CHUNKS = chunk_store.ChunkStore(CACHE_DIR)
+    COMPRESS = args.compress
+    UPSTREAM_HOST, UPSTREAM_PORT = args.parent or (SERVER_HOST, SERVER_PORT)   #where misses are fetched from
+    if args.peers:
+        RING = cluster.HashRing(args.peers)
+        NODE = args.node or cluster.parse_address(f"{CACHE_HOST}:{CACHE_PORT}")
+        print(f"Cache {NODE[0]}:{NODE[1]} in a cluster of {len(RING.nodes)} caches")
+    manager = cache_manager.CacheManager(CACHE_DIR, args.max_bytes, args.max_entries, args.policy, args.ttl,
+                                         args.memory_bytes, args.memory_file_size, CHUNKS and CHUNKS.discard)
+    metrics.TRACE = args.trace
+    metrics.gauge_function("cache_entries", "Files in the cache", lambda: manager.stats()[0])
+    metrics.gauge_function("cache_bytes", "Bytes of the files in the cache", lambda: manager.stats()[1])
+    metrics.gauge_function("cache_memory_entries", "Files in the memory tier", lambda: manager.memory_stats()[0])
+    metrics.gauge_function("cache_memory_bytes", "Bytes of the files in the memory tier", lambda: manager.memory_stats()[1])
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
  #Handle tcp protocol if the command invoked is TCP
     if(PROTOCOL == "tcp"):
         cache_socket_tcp = tcp_transport.create_tcp_socket()
         tcp_transport.bind_and_listen(cache_socket_tcp, CACHE_HOST, CACHE_PORT)
         print(f"Cache listening on {CACHE_HOST}:{CACHE_PORT}")
+        if args.subscribe:
+            subscribe_tcp(CACHE_PORT, SERVER_HOST, SERVER_PORT)
 
-        try:
-            while True:   #Accept client connection
-                client_socket, _ = cache_socket_tcp.accept()
-                print("Client connected to cache")
-                handle_client_request(client_socket, SERVER_HOST, SERVER_PORT)
+        origin_pool = tcp_transport.ConnectionPool(UPSTREAM_HOST, UPSTREAM_PORT, args.origin_connections)
+        for peer in (RING.nodes if RING is not None else []):
+            if peer != NODE:
+                PEER_POOLS[peer] = tcp_transport.ConnectionPool(*peer, args.origin_connections, PEER_TIMEOUT)
+        start_prefetcher(manager, lambda growing, filename, etag, write: fetch_tcp(
+            growing, filename, etag, origin_pool, CHUNKS is not None and manager.encoding(filename) is None, write), args)
+
+        def handler(client_socket):
+            return handle_client_request(client_socket, origin_pool, manager)
+
+        try:   #Accept client connections
+            tcp_transport.serve_connections(cache_socket_tcp, handler, args.concurrency, args.max_connections, IDLE_TIMEOUT,
+                                            args.max_open_connections)
         except KeyboardInterrupt:
             print("Cache server shutting down...")  #Shut down the cache upon encountering a keyboard interupt
         finally:
             tcp_transport.close_connection(cache_socket_tcp)  #close cache server socket
-            print("Cache server shut down") 
+            origin_pool.close()
+            for pool in PEER_POOLS.values():
+                pool.close()
+            stop_prefetcher()
+            print("Cache server shut down")
 
-    else: # PROTOCOL=SNW  #Handle Stop and wait over UDP if the command encountered has snw argument
+    else: # PROTOCOL=SNW or SR  #Handle Stop and wait or selective repeat over UDP if the command encountered has snw or sr argument
+        udp_transport = UDP_TRANSPORTS[PROTOCOL]
         cache_socket_udp = udp_transport.create_udp_socket()
         udp_transport.bind_socket(cache_socket_udp, CACHE_HOST, CACHE_PORT)
         print(f"Cache listening on {CACHE_HOST}:{CACHE_PORT}")
+        if args.subscribe:   #invalidations will arrive on the listening socket
+            udp_transport.send_data(cache_socket_udp, "SUBSCRIBE", (SERVER_HOST, SERVER_PORT))
+        start_prefetcher(manager, lambda growing, filename, etag, write: fetch_udp(
+            udp_transport, growing, filename, etag, UPSTREAM_HOST, UPSTREAM_PORT, write), args)
 
-        printed_timeout = False
-
-        while True:
-            try:  #rececive command from client
-                command, client_address = udp_transport.receive_data(cache_socket_udp)
-                printed_timeout = False
-
-                if command.startswith('GET:'):  #Handle GET method: check cache first and fetch from server if needed
-                    filename = command.split(':')[1]
-                    filepath = os.path.join(CACHE_DIR, filename)  # Use filepath inside 'cache_files' directory
-
-                    if os.path.exists(filepath):  #Check if the file is present in cache
-                        with open(filepath, 'rb') as f:
-                            file_data = f.read()
-                        udp_transport.send_data(cache_socket_udp, f"LEN:{len(file_data)}", client_address)
-                        udp_transport.send_file(cache_socket_udp, file_data, client_address)
-                        fin_message, _ = udp_transport.receive_data(cache_socket_udp)
-                        if fin_message == "FIN":
-                            print("File sent to client completed successfully.")
-                        udp_transport.send_data(cache_socket_udp, "Message:File delivered from cache", client_address)
-                    else:   #if the requested file is not in cache, fetch from server and cache it
-                        udp_transport.send_data(cache_socket_udp, command, (SERVER_HOST, SERVER_PORT))
-                        length_info, _ = udp_transport.receive_data(cache_socket_udp)
-                        if length_info.startswith("LEN:"):
-                            _, length = length_info.split(":")
-                            file_data = udp_transport.receive_file(cache_socket_udp, int(length))
-                            with open(filepath, 'wb') as f:
-                                f.write(file_data)
-                            udp_transport.send_fin(cache_socket_udp, (SERVER_HOST, SERVER_PORT))
-                            udp_transport.send_data(cache_socket_udp, f"LEN:{len(file_data)}", client_address)
-                            udp_transport.send_file(cache_socket_udp, file_data, client_address)
-                            fin_message, _ = udp_transport.receive_data(cache_socket_udp)
-                            if fin_message == "FIN":
-                                print("File sent to client completed successfully.")
-                            udp_transport.send_data(cache_socket_udp, "Message:File delivered from server", client_address)
-                        else:
-                            udp_transport.send_data(cache_socket_udp, "FileNotFound", client_address)
-
-            except socket.timeout:
-                if not printed_timeout:   #print timeout message 
-                    print("Cache socket timed out, waiting for another packet.")
-                    printed_timeout = True
-                continue
+        dispatcher = udp_dispatcher.UDPDispatcher(
+            cache_socket_udp, lambda session: handle_udp_session(udp_transport, session, UPSTREAM_HOST, UPSTREAM_PORT, manager),
+            args.max_connections)
+        try:  #serve every client in its own session
+            dispatcher.serve_forever()
+        except KeyboardInterrupt:
+            print("Cache server shutting down...")
+        finally:
+            cache_socket_udp.close()
+            stop_prefetcher()
+            print("Cache server shut down")
 #Execute main function when the script runs
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,330 @@
+"""
+The cache_manager.py file keeps track of the files stored in the cache directory and keeps them within a budget.
+1. The index of the cached files is rebuilt from the directory at startup.
+2. Files beyond max_bytes or max_entries are evicted with the lru, lfu or gdsf policy, victims come from a heap.
+3. Entries older than the ttl are revalidated with the server before they are served again.
+4. Files stored compressed are listed in the hidden file .encodings.
+5. Small, frequently requested files are also held in memory (MemoryTier), least recently used demoted first.
+Hidden files (names starting with '.') are never indexed, they are used for files that are still being fetched.
+"""
+import collections
+import heapq
+import os
+import threading
+import time
+
+import compression_utils
+import file_utils
+import metrics
+
+ENCODINGS_FILE = ".encodings"   #lines of '<filename> <encoding>' for the files stored compressed
+PROMOTE_AFTER = 2   #requests of a file (the miss that cached it included) before it is copied into memory
+
+class CacheEntry:  #size, access statistics and freshness of one cached file
+    __slots__ = ("size", "hits", "last_access", "priority", "etag", "validated_at", "encoding")
+
+    def __init__(self, size, last_access, etag=None, validated_at=None, encoding=None):
+        self.size = size
+        self.hits = 1
+        self.last_access = last_access
+        self.priority = 0.0   #used by gdsf
+        self.etag = etag      #content hash, computed on demand if unknown
+        self.validated_at = validated_at if validated_at is not None else time.time()
+        self.encoding = encoding  #compression the file is stored in, None for uncompressed
+
+class LRUPolicy:  #evict the entry that was used longest ago, every key ends with last_access so no two entries have the same key
+    def on_access(self, entry, clock):
+        pass
+
+    def victim_key(self, entry):
+        return entry.last_access
+
+    def on_evict(self, entry):
+        pass
+
+class LFUPolicy(LRUPolicy):  #evict the entry with the fewest hits, the oldest one among equals
+    def victim_key(self, entry):
+        return (entry.hits, entry.last_access)
+
+class GDSFPolicy(LRUPolicy):  #Greedy-Dual-Size-Frequency: priority = inflation + hits / size
+    def __init__(self):
+        self.inflation = 0.0   #priority of the last evicted entry, ages the entries that stay in the cache
+
+    def on_access(self, entry, clock):
+        entry.priority = self.inflation + entry.hits / max(entry.size, 1)
+
+    def victim_key(self, entry):
+        return (entry.priority, entry.last_access)
+
+    def on_evict(self, entry):
+        self.inflation = entry.priority
+
+POLICIES = {"lru": LRUPolicy, "lfu": LFUPolicy, "gdsf": GDSFPolicy}
+
+class MemoryTier:  #contents of small hot files in memory, least recently used demoted first, used under the lock of the CacheManager
+    def __init__(self, max_bytes, max_file_size):
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.entries = collections.OrderedDict()   #filename -> bytes, least recently used first
+        self.total_bytes = 0
+
+    def get(self, filename):  #the contents of a file, None if it is not in memory
+        data = self.entries.get(filename)
+        if data is not None:
+            self.entries.move_to_end(filename)
+        return data
+
+    def put(self, filename, data):  #hold the contents of a file, demoting other files to make room
+        self.discard(filename)
+        if len(data) > self.max_file_size:
+            return
+        self.entries[filename] = data
+        self.total_bytes += len(data)
+        metrics.MEMORY_PROMOTIONS.inc()
+        while self.total_bytes > self.max_bytes:
+            _, demoted = self.entries.popitem(last=False)
+            self.total_bytes -= len(demoted)
+            metrics.MEMORY_DEMOTIONS.inc()
+
+    def discard(self, filename):
+        data = self.entries.pop(filename, None)
+        if data is not None:
+            self.total_bytes -= len(data)
+
+    def __contains__(self, filename):
+        return filename in self.entries
+
+class CacheManager:  #index, budget and eviction of the files in the cache directory
+    def __init__(self, cache_dir, max_bytes=None, max_entries=None, policy="lru", ttl=None,
+                 memory_bytes=0, memory_file_size=0, on_remove=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl      #seconds a file is served without asking the server, None for forever
+        self.policy = POLICIES[policy]()
+        self.entries = {}   #filename -> CacheEntry
+        self.victims = []   #heap of (victim key, filename), including outdated keys
+        self.total_bytes = 0
+        self.memory = MemoryTier(memory_bytes, memory_file_size)
+        self.on_remove = on_remove   #called with the name of every file that is removed or evicted, under the lock
+        self.clock = 0      #logical time of the last access
+        self.lock = threading.Lock()
+        self.rebuild()
+
+    def path(self, filename):  #path of a file inside the cache directory
+        return os.path.join(self.cache_dir, filename)
+
+    def rebuild(self):  #rebuild the index from the files in the cache directory, oldest first
+        with self.lock:
+            self.entries.clear()
+            self.victims.clear()
+            self.total_bytes = 0
+            encodings = self._load_encodings()
+            files = []
+            for name in os.listdir(self.cache_dir):
+                path = self.path(name)
+                if name.startswith('.'):
+                    if file_utils.is_temp_file(name):   #left over from a fetch that was interrupted
+                        os.remove(path)
+                    continue
+                if os.path.isfile(path):
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, name, stat.st_size))
+            for mtime, name, size in sorted(files):   #a file was last validated when it was fetched
+                self._add(name, size, validated_at=mtime, encoding=encodings.get(name))
+            self._save_encodings()
+            self._evict()
+
+    def lookup(self, filename):  #return the path of a cached file and record the access, None on a miss
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None:
+                return None
+            path = self.path(filename)
+            if filename not in self.memory and not os.path.exists(path):   #removed behind our back
+                self._remove(filename)
+                self._removed(filename)
+                return None
+            self.clock += 1
+            entry.hits += 1
+            entry.last_access = self.clock
+            self.policy.on_access(entry, self.clock)
+            self._push(filename, entry)
+            return path
+
+    def read(self, filename):  #contents of a cached file if it is (or is now promoted) in memory, None if it is served from disk
+        if not self.memory.max_bytes:   #no memory tier
+            return None
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None:
+                return None
+            data = self.memory.get(filename)
+            promote = data is None and entry.hits >= PROMOTE_AFTER and entry.size <= self.memory.max_file_size
+        metrics.MEMORY_LOOKUPS.inc(result="miss" if data is None else "hit")
+        if not promote:
+            return data
+        try:
+            with open(self.path(filename), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if self.entries.get(filename) is entry:   #not replaced or evicted while it was read
+                self.memory.put(filename, data)
+        return data
+
+    def memory_stats(self):  #number of files and bytes in the memory tier
+        with self.lock:
+            return len(self.memory.entries), self.memory.total_bytes
+
+    def admit(self, filename, etag=None, encoding=None):  #index a file just stored in the cache directory, False if it is too large to keep
+        with self.lock:
+            old = self._remove(filename)
+            size = os.path.getsize(self.path(filename))
+            too_large = self.max_bytes is not None and size > self.max_bytes   #it would evict every other file and then itself
+            if too_large:
+                os.remove(self.path(filename))
+                print(f"{filename} is larger than the cache budget, it is not cached")
+            else:
+                self._add(filename, size, etag, encoding=encoding)
+            if encoding is not None or (old is not None and old.encoding is not None):
+                self._save_encodings()
+            self._evict()
+            return not too_large
+
+    def is_fresh(self, filename):  #whether a cached file may be served without revalidating it
+        with self.lock:
+            entry = self.entries.get(filename)
+            return entry is not None and (self.ttl is None or time.time() - entry.validated_at < self.ttl)
+
+    def encoding(self, filename):  #compression a cached file is stored in, None if it is uncompressed or not cached
+        with self.lock:
+            entry = self.entries.get(filename)
+            return entry and entry.encoding
+
+    def etag(self, filename):  #etag of a cached file (of its uncompressed contents), None if it is not cached
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None:
+                return None
+            if entry.etag is not None:
+                return entry.etag
+        if entry.encoding is not None:
+            etag = compression_utils.decoded_etag(self.path(filename), entry.encoding)
+        else:
+            etag = file_utils.compute_etag(self.path(filename))
+        with self.lock:
+            if self.entries.get(filename) is entry:
+                entry.etag = etag
+        return etag
+
+    def mark_validated(self, filename):  #the server confirmed that the cached file is up to date
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None:
+                entry.validated_at = time.time()
+
+    def remove(self, filename):  #drop a file from the index and the cache directory
+        with self.lock:
+            entry = self._remove(filename)
+            if entry:
+                try:
+                    os.remove(self.path(filename))
+                except FileNotFoundError:
+                    pass
+                if entry.encoding is not None:
+                    self._save_encodings()
+                self._removed(filename)
+
+    def is_full(self):  #whether a new file would make the cache evict another one
+        with self.lock:
+            return ((self.max_bytes is not None and self.total_bytes >= self.max_bytes) or
+                    (self.max_entries is not None and len(self.entries) >= self.max_entries))
+
+    def stats(self):  #number of entries and bytes in the cache
+        with self.lock:
+            return len(self.entries), self.total_bytes
+
+    def _add(self, filename, size, etag=None, validated_at=None, encoding=None):
+        self.clock += 1
+        entry = CacheEntry(size, self.clock, etag, validated_at, encoding)
+        self.policy.on_access(entry, self.clock)
+        self.entries[filename] = entry
+        self.total_bytes += size
+        self._push(filename, entry)
+
+    def _push(self, filename, entry):  #record the current key of an entry, its older keys become outdated
+        heapq.heappush(self.victims, (self.policy.victim_key(entry), filename))
+        if len(self.victims) > 2 * len(self.entries) + 64:   #drop the outdated keys once they are the majority
+            self.victims = [(self.policy.victim_key(entry), name) for name, entry in self.entries.items()]
+            heapq.heapify(self.victims)
+
+    def _pop_victim(self):  #filename of the entry the policy evicts first
+        while True:
+            key, filename = heapq.heappop(self.victims)
+            entry = self.entries.get(filename)
+            if entry is not None and self.policy.victim_key(entry) == key:
+                return filename
+
+    def _remove(self, filename):
+        self.memory.discard(filename)
+        entry = self.entries.pop(filename, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+        return entry
+
+    def _removed(self, filename):
+        if self.on_remove is not None:
+            self.on_remove(filename)
+
+    def _load_encodings(self):  #filename -> encoding of the files stored compressed
+        encodings = {}
+        try:
+            with open(self.path(ENCODINGS_FILE)) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) != 2:
+                        continue
+                    if fields[1] in compression_utils.CODECS:
+                        encodings[fields[0]] = fields[1]
+                    else:   #stored in an encoding this installation can not decompress
+                        try:
+                            os.remove(self.path(fields[0]))
+                        except FileNotFoundError:
+                            pass
+        except FileNotFoundError:
+            pass
+        return encodings
+
+    def _save_encodings(self):
+        lines = [f"{filename} {entry.encoding}\n" for filename, entry in self.entries.items() if entry.encoding is not None]
+        if not lines:
+            try:
+                os.remove(self.path(ENCODINGS_FILE))
+            except FileNotFoundError:
+                pass
+            return
+        f, temp_path = file_utils.create_temp_file(self.path(ENCODINGS_FILE))
+        with f:
+            f.write("".join(lines).encode())
+        os.replace(temp_path, self.path(ENCODINGS_FILE))
+
+    def _over_budget(self):
+        return ((self.max_bytes is not None and self.total_bytes > self.max_bytes) or
+                (self.max_entries is not None and len(self.entries) > self.max_entries))
+
+    def _evict(self):  #evict entries chosen by the policy until the cache is within its budget
+        while self.entries and self._over_budget():
+            filename = self._pop_victim()
+            entry = self._remove(filename)
+            self.policy.on_evict(entry)
+            try:
+                os.remove(self.path(filename))
+            except FileNotFoundError:
+                pass
+            if entry.encoding is not None:
+                self._save_encodings()
+            self._removed(filename)
+            metrics.EVICTIONS.inc()
+            print(f"Evicted {filename} from cache")
@@ -0,0 +1,185 @@
+"""
+The chunk_store.py file splits files into content-defined chunks, so only the changed parts of a file are transferred again.
+1. Chunk boundaries depend on the contents only, on average every 64 KiB, so an insertion only changes the chunks around it.
+2. A manifest lists the digest and size of every chunk of a file, manifests are kept in .manifests.
+3. ChunkStore indexes the chunks of the files it has manifests for, discard forgets a removed file.
+The sender sends the manifest, the receiver asks for the chunks it does not have and assembles the file.
+"""
+import contextlib
+import hashlib
+import os
+import threading
+
+import file_utils
+
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+READ_SIZE = 4 * 1024 * 1024   #bytes scanned for boundaries at a time
+MANIFEST_DIR = ".manifests"
+MAX_MANIFEST = 16 * 1024 * 1024   #longest manifest (or list of missing digests) accepted, about 72 bytes per chunk
+
+_BITS = bytes(b"ab"[hashlib.sha256(bytes([i])).digest()[0] & 1] for i in range(256))   #byte -> one pseudo random bit
+_ANCHOR = b"abaabbbabbaaabab"   #16 bits, found once every 64 KiB on average
+
+def iter_chunks(f):  #yield the content-defined chunks of an open file as memoryviews, copy them to keep them
+    carry = b""
+    while True:
+        block = f.read(READ_SIZE)
+        eof = not block
+        data = carry + block if carry else block
+        signal = data.translate(_BITS)   #one 'a' or 'b' per byte, the anchor is searched in C
+        view = memoryview(data)
+        start = 0
+        while start < len(data) and (eof or len(data) - start >= MAX_CHUNK):   #without enough data the boundary is unknown
+            anchor = signal.find(_ANCHOR, start + MIN_CHUNK - len(_ANCHOR), start + MAX_CHUNK)
+            end = anchor + len(_ANCHOR) if anchor >= 0 else min(start + MAX_CHUNK, len(data))
+            yield view[start:end]
+            start = end
+        if eof:
+            return
+        carry = data[start:]
+
+def compute_manifest(f):  #list of (digest, size) of the chunks of an open file
+    return [(hashlib.sha256(chunk).hexdigest(), len(chunk)) for chunk in iter_chunks(f)]
+
+def format_manifest(manifest):  #manifest as sent in a control message: digest:size digest:size ...
+    return " ".join(f"{digest}:{size}" for digest, size in manifest)
+
+def parse_manifest(text):
+    manifest = []
+    for item in text.split():
+        digest, size = item.split(":")
+        if not 0 < int(size) <= MAX_CHUNK:   #a received chunk is read into memory at once
+            raise ValueError(f"Chunk size {size} out of range")
+        manifest.append((digest, int(size)))
+    return manifest
+
+def missing_digests(manifest, have):  #digests of the manifest that have(digest) is False for, each once, in order
+    missing, seen = [], set()
+    for digest, _ in manifest:
+        if digest not in seen and not have(digest):
+            missing.append(digest)
+        seen.add(digest)
+    return missing
+
+def assemble(manifest, missing, read_local, read_remote, write):  #write a file from local chunks and received ones
+    received = {}   #received chunks that occur again later in the file
+    remaining = {}
+    for digest, _ in manifest:
+        remaining[digest] = remaining.get(digest, 0) + 1
+    missing = set(missing)
+    for digest, size in manifest:
+        remaining[digest] -= 1
+        if digest in received:
+            data = received[digest] if remaining[digest] else received.pop(digest)
+        elif digest in missing:
+            data = read_remote(size)
+            if hashlib.sha256(data).hexdigest() != digest:
+                raise ConnectionError(f"Received chunk does not match its digest {digest}")
+            missing.discard(digest)
+            if remaining[digest]:
+                received[digest] = data
+        else:
+            data = read_local(digest)
+            if data is None:
+                raise ConnectionError(f"Chunk {digest} is no longer available")
+        write(data)
+
+class ChunkStore:  #manifests of the files in a directory and an index of their chunks
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_dir = os.path.join(directory, MANIFEST_DIR)
+        self.manifests = {}   #filename -> (size, mtime_ns, manifest)
+        self.index = {}       #digest -> {filename: (offset, size)} of the files that contain the chunk
+        self.lock = threading.Lock()
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self.load()
+
+    def load(self):  #read the manifests saved earlier, dropping those of files that changed or were removed
+        for filename in os.listdir(self.manifest_dir):
+            path = os.path.join(self.manifest_dir, filename)
+            try:
+                with open(path) as f:
+                    size, mtime_ns = map(int, f.readline().split())
+                    manifest = parse_manifest(f.read())
+            except (OSError, ValueError):
+                manifest = None
+            if manifest is None or not self._matches(filename, size, mtime_ns):
+                os.remove(path)
+                continue
+            with self.lock:
+                self._add(filename, size, mtime_ns, manifest)
+
+    def manifest(self, filename, f=None):  #manifest of a file, computed from f (or the file) if it is not known yet
+        with open(os.path.join(self.directory, filename), 'rb') if f is None else contextlib.nullcontext(f) as f:
+            stat = os.fstat(f.fileno())
+            with self.lock:
+                known = self.manifests.get(filename)
+            if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+                return known[2]
+            f.seek(0)
+            manifest = compute_manifest(f)
+        self.record(filename, stat, manifest)
+        return manifest
+
+    def record(self, filename, stat, manifest):  #remember the manifest of a file with the given os.stat result
+        with self.lock:
+            self._add(filename, stat.st_size, stat.st_mtime_ns, manifest)
+        path = os.path.join(self.manifest_dir, filename)
+        f, temp_path = file_utils.create_temp_file(path)   #removed by load if it is left behind
+        with f:
+            f.write(f"{stat.st_size} {stat.st_mtime_ns}\n{format_manifest(manifest)}".encode())
+        os.replace(temp_path, path)
+
+    def discard(self, filename):  #forget a file that was removed, and the chunks no other file contains
+        with self.lock:
+            self._drop(filename)
+        try:
+            os.remove(os.path.join(self.manifest_dir, filename))
+        except FileNotFoundError:
+            pass
+
+    def has(self, digest):  #whether a chunk is available in one of the indexed files
+        with self.lock:
+            files = [(filename, *self.manifests[filename][:2]) for filename in self.index.get(digest, ())]
+        return any(self._matches(*file) for file in files)
+
+    def read_chunk(self, digest):  #contents of a chunk read from an indexed file, None if it is not available any more
+        with self.lock:
+            locations = list(self.index.get(digest, {}).items())
+        for filename, (offset, size) in locations:
+            try:
+                with open(os.path.join(self.directory, filename), 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(size)
+            except OSError:
+                continue
+            if hashlib.sha256(data).hexdigest() == digest:   #otherwise the file changed since it was indexed
+                return data
+        return None
+
+    def _matches(self, filename, size, mtime_ns):  #whether a file still has the given size and modification time
+        try:
+            stat = os.stat(os.path.join(self.directory, filename))
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns)
+
+    def _add(self, filename, size, mtime_ns, manifest):
+        self._drop(filename)   #the chunks of the previous version of the file are gone
+        self.manifests[filename] = (size, mtime_ns, manifest)
+        offset = 0
+        for digest, chunk_size in manifest:
+            self.index.setdefault(digest, {})[filename] = (offset, chunk_size)
+            offset += chunk_size
+
+    def _drop(self, filename):
+        old = self.manifests.pop(filename, None)
+        if old is None:
+            return
+        for digest, _ in old[2]:
+            files = self.index.get(digest)
+            if files is not None:
+                files.pop(filename, None)
+                if not files:
+                    del self.index[digest]
@@ -8,137 +8,339 @@ The following information gives a simple breakdown structure of the client side
    (b) Invoke relavant blocks of code based on the protocol input
 4. TCP protocol Handling:
    (a) PUT method sends the file to server
-   (b) GET method can download file from server or cache based on the availability
+   (b) GET method can download file from server or cache based on the availability, 'get a b c' pipelines several gets
    (c) quit command will exit the program
+   (d) the connections to the server and to the cache are kept open and reused by later commands
+   (e) with --streams N, GET fetches a file in ranges over N connections and resumes an interrupted transfer
+   (f) with --compress, files are transferred compressed with an encoding both sides support
+   (g) with --delta, PUT sends the chunk manifest of the file and then only the chunks the server does not have
+   (h) with --cache-nodes, GET is sent to the cache of the cluster that owns the file (consistent hashing)
 5. UDP protocol Handling
    (a) PUT method sends the file to server in chunks on 1000 bytes
    (b) GET method can download file from server or cache based on the availability in chunks of 1000 bytes
    (c) quit command will exit the program
+   (d) chunks are sent with stop and wait (snw) or with a sliding window of --window chunks (sr)
+   (e) with --cache-nodes, GET is sent to the cache of the cluster that owns the file
 """
 
 import sys
 import os
+import socket
+import argparse
+import threading
 sys.path.append("..")
-import snw_transport as udp_transport     #snw_transport file is the library consisting the snw related functions
+import snw_transport                      #snw_transport file is the library consisting the snw related functions
+import sr_transport                       #sr_transport file is the library consisting the selective repeat related functions
+import file_utils                         #file_utils file has the etag, temporary file and size parsing helpers
+import chunk_store                        #chunk_store file has the content-defined chunking used for delta uploads
+import compression_utils                  #compression_utils file has the compression used on the wire
 import tcp_transport                      #tcp_transport file is the library consisting the tcp related functions
+import cluster                            #cluster file has the consistent hashing of files onto the caches of a cluster
 
+UDP_TRANSPORTS = {"snw": snw_transport, "sr": sr_transport}   #reliable UDP transports selectable by the protocol argument
+
+RANGE_SIZE = 8 * 1024 * 1024   #bytes fetched by one ranged request when a file is fetched over several connections
 CLIENT_DIR = "client_files"   #The folder to which client stores the donwloaded files/Uploads the files from this folder to the origin
 
 # Create the 'client_files' directory if it doesn't exist
 if not os.path.exists(CLIENT_DIR):
     os.makedirs(CLIENT_DIR)
 #This function will allow the client to send/upload files to the server using the TCP protocol
-def put_file(client_socket, command):    
+def put_file(server_pool, command, encoding=None):
     filename = command.split(' ')[1]
     filepath = os.path.join(CLIENT_DIR, filename)
-    if os.path.exists(filepath):
-        tcp_transport.send_file(client_socket, filepath)   #to send file, if it exits
-        print(tcp_transport.receive_data(client_socket)) #print the response
+    if os.path.exists(filepath):   #send the command and the file (compressed in encoding), if it exits
+        client_socket, response = server_pool.request(command, send_body=lambda s: tcp_transport.send_file(s, filepath, compression_utils.choose_for_file(encoding, filepath)))
+        server_pool.release(client_socket)
+        print(response) #print the response
     else:
         print(f"File '{filename}' not found!")
-#This function will allow the client to receive/upload files from the server using the TCP protocol
-def get_file(client_socket, command):     
+#This function asks the server which compressions it supports and picks the one to upload files with
+def negotiate_encoding(server_pool):
+    client_socket, response = server_pool.request("encodings")
+    server_pool.release(client_socket)
+    if not response.startswith("Encodings:"):   #a server without compression support
+        return None
+    supported = response.split(":", 1)[1].split(",")
+    return compression_utils.choose([name for name in compression_utils.available() if name in supported])
+#This function uploads only the chunks of a file that the server does not have yet (put with --delta)
+def put_file_delta(server_pool, command):
     filename = command.split(' ')[1]
+    filepath = os.path.join(CLIENT_DIR, filename)
+    if not os.path.exists(filepath):
+        print(f"File '{filename}' not found!")
+        return
+    with open(filepath, 'rb') as f:
+        manifest = chunk_store.compute_manifest(f)
+        client_socket, response = server_pool.request(
+            f"putdelta {filename}", send_body=lambda s: tcp_transport.send_data(s, chunk_store.format_manifest(manifest)),
+            max_length=chunk_store.MAX_MANIFEST)
+        try:
+            missing = set(response.split()[1:])   #Missing <digest> ...
+            ranges, offset = [], 0
+            for digest, size in manifest:   #in the order the server assembles the file
+                if digest in missing:
+                    ranges.append((offset, size))
+                    missing.discard(digest)
+                offset += size
+            tcp_transport.send_file_ranges(client_socket, f, ranges)
+            print(tcp_transport.receive_data(client_socket), f"({sum(size for _, size in ranges)} of {offset} bytes sent)")
+        except BaseException:
+            server_pool.discard(client_socket)
+            raise
+    server_pool.release(client_socket)
+#This function will allow the client to receive/upload files from the server using the TCP protocol
+def get_file(client_socket, filename):
     filepath = os.path.join(CLIENT_DIR, filename)
     response = tcp_transport.receive_data(client_socket)  #to get the response
+    if not response:
+        raise ConnectionError("Connection closed by cache")
     if response == "FileNotFound":
-        print("File not found on cache or server!")   #print relavant message if file not found
+        print(f"File '{filename}' not found on cache or server!")   #print relavant message if file not found
         return
-    else:
-        print(response)                
-        tcp_transport.receive_file(client_socket, filepath)   #To receive and save the file
-        #print(f"Received file {filename}")
+    print(response)
+    if not tcp_transport.receive_file(client_socket, filepath):   #To receive and save the file
+        raise ConnectionError(f"Connection lost while receiving {filename}")
+#This function downloads several files over one connection, all get commands are sent before the first answer is read
+def get_files(cache_pool, filenames, accept=None):
+    while filenames:
+        client_socket, reused = cache_pool.acquire()
+        received = 0
+        try:
+            for filename in filenames:   #pipeline the commands, accept lists the compressions the client can receive
+                tcp_transport.send_data(client_socket, f"get {filename} accept={accept}" if accept else f"get {filename}")
+            for filename in filenames:   #the answers arrive in the order of the commands
+                get_file(client_socket, filename)
+                received += 1
+        except OSError:
+            cache_pool.discard(client_socket)
+            if not reused or received:
+                raise
+            continue   #the idle connection had been closed by the cache, send the commands again on a new one
+        cache_pool.release(client_socket)
+        return
+
+#This function downloads a file in ranges over several connections at once (get with --streams)
+def get_file_parallel(cache_pool, filename, streams):
+    client_socket, response = cache_pool.request(f"stat {filename}")
+    cache_pool.release(client_socket)
+    if not response.startswith("Stat:"):
+        print(f"File '{filename}' not found on cache or server!")
+        return
+    _, size, _, etag = response.split(":")
+    size = int(size)
+    filepath = os.path.join(CLIENT_DIR, filename)
+    part_path = os.path.join(CLIENT_DIR, f".{filename}.part")           #the file, written at the offsets of the ranges
+    progress_path = os.path.join(CLIENT_DIR, f".{filename}.progress")   #the ranges that are complete, to resume from
+
+    done = load_progress(progress_path, size, etag)
+    if not done:
+        with open(progress_path, 'w') as progress:
+            progress.write(f"{size} {etag}\n")
+    ranges = [(offset, min(RANGE_SIZE, size - offset)) for offset in range(0, size, RANGE_SIZE) if offset not in done]
+    print(f"Fetching {len(ranges)} ranges over {min(streams, len(ranges))} connections" + (" (resumed)" if done else ""))
+
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+    lock = threading.Lock()
+    errors = []
+
+    def worker():   #fetch ranges until none are left or one failed
+        while True:
+            with lock:
+                if not ranges or errors:
+                    return
+                offset, length = ranges.pop(0)
+            try:
+                get_range(cache_pool, filename, etag, fd, offset, length)
+            except (OSError, ValueError) as e:
+                with lock:
+                    errors.append(e)
+                return
+            with lock, open(progress_path, 'a') as progress:
+                progress.write(f"{offset} {length}\n")
+
+    try:
+        os.ftruncate(fd, size)
+        threads = [threading.Thread(target=worker) for _ in range(min(streams, len(ranges)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        os.close(fd)
+    if errors:
+        print(f"Transfer of '{filename}' incomplete: {errors[0]}. Get it again to resume.")
+        return
+    os.replace(part_path, filepath)
+    os.remove(progress_path)
+    print(f"Received {filename}")
+
+def load_progress(progress_path, size, etag):  #offsets of the ranges fetched earlier, empty if there are none or the file changed
+    try:
+        with open(progress_path) as progress:
+            if progress.readline().split() != [str(size), etag]:
+                return set()
+            done = set()
+            for line in progress:
+                fields = line.split()
+                if len(fields) == 2 and int(fields[0]) % RANGE_SIZE == 0 and int(fields[1]) == min(RANGE_SIZE, size - int(fields[0])):
+                    done.add(int(fields[0]))
+            return done
+    except (FileNotFoundError, ValueError):
+        return set()
+
+#This function fetches one range of a file and writes it at its offset
+def get_range(cache_pool, filename, etag, fd, offset, length):
+    client_socket, response = cache_pool.request(f"get {filename} {offset} {length} match={etag}")
+    try:
+        if not response.startswith("File delivered"):   #Changed or FileNotFound
+            raise ValueError(f"file changed on the server ({response})")
+        if tcp_transport.receive_file_length(client_socket) != length:
+            raise ConnectionError("Unexpected range length")
+        position = offset
+
+        def write(data):
+            nonlocal position
+            os.pwrite(fd, data, position)
+            position += len(data)
 
+        if not tcp_transport.receive_exact(client_socket, length, write):
+            raise ConnectionError(f"Connection lost while receiving {filename}")
+    except BaseException:
+        cache_pool.discard(client_socket)
+        raise
+    cache_pool.release(client_socket)
+
+def parse_args():   #parse the command line arguments of the client
+    parser = argparse.ArgumentParser(usage="python client.py <SERVER_HOST> <SERVER_PORT> <CACHE_HOST> <CACHE_PORT> <PROTOCOL> [options]")
+    parser.add_argument("server_host")
+    parser.add_argument("server_port", type=int)
+    parser.add_argument("cache_host")
+    parser.add_argument("cache_port", type=int)
+    parser.add_argument("protocol", choices=["tcp", "snw", "sr"])
+    parser.add_argument("--window", type=int, default=sr_transport.WINDOW_SIZE,
+                        help="packets in flight for the sr protocol (default: %(default)s)")
+    parser.add_argument("--compress", action="store_true",
+                        help="transfer files compressed over TCP (zstd, zlib or lzma, whichever both sides support)")
+    parser.add_argument("--streams", type=int, default=1,
+                        help="TCP connections a file is fetched over in parallel ranges, resumable (default: %(default)s)")
+    parser.add_argument("--delta", action="store_true",
+                        help="upload files over TCP as deltas, sending only the chunks the server does not have")
+    parser.add_argument("--cache-nodes", type=cluster.parse_nodes, default=None,
+                        help="host:port of every cache of a cluster, gets go to the cache that owns the file")
+    parser.add_argument("--buffer-size", type=file_utils.parse_size, default=tcp_transport.BUFFER_SIZE,
+                        help="TCP read/receive buffer size, e.g. 1M (default: %(default)s)")
+    parser.add_argument("--no-sendfile", action="store_true",
+                        help="send TCP file data from a Python buffer instead of with os.sendfile")
+    return parser.parse_args()
 
 def main():
-    if len(sys.argv)!=6:
-        print("Usage: python client.py <SERVER_HOST> <SERVER_PORT> <CACHE_HOST> <CACHE_PORT> <PROTOCOL>")
-        sys.exit(1)
+    args = parse_args()
 #to extract the command line arguments
-    SERVER_HOST = sys.argv[1]    #To extract the server host
-    SERVER_PORT = int(sys.argv[2])    #To extract server port
-    CACHE_HOST = sys.argv[3]      #to extract cache host
-    CACHE_PORT = int(sys.argv[4])   #To extract cache port
-    PROTOCOL=sys.argv[5]    
+    SERVER_HOST = args.server_host    #To extract the server host
+    SERVER_PORT = args.server_port    #To extract server port
+    CACHE_HOST = args.cache_host      #to extract cache host
+    CACHE_PORT = args.cache_port   #To extract cache port
+    PROTOCOL = args.protocol
+    sr_transport.WINDOW_SIZE = args.window
+    tcp_transport.BUFFER_SIZE = args.buffer_size
+    tcp_transport.USE_SENDFILE = tcp_transport.USE_SENDFILE and not args.no_sendfile
+    ring = cluster.HashRing(args.cache_nodes) if args.cache_nodes else None   #the caches of a cluster
+
+    def cache_for(filename):   #address of the cache to get a file from
+        return ring.owner(filename) if ring is not None else (CACHE_HOST, CACHE_PORT)
 
     if(PROTOCOL=="tcp"):
+       server_pool = tcp_transport.ConnectionPool(SERVER_HOST, SERVER_PORT, 1)   #persistent connections, reused by later commands
+       cache_pools = {}   #address of a cache -> persistent connections to it
+
+       def cache_pool_for(filename):
+           address = cache_for(filename)
+           if address not in cache_pools:
+               cache_pools[address] = tcp_transport.ConnectionPool(*address, args.streams)
+           return cache_pools[address]
+
+       accept = ",".join(compression_utils.available()) if args.compress else None   #compressions offered to the cache
+       put_encoding = None   #compression used for uploads, asked from the server on the first put
        while True:
             command = input("Enter command: ")   #To get the user command input
             
 
             if command.startswith('put'):           #If method is 'PUT'
                 print("Awaiting server response.")
-                client_socket = tcp_transport.create_tcp_socket()   #create a tcp socket
-                tcp_transport.connect_to_host(client_socket, SERVER_HOST, SERVER_PORT)   #connect to server
-                tcp_transport.send_data(client_socket, command)   #send command to server
-                put_file(client_socket, command)    #upload the file
-                
-                tcp_transport.close_connection(client_socket)   #close the connection
-
-            elif command.startswith('get'):        #If method is 'GET'
-                print("Awaiting server response.")
-                client_socket = tcp_transport.create_tcp_socket()   #create a tcp socket
-                tcp_transport.connect_to_host(client_socket, CACHE_HOST, CACHE_PORT)  #connect to cache
-                tcp_transport.send_data(client_socket, command)   #send command to cache 
-                get_file(client_socket, command)   #download the file
+                if args.delta:
+                    put_file_delta(server_pool, command)   #upload only the changed chunks of the file
+                else:
+                    if args.compress and put_encoding is None:
+                        put_encoding = negotiate_encoding(server_pool) or ""
+                    put_file(server_pool, command, put_encoding or None)    #upload the file over the connection to the server
 
-                tcp_transport.close_connection(client_socket)    #close connenction
+            elif command.startswith('get'):        #If method is 'GET', 'get a b c' downloads several files at once
+                print("Awaiting server response.")
+                if args.streams > 1:
+                    for filename in command.split()[1:]:
+                        get_file_parallel(cache_pool_for(filename), filename, args.streams)   #download the file in ranges over several connections
+                else:
+                    batches = {}   #the files to get from each cache, in the order they were asked for
+                    for filename in command.split()[1:]:
+                        batches.setdefault(cache_for(filename), []).append(filename)
+                    for filenames in batches.values():
+                        get_files(cache_pool_for(filenames[0]), filenames, accept)   #download the files over the connection to the cache
 
             elif command == 'quit':        #Exit program on encountering a quit command
+                server_pool.close()   #close the connections
+                for cache_pool in cache_pools.values():
+                    cache_pool.close()
                 print("Exiting Program....")    #print relavant message to the user
                 break
 
             else:
                 print("Invalid command! Please use 'put', 'get', or 'quit'.")   #If an invalid command is enter print error message
 
-    else: #PROTOCOL=SNW               # If the protocol invoked is stop and wait
+    else: #PROTOCOL=SNW or SR        # If the protocol invoked is stop and wait or selective repeat
+        udp_transport = UDP_TRANSPORTS[PROTOCOL]
         client_socket = udp_transport.create_udp_socket()     #create a UDP Socket
+        client_socket.settimeout(udp_transport.TIMEOUT)       #requests are sent again until they are answered, then given up
 
         while True:
             command = input("Enter command: ")
 
-            if command.startswith('put'):              #Handle PUT command 
-                filename = command.split(' ')[1]
-                filepath = os.path.join(CLIENT_DIR, filename)  # Use filepath inside 'client_files' directory
-                if os.path.exists(filepath):
-                    with open(filepath, 'rb') as f:    #open and read the file to be sent
-                        file_data = f.read()
-
-                    udp_transport.send_data(client_socket, f"PUT:{filename}", (SERVER_HOST, SERVER_PORT))
-                    udp_transport.send_data(client_socket, f"LEN:{len(file_data)}", (SERVER_HOST, SERVER_PORT))
-                    udp_transport.send_file(client_socket, file_data, (SERVER_HOST, SERVER_PORT))
-
-                    fin_message, _ = udp_transport.receive_data(client_socket)
-                    if fin_message == "FIN":
-                        None# print("Received FIN from server.")   Receive FIN message from server upon complete transmission of data
-                    response, _ = udp_transport.receive_data(client_socket)
-                    if response.startswith("Message:"):
-                        print("Server response: ",response.split(":", 1)[1])
-
-            elif command.startswith('get'):    #Handle GET command
-                filename = command.split(' ')[1]
-                udp_transport.send_data(client_socket, f"GET:{filename}", (CACHE_HOST, CACHE_PORT))
-
-                length_info, _ = udp_transport.receive_data(client_socket)
-                if length_info.startswith("LEN:"):
-                    _, length = length_info.split(":")
-                    file_data = udp_transport.receive_file(client_socket, int(length))
+            try:
+                if command.startswith('put'):              #Handle PUT command 
+                    filename = command.split(' ')[1]
                     filepath = os.path.join(CLIENT_DIR, filename)  # Use filepath inside 'client_files' directory
-                    with open(filepath, 'wb') as f:
-                        f.write(file_data)
+                    if os.path.exists(filepath):
+                        with open(filepath, 'rb') as f:    #open the file, it is read one chunk at a time while it is sent
+                            length = os.fstat(f.fileno()).st_size
+                            udp_transport.request(client_socket, f"PUT:{filename}:{length}", (SERVER_HOST, SERVER_PORT))   #answered once the server is ready for the data
+                            udp_transport.send_from_file(client_socket, f, length, (SERVER_HOST, SERVER_PORT))
+
+                        response, _ = udp_transport.send_fin(client_socket, (SERVER_HOST, SERVER_PORT))   #answered once the file is saved
+                        if response.startswith("Message:"):
+                            print("Server response: ",response.split(":", 1)[1])
+
+                elif command.startswith('get'):    #Handle GET command
+                    filename = command.split(' ')[1]
+                    cache_address = cache_for(filename)   #the cache of the cluster that owns the file
+                    length_info, _ = udp_transport.request(client_socket, f"GET:{filename}", cache_address)
+                    if length_info.startswith("LEN:"):
+                        _, length = length_info.split(":")
+                        filepath = os.path.join(CLIENT_DIR, filename)  # Use filepath inside 'client_files' directory
+                        udp_transport.receive_file_to(client_socket, filepath, int(length))   #written straight into the file
                     
-                    udp_transport.send_fin(client_socket, (CACHE_HOST, CACHE_PORT))
-                    message, _ = udp_transport.receive_data(client_socket)
-                    if message.startswith("Message:"):
-                        print("Server response: ",message.split(":", 1)[1])
+                        message, _ = udp_transport.send_fin(client_socket, cache_address)
+                        if message.startswith("Message:"):
+                            print("Server response: ",message.split(":", 1)[1])
 
-                else:
-                    print("File not found on server!")
+                    else:
+                        print("File not found on server!")
 
-            elif command == 'quit':     #Handle quit command
-                client_socket.close()     #close UDP socket
-                print("Exiting Program....")
-                break
+                elif command == 'quit':     #Handle quit command
+                    client_socket.close()     #close UDP socket
+                    print("Exiting Program....")
+                    break
+            except socket.timeout:   #the transfer was given up after retransmitting without an answer
+                print("No response, the transfer was given up.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,40 @@
+"""
+The cluster.py file lets several caches work as one cache cluster, so the files are spread over their disks.
+1. HashRing places every node at VIRTUAL_NODES points of a hash ring, a file belongs to the next node after its hash.
+2. Caches with the same --peers agree on the owner of every file and pass the gets of other files on to it.
+3. Clients with the same --cache-nodes send every get straight to the owner.
+Nodes are written as host:port and compared by IP address.
+"""
+import bisect
+import hashlib
+import socket
+
+VIRTUAL_NODES = 100   #points of every node on the ring, more points spread the files more evenly
+
+def parse_address(text):  #(ip, port) of a node written as host:port
+    host, _, port = text.strip().rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"Expected host:port, got '{text}'")
+    return socket.gethostbyname(host), int(port)
+
+def parse_nodes(text):  #addresses of a comma separated list of nodes
+    return [parse_address(node) for node in text.split(",") if node.strip()]
+
+def _hash(text):
+    return int.from_bytes(hashlib.sha1(text.encode()).digest()[:8], "big")
+
+class HashRing:  #consistent hashing of file names onto node addresses
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node")
+        self.nodes = sorted(set(nodes))
+        points = sorted((_hash(f"{host}:{port}#{i}"), (host, port)) for host, port in self.nodes for i in range(virtual_nodes))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key):  #address of the node that owns a file name
+        i = bisect.bisect_left(self.hashes, _hash(key))
+        return self.owners[i % len(self.owners)]
+
+    def __contains__(self, node):
+        return node in self.nodes
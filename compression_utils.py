@@ -0,0 +1,151 @@
+"""
+The compression_utils.py file has the compression used on the wire (TCP only).
+1. Supported encodings, most preferred first: zstd (if available), zlib and lzma.
+2. The receiver lists the encodings it accepts (accept=zstd,zlib), files that do not shrink are sent uncompressed.
+3. Encoder, Decoder and transcode convert streams piece by piece.
+"""
+import hashlib
+import os
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:   #Python built without lzma
+    lzma = None
+try:
+    from compression import zstd   #Python 3.14 and later
+except ImportError:
+    zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BLOCK_SIZE = 256 * 1024   #bytes read from a file at a time
+DECODE_SLICE = 16 * 1024  #compressed bytes passed to a decompressor at a time, bounds the output of one call
+SAMPLE_SIZE = 256 * 1024  #bytes compressed to tell whether compressing a file is worth it
+
+class Codec:  #how one encoding is compressed and decompressed
+    def __init__(self, name, encoding_id, compressor, decompressor):
+        self.name = name
+        self.id = encoding_id
+        self.compressor = compressor       #returns an object with compress(data) and flush()
+        self.decompressor = decompressor   #returns an object with decompress(data) and, for some encodings, flush() and eof
+
+CODECS = {}
+if zstd is not None:
+    CODECS["zstd"] = Codec("zstd", 3, zstd.ZstdCompressor, zstd.ZstdDecompressor)
+elif zstandard is not None:
+    CODECS["zstd"] = Codec("zstd", 3, lambda: zstandard.ZstdCompressor().compressobj(),
+                           lambda: zstandard.ZstdDecompressor().decompressobj())
+CODECS["zlib"] = Codec("zlib", 1, lambda: zlib.compressobj(6), zlib.decompressobj)
+if lzma is not None:
+    CODECS["lzma"] = Codec("lzma", 2, lzma.LZMACompressor, lzma.LZMADecompressor)
+
+_BY_ID = {codec.id: codec for codec in CODECS.values()}
+
+def available():  #names of the supported encodings, most preferred first
+    return list(CODECS)
+
+def choose(accepted, preferred=None):  #encoding to send given the accept list of the receiver, None for no compression
+    names = accepted.split(",") if isinstance(accepted, str) else list(accepted or [])
+    if preferred is not None and preferred in names:   #e.g. the encoding a file is already stored in
+        return preferred
+    return next((name for name in names if name in CODECS), None)
+
+_shrinks = {}   #(path, encoding) -> (size, mtime_ns, whether the sample got smaller)
+_shrinks_lock = threading.Lock()
+
+def shrinks(path, name):  #whether compressing the start of a file makes it smaller
+    stat = os.stat(path)
+    with _shrinks_lock:
+        known = _shrinks.get((path, name))
+    if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+        return known[2]
+    with open(path, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    compressor = CODECS[name].compressor()
+    result = len(compressor.compress(sample)) + len(compressor.flush()) < len(sample)
+    with _shrinks_lock:
+        _shrinks[(path, name)] = (stat.st_size, stat.st_mtime_ns, result)
+    return result
+
+def choose_for_file(accepted, path, stored=None):  #encoding to send a file in, None if compressing it does not pay
+    name = choose(accepted, stored)
+    if name is None or stored is not None or shrinks(path, name):   #a file is only stored compressed if that made it smaller
+        return name
+    return None
+
+def encoding_id(name):  #flags byte of a file message in the given encoding
+    return 0 if name is None else CODECS[name].id
+
+def encoding_name(encoding_id):  #encoding of a file message from its flags byte
+    if encoding_id == 0:
+        return None
+    codec = _BY_ID.get(encoding_id)
+    if codec is None:
+        raise ValueError(f"Unsupported encoding {encoding_id}")
+    return codec.name
+
+class Encoder:  #compress a stream, passing the compressed data to write
+    def __init__(self, name, write):
+        self.compressor = CODECS[name].compressor()
+        self.write = write
+
+    def __call__(self, data):
+        output = self.compressor.compress(data)
+        if output:
+            self.write(output)
+
+    def finish(self):
+        output = self.compressor.flush()
+        if output:
+            self.write(output)
+
+class Decoder:  #decompress a stream, passing the decompressed data to write
+    def __init__(self, name, write):
+        self.decompressor = CODECS[name].decompressor()
+        self.write = write
+
+    def __call__(self, data):
+        data = memoryview(data)
+        for start in range(0, len(data), DECODE_SLICE):
+            output = self.decompressor.decompress(data[start:start + DECODE_SLICE])
+            if output:
+                self.write(output)
+
+    def finish(self):  #raise ValueError if the compressed stream was incomplete
+        flush = getattr(self.decompressor, "flush", None)
+        if flush is not None:
+            output = flush()
+            if output:
+                self.write(output)
+        if not getattr(self.decompressor, "eof", True):
+            raise ValueError("Compressed data ended early")
+
+def transcode(blocks, source, target):  #yield blocks of data in encoding source converted to encoding target, as they are read
+    output = bytearray()
+    encoder = Encoder(target, output.extend) if target is not None else None
+    decoder = Decoder(source, encoder or output.extend) if source is not None else None
+    sink = decoder or encoder or output.extend
+    for block in blocks:
+        sink(block)
+        if len(output) >= BLOCK_SIZE:   #compressors return small pieces, they are passed on in blocks
+            yield bytes(output)
+            output.clear()
+    if decoder is not None:
+        decoder.finish()
+    if encoder is not None:
+        encoder.finish()
+    if output:
+        yield bytes(output)
+
+def decoded_etag(path, name):  #content hash of the decompressed contents of a file stored in an encoding
+    digest = hashlib.sha256()
+    decoder = Decoder(name, digest.update)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+            decoder(block)
+    decoder.finish()
+    return digest.hexdigest()
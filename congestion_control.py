@@ -0,0 +1,78 @@
+"""
+The congestion_control.py file has the timers and the congestion window used by the UDP transports.
+1. RTOEstimator computes the retransmission timeout as in RFC 6298, with exponential backoff and Karn's algorithm.
+2. AIMDWindow is the congestion window of the sr transport: slow start, additive increase, multiplicative decrease.
+The estimator of a socket is kept across transfers.
+"""
+import weakref
+
+INITIAL_RTO = 1.0   #seconds, before the first sample
+MIN_RTO = 0.2       #RFC 6298 asks for 1 second, which is far too slow on a LAN
+MAX_RTO = 10.0      #RFC 6298 allows 60 seconds, receivers give up long before that
+ALPHA = 1 / 8
+BETA = 1 / 4
+CLOCK_GRANULARITY = 0.001
+
+INITIAL_WINDOW = 4   #packets in flight at the start of a transfer
+
+_estimators = weakref.WeakKeyDictionary()   #socket -> RTOEstimator
+
+class RTOEstimator:  #retransmission timeout from smoothed round trip times (RFC 6298)
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+
+    def sample(self, rtt):  #a round trip time measured on a packet that was sent once
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.restore()
+
+    def backoff(self):  #a packet timed out, wait twice as long for the next one
+        self.rto = min(self.rto * 2, MAX_RTO)
+
+    def restore(self):  #an ACK arrived, go back to the RTO computed from the samples
+        if self.srtt is None:
+            self.rto = INITIAL_RTO
+        else:
+            self.rto = min(max(self.srtt + max(CLOCK_GRANULARITY, 4 * self.rttvar), MIN_RTO), MAX_RTO)
+
+def estimator(s):  #the RTOEstimator of a socket
+    rto = _estimators.get(s)
+    if rto is None:
+        rto = _estimators[s] = RTOEstimator()
+    return rto
+
+class AIMDWindow:  #congestion window in packets, never larger than max_window
+    def __init__(self, max_window, initial=INITIAL_WINDOW):
+        self.max_window = max_window
+        self.cwnd = float(min(initial, max_window))
+        self.ssthresh = float(max_window)
+        self.recover = -1   #losses of packets sent before this sequence number were already answered
+
+    @property
+    def size(self):
+        return max(1, min(self.max_window, int(self.cwnd)))
+
+    def on_ack(self):  #a packet was acknowledged for the first time
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1            #slow start
+        else:
+            self.cwnd += 1 / self.cwnd   #additive increase, one packet per window
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self, seq, next_seq):  #packet seq was reported missing by later ACKs, halve the window once per window
+        if seq < self.recover:
+            return
+        self.recover = next_seq
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self, next_seq):  #no ACK arrived in time, start again from one packet
+        self.recover = next_seq
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = 1.0
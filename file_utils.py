@@ -0,0 +1,83 @@
+"""
+The file_utils.py file has file helpers shared by the server, the cache and the client.
+1. Content hashes (etags) of files.
+2. Hidden temporary files that are renamed over the real file once they are complete, and reads at an offset.
+3. Parsing of byte counts given on the command line.
+4. Reading a file in chunks and receiving a file into a memory map.
+"""
+import contextlib
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+
+HASH_BUFFER_SIZE = 1024 * 1024
+_UMASK = os.umask(0)   #read once at import, while no other thread creates files
+os.umask(_UMASK)
+
+_etags = {}   #path -> (size, mtime_ns, etag), so unchanged files are not hashed again
+_etags_lock = threading.Lock()
+
+def compute_etag(path):  #content hash of a file, cached while its size and modification time stay the same
+    stat = os.stat(path)
+    with _etags_lock:
+        known = _etags.get(path)
+    if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+        return known[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BUFFER_SIZE), b""):
+            digest.update(block)
+    etag = digest.hexdigest()
+    with _etags_lock:
+        _etags[path] = (stat.st_size, stat.st_mtime_ns, etag)
+    return etag
+
+def create_temp_file(path):  #create a hidden temporary file next to path, return (file object, temporary path)
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory or ".", prefix=f".{name}.", suffix=".part")
+    if hasattr(os, "fchmod"):   #mkstemp creates the file readable by its owner only, the published file gets the usual mode
+        os.fchmod(fd, 0o666 & ~_UMASK)
+    return os.fdopen(fd, 'wb'), temp_path
+
+_seek_lock = threading.Lock()
+
+def open_for_reading(path):  #open a file descriptor for read_at
+    return os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+def read_at(fd, size, offset):  #read up to size bytes at offset of a file descriptor, without moving a position other readers rely on
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    with _seek_lock:   #e.g. Windows
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+def read_chunks(f, length, chunk_size):  #yield length bytes of an open file, chunk_size bytes at a time
+    remaining = length
+    while remaining:
+        chunk = f.read(min(remaining, chunk_size))
+        if not chunk:   #the file was truncated while it was being sent
+            raise ValueError(f"File data ended {remaining} bytes early")
+        remaining -= len(chunk)
+        yield chunk
+
+@contextlib.contextmanager
+def mapped_file(path, length):  #create path with the given length and yield a writable memory map of its contents
+    with open(path, 'w+b') as f:
+        if not length:   #an empty file can not be mapped
+            yield bytearray()
+            return
+        f.truncate(length)
+        with mmap.mmap(f.fileno(), length) as buffer:
+            yield buffer
+
+def parse_size(text):  #parse a byte count such as 4096, 512K, 100M or 2G
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def is_temp_file(name):  #whether a directory entry is a temporary file created by create_temp_file
+    return name.startswith('.') and name.endswith('.part')
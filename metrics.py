@@ -0,0 +1,249 @@
+"""
+The metrics.py file collects the numbers needed to size the cache and to find slow clients.
+1. Counter, Gauge and Histogram keep thread safe values per combination of label values.
+2. serve(port) answers GET /metrics in the Prometheus text format (--metrics-port).
+3. RequestTrace measures the phases of one request, --trace prints one line per request.
+"""
+import contextlib
+import http.server
+import threading
+import time
+
+NAMESPACE = "file_transfer"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TRACE = False   #print a trace line for every request (--trace)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:  #a metric with a value per combination of label values
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = f"{NAMESPACE}_{name}"
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}   #tuple of label values -> value
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} has the labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):  #the lines of the metric in the Prometheus text format
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+class Counter(Metric):  #a value that only goes up
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+class Gauge(Counter):  #a value that goes up and down
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    @contextlib.contextmanager
+    def track(self, **labels):  #count something as in progress while the block runs
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class GaugeFunction(Metric):  #a gauge whose value is read from a function when the metrics are rendered
+    kind = "gauge"
+
+    def __init__(self, name, help, function):
+        super().__init__(name, help)
+        self.function = function
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}",
+                f"{self.name} {_format_value(self.function())}"]
+
+class Histogram(Metric):  #distribution of observed values in cumulative buckets
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]   #bucket counts, sum, count
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted((key, [list(state[0]), state[1], state[2]]) for key, state in self.values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+class Registry:  #the metrics of a process
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):  #add a metric, a metric of the same name is replaced
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):  #all metrics in the Prometheus text format
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+def gauge(name, help, labels=()):
+    return REGISTRY.register(Gauge(name, help, labels))
+
+def gauge_function(name, help, function):
+    return REGISTRY.register(GaugeFunction(name, help, function))
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+# The metrics updated by cache, server and transports
+REQUESTS = counter("requests_total", "Requests handled, by command and result", ("command", "result"))
+CACHE_LOOKUPS = counter("cache_lookups_total", "get requests answered by the cache, by result (hit, miss, revalidated, peer)",
+                        ("result",))
+EVICTIONS = counter("cache_evictions_total", "Files evicted from the cache to stay within its budget")
+BYTES_SENT = counter("bytes_sent_total", "File bytes sent to clients, by where they came from (memory, cache, origin)",
+                     ("source",))
+BYTES_RECEIVED = counter("bytes_received_total", "File bytes received from clients and from the origin", ("source",))
+REQUEST_PHASES = histogram("request_phase_seconds", "Time spent in a phase of a request (origin, disk, send, receive, total)",
+                           ("command", "phase"))
+RETRANSMISSIONS = counter("udp_retransmissions_total", "UDP data packets sent again", ("protocol",))
+TRANSFERS_GIVEN_UP = counter("udp_transfers_given_up_total", "UDP transfers given up after too many retransmissions",
+                             ("protocol",))
+MEMORY_LOOKUPS = counter("cache_memory_lookups_total", "Cache hits looked up in the memory tier, by result (hit, miss)",
+                         ("result",))
+MEMORY_PROMOTIONS = counter("cache_memory_promotions_total", "Files copied from disk into the memory tier")
+MEMORY_DEMOTIONS = counter("cache_memory_demotions_total", "Files dropped from the memory tier to make room")
+PREFETCHES = counter("cache_prefetches_total", "Files fetched before a client asked for them, by reason (warm, co_access)",
+                     ("reason",))
+OPEN_CONNECTIONS = gauge("open_connections", "Client connections (tcp) and sessions (udp) being served", ("protocol",))
+
+COMMANDS = {"get", "peerget", "put", "putdelta", "stat", "encodings", "subscribe", "invalidate", "fin"}   #command label values, others are "other"
+
+class RequestTrace:  #phases, result and bytes of one request, recorded when the with block ends
+    def __init__(self, command, peer=None):
+        words = command.replace(":", " ").split()
+        self.command = words[0].lower() if words else ""
+        if self.command not in COMMANDS:   #untrusted input must not create new series
+            self.command = "other"
+        self.target = words[1] if len(words) > 1 else ""
+        self.peer = peer
+        self.result = "ok"
+        self.bytes = 0
+        self.phases = {}
+        self.start = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish("error" if exc_type is not None else self.result)
+
+    @contextlib.contextmanager
+    def phase(self, name):  #add the time the block takes to a phase of the request
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def sent(self, count, source):  #file bytes sent to the client, from the cache or from the origin
+        self.bytes += count or 0
+        BYTES_SENT.inc(count or 0, source=source)
+
+    def received(self, count, source="client"):
+        self.bytes += count or 0
+        BYTES_RECEIVED.inc(count or 0, source=source)
+
+    def finish(self, result):
+        total = time.perf_counter() - self.start
+        REQUESTS.inc(command=self.command, result=result)
+        for name, seconds in self.phases.items():
+            REQUEST_PHASES.observe(seconds, command=self.command, phase=name)
+        REQUEST_PHASES.observe(total, command=self.command, phase="total")
+        if TRACE:
+            phases = " ".join(f"{name}_ms={seconds * 1000:.2f}" for name, seconds in self.phases.items())
+            peer = f" peer={self.peer[0]}:{self.peer[1]}" if self.peer else ""
+            print(f"trace command={self.command} target={self.target} result={result} bytes={self.bytes} "
+                  f"{phases + ' ' if phases else ''}total_ms={total * 1000:.2f}{peer}")
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  #scrapes are not logged
+        pass
+
+def serve(port, host="localhost"):  #answer GET /metrics on a local port from a background thread, return the server
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics available on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,126 @@
+"""
+The netem_proxy.py file is a UDP proxy that makes a local link behave like a poor network.
+1. Datagrams are forwarded to the target from one socket per client address, replies are forwarded back.
+2. In both directions datagrams are dropped (--loss), duplicated (--duplicate), delayed (--delay, --jitter) and reordered (--reorder).
+Usage: python netem_proxy.py <listen_port> <target_host> <target_port> [--loss 0.05] [--delay 0.02] [--jitter 0.01]
+For example, with the server on port 8000: python netem_proxy.py 8100 localhost 8000 --loss 0.1 --delay 0.01
+and start the cache (or client) with server port 8100.
+"""
+import argparse
+import heapq
+import itertools
+import random
+import selectors
+import socket
+import time
+
+MAX_DATAGRAM = 65535   #largest UDP payload
+
+class Impairment:  #what happens to the datagrams that pass the proxy
+    def __init__(self, loss=0.0, delay=0.0, jitter=0.0, duplicate=0.0, reorder=0.0, seed=None):
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.random = random.Random(seed)
+
+    def deliveries(self):  #delays after which a datagram is delivered, empty if it is lost
+        if self.random.random() < self.loss:
+            return []
+        copies = 2 if self.random.random() < self.duplicate else 1
+        delays = []
+        for _ in range(copies):
+            delay = self.delay + self.random.uniform(0, self.jitter)
+            if self.random.random() < self.reorder:
+                delay += self.delay or 0.01   #held back behind the datagrams that follow it
+            delays.append(delay)
+        return delays
+
+class NetemProxy:  #forward datagrams between clients and a target through an Impairment
+    def __init__(self, listen_port, target, impairment, host="0.0.0.0"):
+        self.target = (socket.gethostbyname(target[0]), target[1])
+        self.impairment = impairment
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind((host, listen_port))
+        self.upstreams = {}   #client address -> socket connected to the target
+        self.clients = {}     #upstream socket -> client address
+        self.queue = []       #(due time, counter, socket, data, address) of delayed datagrams
+        self.counter = itertools.count()
+        self.stats = {"forwarded": 0, "dropped": 0, "duplicated": 0}
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.running = True
+
+    def serve_forever(self):  #forward datagrams until interrupted or shut down
+        try:
+            while self.running:
+                timeout = min(max(self.queue[0][0] - time.monotonic(), 0), 1) if self.queue else 1
+                for key, _ in self.selector.select(timeout):
+                    data, address = key.fileobj.recvfrom(MAX_DATAGRAM)
+                    if key.fileobj is self.listener:   #from a client to the target
+                        self.schedule(self._upstream(address), data, self.target)
+                    else:                              #from the target back to its client
+                        self.schedule(self.listener, data, self.clients[key.fileobj])
+                self.flush()
+        finally:
+            for sock in self.clients:
+                sock.close()
+            self.listener.close()
+            self.selector.close()
+
+    def shutdown(self):  #stop serve_forever running in another thread, within a second
+        self.running = False
+
+    def schedule(self, sock, data, address):  #queue a datagram for delivery according to the impairment
+        delays = self.impairment.deliveries()
+        if not delays:
+            self.stats["dropped"] += 1
+        self.stats["duplicated"] += max(len(delays) - 1, 0)
+        now = time.monotonic()
+        for delay in delays:
+            heapq.heappush(self.queue, (now + delay, next(self.counter), sock, data, address))
+
+    def flush(self):  #send every datagram that is due
+        now = time.monotonic()
+        while self.queue and self.queue[0][0] <= now:
+            _, _, sock, data, address = heapq.heappop(self.queue)
+            try:
+                sock.sendto(data, address)
+                self.stats["forwarded"] += 1
+            except OSError:   #e.g. the client is gone, like a lost datagram
+                self.stats["dropped"] += 1
+
+    def _upstream(self, client):  #the socket that forwards the datagrams of a client
+        sock = self.upstreams.get(client)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("", 0))
+            self.upstreams[client] = sock
+            self.clients[sock] = client
+            self.selector.register(sock, selectors.EVENT_READ)
+        return sock
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP proxy that drops, delays, duplicates and reorders datagrams")
+    parser.add_argument("listen_port", type=int)
+    parser.add_argument("target_host")
+    parser.add_argument("target_port", type=int)
+    parser.add_argument("--loss", type=float, default=0.0, help="probability that a datagram is dropped")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds every datagram is delayed")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra delay of up to this many seconds")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="probability that a datagram is delivered twice")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probability that a datagram is held back behind later ones")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the random choices, to repeat a run")
+    args = parser.parse_args()
+
+    impairment = Impairment(args.loss, args.delay, args.jitter, args.duplicate, args.reorder, args.seed)
+    proxy = NetemProxy(args.listen_port, (args.target_host, args.target_port), impairment)
+    print(f"Proxy on port {args.listen_port} forwarding to {args.target_host}:{args.target_port}")
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        print("Proxy stopped:", ", ".join(f"{count} {name}" for name, count in proxy.stats.items()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+The prefetch.py file lets the cache fetch files from the server before clients ask for them.
+1. AccessLog appends the gets of the clients to .access_log in a writer thread, keeping the last MAX_RECORDS.
+2. The log ranks the hottest files and learns which file clients usually get after another one (co-access).
+3. Prefetcher fetches the hottest files on startup and the predicted ones later, at the rate of a TokenBucket.
+"""
+import collections
+import os
+import queue
+import threading
+import time
+
+import metrics
+
+ACCESS_LOG = ".access_log"   #lines of '<time> <client> <filename>' in the cache directory
+MAX_RECORDS = 100000         #gets kept in the log
+CO_ACCESS_WINDOW = 10        #seconds within which a get counts as following the previous get of the same client
+MIN_SUPPORT = 3              #times b has to follow a before a get of a prefetches b
+MIN_CONFIDENCE = 0.3         #share of the gets of a that have to be followed by b
+MAX_RULES = 3                #files prefetched after a get
+MAX_QUEUED = 1000            #prefetches waiting for the background thread
+FLUSH_INTERVAL = 1           #seconds between two writes of the buffered gets to the log
+
+class _History:  #counts and co-access rules learned from a sequence of gets
+    def __init__(self, records=()):
+        self.counts = collections.Counter()    #filename -> gets
+        self.follows = collections.defaultdict(collections.Counter)   #filename -> files that followed it -> times
+        self.last = {}   #client -> (time, filename) of its previous get
+        for when, client, filename in records:
+            self.learn(when, client, filename)
+
+    def learn(self, when, client, filename):
+        self.counts[filename] += 1
+        previous = self.last.get(client)
+        if previous is not None and previous[1] != filename and when - previous[0] <= CO_ACCESS_WINDOW:
+            self.follows[previous[1]][filename] += 1
+        self.last[client] = (when, filename)
+
+    def rules(self, filename):
+        gets = self.counts[filename]
+        return [follower for follower, times in self.follows[filename].most_common(MAX_RULES)
+                if times >= MIN_SUPPORT and times >= MIN_CONFIDENCE * gets]
+
+class AccessLog:  #persistent history of the gets of the clients, ranks files and learns co-access rules
+    def __init__(self, cache_dir, max_records=MAX_RECORDS):
+        self.path = os.path.join(cache_dir, ACCESS_LOG)
+        self.max_records = max_records
+        self.lock = threading.Lock()
+        records = self._read()
+        self.history = _History(records)
+        self.pending = []   #(time, client, filename) of the gets that are not written to the log yet
+        self.lines = len(records)   #gets in the log file, only used by the writer thread
+        self.file = open(self.path, 'a')
+        self.closed = threading.Event()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def record(self, filename, client):  #log a get of a client, return the files the co-access rules predict next
+        now = time.time()
+        client = f"{client[0]}:{client[1]}" if isinstance(client, tuple) else str(client or "-")
+        with self.lock:
+            self.pending.append((now, client, filename))   #written by the writer thread
+            self.history.learn(now, client, filename)
+            return self.history.rules(filename)
+
+    def hottest(self, n):  #the n files that were requested most often
+        with self.lock:
+            return [filename for filename, _ in self.history.counts.most_common(n)]
+
+    def rules(self, filename):  #the files that usually follow a get of filename
+        with self.lock:
+            return self.history.rules(filename)
+
+    def close(self):  #write the buffered gets and stop the writer thread
+        self.closed.set()
+        self.writer.join()
+
+    def _write_loop(self):
+        while not self.closed.wait(FLUSH_INTERVAL):
+            self._write()
+        self._write()
+        self.file.close()
+
+    def _write(self):  #append the buffered gets to the log, compact it when it has grown past max_records
+        with self.lock:
+            records, self.pending = self.pending, []
+        if not records:
+            return
+        try:
+            self.file.writelines(f"{when:.3f} {client} {filename}\n" for when, client, filename in records)
+            self.file.flush()
+            self.lines += len(records)
+            if self.lines > self.max_records:
+                self._compact()
+        except OSError as e:   #the gets stay in the counts and rules, only the history on disk misses them
+            print(f"Error while writing the access log: {e}")
+
+    def _read(self):  #(time, client, filename) of the logged gets, oldest first
+        records = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split(" ", 2)
+                    if len(fields) != 3:   #torn by a crash while it was written
+                        continue
+                    try:
+                        records.append((float(fields[0]), fields[1], fields[2]))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _compact(self):  #keep the newer half of the log, the counts and rules are rebuilt from it outside the lock
+        self.file.close()
+        records = self._read()[-(self.max_records // 2):]
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            f.writelines(f"{when:.3f} {client} {filename}\n" for when, client, filename in records)
+        os.replace(temp_path, self.path)
+        self.file = open(self.path, 'a')
+        self.lines = len(records)
+        history = _History(records)
+        with self.lock:
+            for record in self.pending:   #gets that arrived while the log was compacted
+                history.learn(*record)
+            self.history = history
+
+class TokenBucket:  #limits a byte rate, with bursts of up to one second of it
+    def __init__(self, rate):
+        self.rate = rate   #bytes per second
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, count):  #wait until count bytes may pass
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - count
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class Prefetcher:  #fetches predicted and hot files in a background thread
+    def __init__(self, log, fetch, is_cached, rate):
+        self.log = log
+        self.fetch = fetch   #fetch(filename, reason, bucket) fetches a file, reading its data at the rate of bucket
+        self.is_cached = is_cached
+        self.bucket = TokenBucket(rate)
+        self.queue = queue.Queue(MAX_QUEUED)
+        self.queued = set()
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def accessed(self, filename, client):  #a client got filename, prefetch what usually follows it
+        for follower in self.log.record(filename, client):
+            self.request(follower, "co_access")
+
+    def warm(self, n):  #prefetch the n hottest files of the access log
+        hottest = self.log.hottest(n)
+        if hottest:
+            print(f"Warming up the cache with the {len(hottest)} most requested files")
+        for filename in hottest:
+            self.request(filename, "warm")
+
+    def request(self, filename, reason):  #queue a prefetch unless the file is cached or already queued
+        with self.lock:
+            if filename in self.queued or self.is_cached(filename):
+                return
+            try:
+                self.queue.put_nowait((filename, reason))
+            except queue.Full:   #prefetching is behind, predictions are dropped rather than delayed
+                return
+            self.queued.add(filename)
+
+    def _run(self):
+        while True:
+            filename, reason = self.queue.get()
+            try:
+                if not self.is_cached(filename) and self.fetch(filename, reason, self.bucket):
+                    metrics.PREFETCHES.inc(reason=reason)
+            except Exception as e:
+                print(f"Error while prefetching {filename}: {e}")
+            finally:
+                with self.lock:
+                    self.queued.discard(filename)
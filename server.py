@@ -8,128 +8,378 @@ The following information gives a simple breakdown structure of the server side
    (b) Invoke relavant blocks of code based on the protocol input
 4. TCP protocol Handling:
    (a) put functionality in handle_client method receives the file from client
-   (b) get  functionality in handle_client method will sned file to cache
+   (b) get  functionality in handle_client method will sned file to cache, get <file> <offset> <length> sends a range of it
    (c) quit command will exit the program
+   (d) connections are served serially or from a bounded thread pool (--concurrency)
+   (e) connections are persistent until the client closes them or they are idle for --idle-timeout
 5. UDP protocol Handling
    (a) PUT method recieves the file from client in chunks on 1000 bytes
    (b) GET method will send file to cache in chunks of 1000 bytes
+   (c) chunks are sent with stop and wait (snw) or with a sliding window of --window chunks (sr)
+   (d) datagrams are dispatched by client address to sessions, so up to --max-connections clients are served at once
+6. Freshness of cached copies:
+   (a) stat returns the size, modification time and etag (content hash) of a file without sending it
+   (b) get with the etag of a cached copy answers NotModified if the file did not change
+   (c) caches can subscribe to the server, they are told to invalidate a file whenever a client puts it
+7. Compression (TCP):
+   (a) get with accept=<encodings> sends the file compressed with the first of them the server supports
+   (b) put accepts compressed files, encodings lists the compressions the server supports
+8. Delta transfers (TCP):
+   (a) putdelta receives the chunk manifest of a file, asks for the chunks the server does not have and assembles the file
+   (b) get with delta=1 sends the manifest of a changed file and then only the chunks the cache asks for
+9. Metrics (metrics.py):
+   (a) requests, bytes and the time spent on disk, sending and receiving are served on --metrics-port
+   (b) --trace prints one line per command with its phases, result and bytes
 """
 
 
 
 import sys
+import argparse
 sys.path.append("..")
+import file_utils                       #file_utils file has the etag and temporary file helpers
+import chunk_store                      #chunk_store file has the content-defined chunking used for delta transfers
+import compression_utils                #compression_utils file has the compression used on the wire
 import tcp_transport                    #tcp_transport file is the library consisting the tcp related functions
-import snw_transport as udp_transport  #snw_transport file is the library consisting the snw related functions
+import udp_dispatcher                  #udp_dispatcher file serves many UDP clients at once on one socket
+import snw_transport                   #snw_transport file is the library consisting the snw related functions
+import sr_transport                    #sr_transport file is the library consisting the selective repeat related functions
+import metrics                         #metrics file has the counters and request traces exposed on --metrics-port
 import os
 import socket
+import threading
+
+UDP_TRANSPORTS = {"snw": snw_transport, "sr": sr_transport}   #reliable UDP transports selectable by the protocol argument
 
 SERVER_FILES_DIR = "server_files" #The folder to which server stores the downloaded files/Uploads the files from this folder to the client or cache.
 
 # Ensure the server_files directory exists
 if not os.path.exists(SERVER_FILES_DIR):
     os.makedirs(SERVER_FILES_DIR)
-# This function handles the tcp client or cache request either put or get.
+chunks = chunk_store.ChunkStore(SERVER_FILES_DIR)   #manifests and chunk index of the server files, for delta transfers
+subscribers = set()   #addresses of the caches that want to be told when a file changes
+subscribers_lock = threading.Lock()
+
+def file_stat(filepath):  #metadata of a file as sent in reply to stat: Stat:<size>:<mtime_ns>:<etag>
+    stat = os.stat(filepath)
+    return f"Stat:{stat.st_size}:{stat.st_mtime_ns}:{file_utils.compute_etag(filepath)}"
+
+def notify_subscribers(notify, filename):  #tell every subscribed cache that filename changed
+    with subscribers_lock:
+        addresses = list(subscribers)
+    for address in addresses:
+        try:
+            notify(address, filename)
+        except OSError as e:   #the cache went away, stop telling it
+            print(f"Could not notify cache {address[0]}:{address[1]}: {e}")
+            with subscribers_lock:
+                subscribers.discard(address)
+
+def notify_tcp(address, filename):  #send an invalidate command to a cache over TCP
+    cache_socket = tcp_transport.create_tcp_socket()
+    try:
+        cache_socket.settimeout(5)
+        tcp_transport.connect_to_host(cache_socket, *address)
+        tcp_transport.send_data(cache_socket, f"invalidate {filename}")
+    finally:
+        tcp_transport.close_connection(cache_socket)
+
+IDLE_TIMEOUT = 30   #seconds a persistent connection may wait for its next command (--idle-timeout)
+
+# This function serves the next command of a tcp client or cache connection, False if the connection has to be closed.
 def handle_client(client_socket):
     try:
         command = tcp_transport.receive_data(client_socket)
-        #If the encountered command is put, receive and save file from the client
-        if command.startswith('put'):
-            filename = command.split(' ')[1]
-            filepath = os.path.join(SERVER_FILES_DIR, filename)
-            tcp_transport.receive_file(client_socket, filepath)
-            print(f"Received and saved {filename}")
-            tcp_transport.send_data(client_socket, "Server response: File successfully uploaded")
-
-        #If the encountered command is get, then send file or respond with relavant messages based on the availibility of file at the server
-        elif command.startswith('get'):
-            filename = command.split(' ')[1]
-            filepath = os.path.join(SERVER_FILES_DIR, filename)
-
-            if os.path.exists(filepath):
-                tcp_transport.send_data(client_socket, "File delivered from origin")
-                tcp_transport.send_file(client_socket, filepath)
-            
-            else:
-                tcp_transport.send_data(client_socket, "FileNotFound")
-
+        if not command:   #the client closed the connection
+            return False
+        return handle_command(client_socket, command, client_socket.getpeername())
+    except socket.timeout:
+        print("Client stopped sending in the middle of a command")
     except Exception as e:
         print(f"Error while handling client: {e}")
-    finally:  #close the connection after handlding the request
-        tcp_transport.close_connection(client_socket)
+    return False
+
+# This function handles one command and records its metrics, returns False if the connection can not be used any more.
+def handle_command(client_socket, command, peer=None):
+    with metrics.RequestTrace(command, peer) as trace:
+        usable = serve_command(client_socket, command, trace)
+        if not usable:
+            trace.result = "error"
+        return usable
+
+def serve_command(client_socket, command, trace):
+    words, options = tcp_transport.parse_command(command)
+    #If the encountered command is putdelta, receive the chunks of the file that the server does not have yet
+    if command.startswith('putdelta'):
+        return receive_file_delta(client_socket, words[1], trace)
+
+    #If the encountered command is put, receive and save file from the client
+    elif command.startswith('put'):
+        filename = words[1]
+        filepath = os.path.join(SERVER_FILES_DIR, filename)
+        f, temp_path = file_utils.create_temp_file(filepath)   #readers keep seeing the old file until the upload is complete
+        f.close()
+        try:
+            with trace.phase("receive"):
+                received = tcp_transport.receive_file(client_socket, temp_path)
+        except BaseException:   #timeout, reset or damaged compressed data, keep the old file
+            os.remove(temp_path)
+            raise
+        if not received:
+            os.remove(temp_path)
+            return False
+        trace.received(os.path.getsize(temp_path))
+        os.replace(temp_path, filepath)
+        print(f"Received and saved {filename}")
+        tcp_transport.send_data(client_socket, "Server response: File successfully uploaded")
+        notify_subscribers(notify_tcp, filename)
+
+    #If the encountered command is get, then send file or respond with relavant messages based on the availibility of file at the server
+    elif command.startswith('get'):
+        filename = words[1]
+        filepath = os.path.join(SERVER_FILES_DIR, filename)
+
+        with trace.phase("disk"):
+            exists = os.path.exists(filepath)
+            etag = options.get('etag')   #only conditional gets hash the file
+            unchanged = exists and len(words) <= 3 and etag is not None and etag == file_utils.compute_etag(filepath)
+        if not exists:
+            trace.result = "not_found"
+            tcp_transport.send_data(client_socket, "FileNotFound")
+        elif len(words) > 3:   #ranged get: get <file> <offset> <length> [match=<etag>]
+            send_file_range(client_socket, filepath, int(words[2]), int(words[3]), options.get('match'), trace)
+        elif unchanged:   #the cached copy is still up to date
+            trace.result = "not_modified"
+            tcp_transport.send_data(client_socket, "NotModified")
+        elif options.get('delta'):   #the cache has an older copy, send only the chunks it lacks
+            send_file_delta(client_socket, words[1], filepath, trace)
+        else:   #compressed if the receiver accepts an encoding the server supports
+            with trace.phase("send"):
+                tcp_transport.send_data(client_socket, "File delivered from origin")
+                trace.sent(tcp_transport.send_file(client_socket, filepath, compression_utils.choose_for_file(options.get('accept'), filepath)), "origin")
+
+    #If the encountered command is stat, send the metadata of the file
+    elif command.startswith('stat'):
+        filepath = os.path.join(SERVER_FILES_DIR, words[1])
+        tcp_transport.send_data(client_socket, file_stat(filepath) if os.path.exists(filepath) else "FileNotFound")
+
+    #If the encountered command is encodings, list the compressions the server can receive
+    elif command.startswith('encodings'):
+        tcp_transport.send_data(client_socket, "Encodings:" + ",".join(compression_utils.available()))
+
+    #If the encountered command is subscribe, remember the cache listening on the given port
+    elif command.startswith('subscribe'):
+        with subscribers_lock:
+            subscribers.add((client_socket.getpeername()[0], int(words[1])))
+        tcp_transport.send_data(client_socket, "Subscribed")
+
+    else:
+        trace.result = "invalid"
+        tcp_transport.send_data(client_socket, "InvalidCommand")
+    return True
+# This function receives a file uploaded with putdelta, returns False if the connection can not be used any more.
+def receive_file_delta(client_socket, filename, trace):
+    filepath = os.path.join(SERVER_FILES_DIR, filename)
+    manifest = chunk_store.parse_manifest(tcp_transport.receive_data(client_socket, chunk_store.MAX_MANIFEST))
+    if os.path.exists(filepath):
+        chunks.manifest(filename)   #index the chunks of the current version, they are not sent again
+    missing = chunk_store.missing_digests(manifest, chunks.has)
+    tcp_transport.send_data(client_socket, " ".join(["Missing"] + missing))
+
+    sizes = dict(manifest)
+    length = tcp_transport.receive_file_length(client_socket)
+    if length is None:
+        return False
+    if length != sum(sizes[digest] for digest in missing):
+        raise ConnectionError(f"Expected the missing chunks, got {length} bytes")
+    f, temp_path = file_utils.create_temp_file(filepath)   #readers keep seeing the old file until the upload is complete
+    try:
+        with f, trace.phase("receive"):
+            chunk_store.assemble(manifest, missing, chunks.read_chunk,
+                                 lambda size: tcp_transport.receive_bytes(client_socket, size), f.write)
+        chunks.record(filename, os.stat(temp_path), manifest)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    trace.received(length)
+    os.replace(temp_path, filepath)
+    print(f"Received and saved {filename} ({length} of {sum(size for _, size in manifest)} bytes transferred)")
+    tcp_transport.send_data(client_socket, "Server response: File successfully uploaded")
+    notify_subscribers(notify_tcp, filename)
+    return True
+
+# This function sends length bytes of a file from offset, unless the file no longer has the etag the client expects.
+def send_file_range(client_socket, filepath, offset, length, match, trace):
+    with open(filepath, 'rb') as f:
+        if match is not None and match != file_utils.compute_etag(filepath):
+            trace.result = "changed"
+            tcp_transport.send_data(client_socket, "Changed")
+            return
+        size = os.fstat(f.fileno()).st_size
+        offset = min(offset, size)
+        with trace.phase("send"):
+            tcp_transport.send_data(client_socket, "File delivered from origin")
+            trace.sent(tcp_transport.send_file_ranges(client_socket, f, [(offset, max(0, min(length, size - offset)))]), "origin")
+
+# This function sends the manifest of a file and then the chunks the cache asks for.
+def send_file_delta(client_socket, filename, filepath, trace):
+    with open(filepath, 'rb') as f:
+        with trace.phase("disk"):
+            manifest = chunks.manifest(filename, f)
+        tcp_transport.send_data(client_socket, "Manifest")
+        tcp_transport.send_data(client_socket, chunk_store.format_manifest(manifest))
+        missing = set(tcp_transport.receive_data(client_socket, chunk_store.MAX_MANIFEST).split()[1:])   #Missing <digest> ...
+        ranges, offset = [], 0
+        for digest, size in manifest:   #in the order the receiver assembles the file
+            if digest in missing:
+                ranges.append((offset, size))
+                missing.discard(digest)
+            offset += size
+        with trace.phase("send"):
+            trace.sent(tcp_transport.send_file_ranges(client_socket, f, ranges), "origin")
+
+# This function serves the next command of a UDP client (a session of the dispatcher) if one arrived, without waiting.
+def handle_udp_session(udp_transport, session):
+    session.settimeout(0)   #only datagrams that already arrived, the transports change the timeout during transfers
+    try:
+        command, client_address = udp_transport.receive_data(session)
+    except socket.timeout:   #a late packet of a finished transfer, not a command
+        return
+    session.settimeout(udp_transport.TIMEOUT)   #the rest of the command (FIN) may still be on its way
+    with metrics.RequestTrace(command, client_address) as trace:
+        handle_udp_command(udp_transport, session, command, client_address, trace)
+
+# This function handles one PUT, GET, STAT or SUBSCRIBE command of a UDP client.
+def handle_udp_command(udp_transport, session, command, client_address, trace):
+    if command.startswith('PUT:'):   #If the method is PUT, Receive and save files from client
+        _, filename, length = command.split(':')   #PUT:<filename>:<length>
+        filepath = os.path.join(SERVER_FILES_DIR, filename)
+
+        f, temp_path = file_utils.create_temp_file(filepath)
+        f.close()
+        udp_transport.send_data(session, "Ready", client_address)
+        try:
+            with trace.phase("receive"):
+                udp_transport.receive_file_to(session, temp_path, int(length))   #written straight into the file
+        except BaseException:   #the upload broke off, keep the old file
+            os.remove(temp_path)
+            raise
+        trace.received(int(length))
+        os.replace(temp_path, filepath)
+        print(f"Received and saved {filepath}")
+        notify_subscribers(lambda address, name: udp_transport.send_data(session, f"INVALIDATE:{name}", address),
+                           filename)
+        fin_message, _ = udp_transport.receive_data(session)
+        if fin_message == "FIN":
+            udp_transport.send_data(session, "Message:File Successfully uploaded", client_address)
+
+    elif command.startswith('GET:'):  #If the method is GET, send the file or respond with error message if file not found
+        parts = command.split(':')   #GET:<filename> or GET:<filename>:<etag of the cached copy>
+        filename = parts[1]
+        filepath = os.path.join(SERVER_FILES_DIR, filename)
+
+        with trace.phase("disk"):
+            exists = os.path.exists(filepath)
+            unchanged = exists and len(parts) > 2 and parts[2] == file_utils.compute_etag(filepath)
+        if unchanged:
+            trace.result = "not_modified"
+            udp_transport.send_data(session, "NotModified", client_address)
+
+        elif exists:
+            with trace.phase("send"), open(filepath, 'rb') as f:   #the file is read one chunk at a time while it is sent
+                length = os.fstat(f.fileno()).st_size
+                udp_transport.send_data(session, f"LEN:{length}", client_address)
+                udp_transport.send_from_file(session, f, length, client_address)
+                trace.sent(length, "origin")
+            fin_message, _ = udp_transport.receive_data(session)
+            if fin_message == "FIN":
+                print("File sent to cache completed successfully.")
+                udp_transport.send_data(session, "Message:File delivered from server", client_address)
+
+        else:
+            trace.result = "not_found"
+            udp_transport.send_data(session, "FileNotFound", client_address)
+
+    elif command.startswith('STAT:'):  #If the method is STAT, send the metadata of the file
+        filepath = os.path.join(SERVER_FILES_DIR, command.split(':')[1])
+        udp_transport.send_data(session, file_stat(filepath) if os.path.exists(filepath) else "FileNotFound",
+                                client_address)
+
+    elif command.startswith('SUBSCRIBE'):  #If the method is SUBSCRIBE, remember the cache that sent it
+        with subscribers_lock:
+            subscribers.add(client_address)
+
+    elif command == 'FIN':  #the FIN of a transfer that arrived after the handler stopped waiting for it
+        udp_transport.send_data(session, "Message:Transfer finished", client_address)
 #The main function will start the server and invoke the functions based on clients arguments in command
+def parse_args():
+    parser = argparse.ArgumentParser(usage="python server.py <PORT> <PROTOCOL> [options]")
+    parser.add_argument("port", type=int)
+    parser.add_argument("protocol", choices=["tcp", "snw", "sr"])
+    parser.add_argument("--concurrency", choices=tcp_transport.SERVING_MODES, default="thread",
+                        help="how TCP connections are served (default: thread)")
+    parser.add_argument("--max-connections", type=int, default=64,
+                        help="maximum number of TCP commands or UDP sessions handled at once, idle connections do not count (default: 64)")
+    parser.add_argument("--max-open-connections", type=int, default=None,
+                        help="maximum number of TCP connections kept open, idle ones included (default: 1024, less with a low file descriptor limit)")
+    parser.add_argument("--window", type=int, default=sr_transport.WINDOW_SIZE,
+                        help="packets in flight for the sr protocol (default: %(default)s)")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds an idle TCP connection is kept open (default: %(default)s)")
+    parser.add_argument("--buffer-size", type=file_utils.parse_size, default=tcp_transport.BUFFER_SIZE,
+                        help="TCP read/receive buffer size, e.g. 1M (default: %(default)s)")
+    parser.add_argument("--no-sendfile", action="store_true",
+                        help="send TCP file data from a Python buffer instead of with os.sendfile")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve metrics in the Prometheus format on http://localhost:<port>/metrics")
+    parser.add_argument("--trace", action="store_true",
+                        help="print the phases, result and bytes of every command")
+    return parser.parse_args()
+
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python tcp_snw_server.py <PORT> <PROTOCOL>")
-        sys.exit(1)
+    global IDLE_TIMEOUT
+    args = parse_args()
 
     HOST = 'localhost'
-    PORT = int(sys.argv[1])
-    PROTOCOL = sys.argv[2]
+    PORT = args.port
+    PROTOCOL = args.protocol
+    sr_transport.WINDOW_SIZE = args.window
+    tcp_transport.BUFFER_SIZE = args.buffer_size
+    IDLE_TIMEOUT = args.idle_timeout
+    tcp_transport.USE_SENDFILE = tcp_transport.USE_SENDFILE and not args.no_sendfile
+    metrics.TRACE = args.trace
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
 #If the protocol invoked is TCP, handle it using necessary functions
     if PROTOCOL == "tcp":
         server_socket_tcp = tcp_transport.create_tcp_socket()
         tcp_transport.bind_and_listen(server_socket_tcp, HOST, PORT)
         print(f"Server listening on {HOST}:{PORT}")
 
-        try:
-            while True:  #Accept the client connection and handle the requests
-                client_socket, _ = server_socket_tcp.accept()
-                print("Client connected")
-                handle_client(client_socket)
+        try:  #Accept the client connections and handle the requests
+            tcp_transport.serve_connections(server_socket_tcp, handle_client, args.concurrency, args.max_connections, IDLE_TIMEOUT,
+                                            args.max_open_connections)
         except KeyboardInterrupt:
             print("Server shutting down...")  #shutdown the server using the keypad interupts
         finally:
             tcp_transport.close_connection(server_socket_tcp)  #close the server sockets
             print("Server shut down")
 
-    else: #PROTOCOL=SNW    #Handle the UDP protocol along with stop and wait mechanisms
+    else: #PROTOCOL=SNW or SR    #Handle the UDP protocol along with stop and wait or selective repeat mechanisms
+        udp_transport = UDP_TRANSPORTS[PROTOCOL]
         server_socket_udp = udp_transport.create_udp_socket()
         udp_transport.bind_socket(server_socket_udp, HOST, PORT)
         print(f"Server listening on {HOST}:{PORT}")
 
-        printed_timeout = False
-
-        while True:
-            try:   #receive command from client
-                command, client_address = udp_transport.receive_data(server_socket_udp)
-                printed_timeout = False
-
-                if command.startswith('PUT:'):   #If the method is PUT, Receive and save files from client
-                    filename = command.split(':')[1]
-                    filepath = os.path.join(SERVER_FILES_DIR, filename)
-
-                    length_info, _ = udp_transport.receive_data(server_socket_udp)
-                    if length_info.startswith("LEN:"):
-                        _, length = length_info.split(":")
-                        file_data = udp_transport.receive_file(server_socket_udp, int(length))
-                        with open(filepath, 'wb') as f:
-                            f.write(file_data)
-                        print(f"Received and saved {filepath}")
-                        udp_transport.send_fin(server_socket_udp, client_address)
-                        udp_transport.send_data(server_socket_udp, "Message:File Successfully uploaded", client_address)
-
-                elif command.startswith('GET:'):  #If the method is GET, send the file or respond with error message if file not found
-                    filename = command.split(':')[1]
-                    filepath = os.path.join(SERVER_FILES_DIR, filename)
-
-                    if os.path.exists(filepath):
-                        with open(filepath, 'rb') as f:
-                            file_data = f.read()
-                        udp_transport.send_data(server_socket_udp, f"LEN:{len(file_data)}", client_address)
-                        udp_transport.send_file(server_socket_udp, file_data, client_address)
-                        fin_message, _ = udp_transport.receive_data(server_socket_udp)
-                        if fin_message == "FIN":
-                            print("File sent to cache completed successfully.")
-
-                    else:
-                        udp_transport.send_data(server_socket_udp, "FileNotFound", client_address)
-
-            except socket.timeout:    #Print time out message once until next packet arrives
-                if not printed_timeout:
-                    print("Socket timed out, waiting for another packet.")
-                    printed_timeout = True
-                continue
+        dispatcher = udp_dispatcher.UDPDispatcher(server_socket_udp, lambda session: handle_udp_session(udp_transport, session),
+                                                  args.max_connections)
+        try:  #serve every client in its own session
+            dispatcher.serve_forever()
+        except KeyboardInterrupt:
+            print("Server shutting down...")
+        finally:
+            server_socket_udp.close()
+            print("Server shut down")
 #Execute main function when server.py runs
 if __name__ == "__main__":
     main()
\ No newline at end of file
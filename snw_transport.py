@@ -4,8 +4,33 @@ The file consists functions to create sockets, bind sockets, send and receive da
 1000 byte chunks in UDP.
 These mechanisms invlove sending and receiving of ACKS in order to ensure reception of chunks
 This file also has timeout mechanisms to detect potential data loss
+Files are sent from an open file and received into a buffer or a memory-mapped file, one chunk at a time.
+The ACK timeout adapts to the round trip time (congestion_control.py), control messages are retransmitted (udp_control.py).
 """
+import random
 import socket
+import struct
+import time
+import weakref
+from collections import deque
+
+import congestion_control
+import file_utils
+import metrics
+import udp_control
+
+CHUNK_SIZE = 1000   #payload bytes per data packet
+TIMEOUT = 1         #seconds the socket is left waiting for control messages
+MAX_RETRIES = 10    #retransmissions of one chunk before the transfer is given up
+IDLE_TIMEOUT = 60   #seconds a receiver waits for the next chunk, longer than a sender retransmits
+
+DATA = 0xD4   #type byte of a data packet
+ACK = 0xA4    #type byte of an acknowledgement
+DATA_HEADER = struct.Struct("!BIB")   #type, transfer id, sequence bit
+ACK_PACKET = struct.Struct("!BIB")    #type, transfer id, sequence bit
+MAX_DATAGRAM = DATA_HEADER.size + CHUNK_SIZE
+
+_finished = weakref.WeakKeyDictionary()  #ids of transfers a socket already received, their late retransmissions are only acknowledged
 
 def create_udp_socket(): #create and return a new udp socket
     return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -13,40 +38,136 @@ def create_udp_socket(): #create and return a new udp socket
 def bind_socket(s, host, port):  #bind the socket to the host and port
     s.bind((host, port))
 
-def send_data(s, data, address):  #Send the data to address specified
-    s.sendto(data.encode(), address)
+def send_data(s, data, address):  #Send the data to address specified, as the reply to its last request or as a notice
+    udp_control.send(s, data, address)
+
+def request(s, data, address, timeout=None):  #send a request until it is answered and return the reply and the sender's address
+    return udp_control.request(s, data, address, MAX_DATAGRAM, _late_packet, "snw", timeout)
 
-def receive_data(s, buffer_size=1024): #receive data form socket and return data to sender's address
-    data, addr = s.recvfrom(buffer_size)
-    return data.decode(), addr
+def receive_data(s, buffer_size=1024): #receive the next request or notice form socket and return data to sender's address
+    return udp_control.receive(s, max(buffer_size, MAX_DATAGRAM), _late_packet)
 
-def send_fin(s, address):  #send FIN message as an indication of the end of transmission
-    send_data(s, "FIN", address)
+def _late_packet(s, packet, address):  #a data packet outside of a transfer
+    if packet[0] == DATA:   #retransmission of a chunk whose ACK was lost, late ACKs are dropped
+        _ack_finished(s, packet, address)
+
+def _send_ack(s, transfer_id, bit, address):
+    s.sendto(ACK_PACKET.pack(ACK, transfer_id, bit), address)
+
+def _ack_finished(s, packet, address):  #acknowledge a late chunk of a received transfer again
+    transfer_id, bit = DATA_HEADER.unpack_from(packet)[1:]
+    if transfer_id in _finished.get(s, ()):   #chunks of a transfer not received yet arrived early, the sender repeats them
+        _send_ack(s, transfer_id, bit, address)
+
+def send_fin(s, address):  #send FIN message as an indication of the end of transmission, return the reply
+    return request(s, "FIN", address)
 
 def send_file(s, file_data, address): #send file data in chunks of 1000 bytes to the address specified
-    length = len(file_data)
-    chunks = [file_data[i:i+1000] for i in range(0, length, 1000)]
-    for chunk in chunks:
-        while True:
-            s.sendto(chunk, address)  #send a chunk of data
-            s.settimeout(1)   #set a timeout to wait for an ACK
-            try:
-                ack, _ = receive_data(s)
-                if ack == "ACK":
-                    break  #if ACK is received break the loop
-            except socket.timeout:  #if timeout occurs print error message
-                print("Did not receive ACK. Terminating.")
-                exit()
+    view = memoryview(file_data)   #slices of a memoryview do not copy the data
+    send_stream(s, (view[i:i+CHUNK_SIZE] for i in range(0, len(view), CHUNK_SIZE)), address)
+
+def send_from_file(s, f, length, address):  #send length bytes of an open file, reading one chunk at a time
+    send_stream(s, file_utils.read_chunks(f, length, CHUNK_SIZE), address)
+
+def send_stream(s, chunks, address):  #send chunks of at most 1000 bytes as they are produced, waiting for an ACK after each
+    rto = congestion_control.estimator(s)
+    transfer_id = random.getrandbits(32)
+    bit = 0
+    try:
+        for chunk in chunks:
+            packet = DATA_HEADER.pack(DATA, transfer_id, bit) + chunk
+            s.sendto(packet, address)  #send a chunk of data
+            sent_at = time.monotonic()
+            deadline = sent_at + rto.rto
+            retries = 0
+            while True:
+                s.settimeout(max(deadline - time.monotonic(), 0.001))   #wait for the ACK until the retransmission timeout
+                try:
+                    data, addr = s.recvfrom(MAX_DATAGRAM)
+                except socket.timeout:
+                    retries += 1
+                    if retries > MAX_RETRIES:
+                        print("Did not receive ACK. Terminating.")
+                        metrics.TRANSFERS_GIVEN_UP.inc(protocol="snw")
+                        raise
+                    metrics.RETRANSMISSIONS.inc(protocol="snw")
+                    rto.backoff()
+                    s.sendto(packet, address)   #send the chunk again
+                    deadline = time.monotonic() + rto.rto
+                    continue
+                if data and data[0] == ACK:
+                    if ACK_PACKET.unpack(data)[1:] == (transfer_id, bit):
+                        if not retries:   #the ACK of a retransmitted chunk could belong to either copy
+                            rto.sample(time.monotonic() - sent_at)
+                        else:
+                            rto.restore()
+                        break  #if ACK is received break the loop
+                elif data and data[0] == DATA:   #the peer is still sending the last chunk of its own transfer
+                    _ack_finished(s, data, addr)
+                elif data and data[0] == udp_control.CONTROL:   #control message for the application, keep it for receive_data
+                    udp_control.accept(s, data, addr)
+            bit ^= 1
+    finally:
+        s.settimeout(TIMEOUT)
 
 def receive_file(s, expected_length):  #receive a file of expected length in chunks of 1000 bytes
-    received_data = b""
-    while len(received_data) < expected_length:
-        s.settimeout(1)   #set a time out to wait to incoming data
-        try:
-            data, addr = s.recvfrom(1000)  #receive data
-            received_data += data   #add received data to buffer
-            send_data(s, "ACK", addr)   #send acknowledgement ot sender
-        except socket.timeout:   #if timeout occurs, print error message
-            print("Data transmission terminated prematurely.")
-            exit()
-    return received_data  #return the complete received data
+    data = bytearray(expected_length)
+    receive_into(s, data)
+    return data  #return the complete received data
+
+def receive_file_to(s, file_path, expected_length):  #receive a file of expected length straight into a memory-mapped file
+    with file_utils.mapped_file(file_path, expected_length) as buffer:
+        receive_into(s, buffer)
+
+def receive_into(s, buffer):  #fill a preallocated buffer (bytearray or mmap) with the received data
+    with memoryview(buffer) as view:
+        position = 0
+
+        def write(chunk):
+            nonlocal position
+            view[position:position + len(chunk)] = chunk
+            position += len(chunk)
+
+        receive_stream(s, len(view), write)
+
+def receive_stream(s, expected_length, write):  #receive expected_length bytes, passing every chunk to write as it arrives
+    packet = memoryview(bytearray(MAX_DATAGRAM))   #reused for every chunk, write must consume it before returning
+    finished = _finished.setdefault(s, deque(maxlen=64))
+    transfer_id = None
+    expected_bit = 0
+    received = 0
+    s.settimeout(IDLE_TIMEOUT)   #the sender retransmits, so only a long silence ends the transfer
+    try:
+        while received < expected_length:
+            try:
+                n, addr = s.recvfrom_into(packet)  #receive data
+            except socket.timeout:   #if timeout occurs, print error message
+                print("Data transmission terminated prematurely.")
+                raise
+            if not n or packet[0] == ACK:
+                continue
+            if packet[0] == udp_control.CONTROL:
+                udp_control.accept(s, packet[:n], addr)
+                continue
+            if packet[0] != DATA:
+                continue
+            packet_id, bit = DATA_HEADER.unpack_from(packet)[1:]
+            if packet_id in finished:   #retransmission from an earlier transfer
+                _send_ack(s, packet_id, bit, addr)
+                continue
+            if transfer_id is None:
+                if bit != 0:
+                    continue   #not the first chunk of a transfer
+                transfer_id = packet_id
+            elif packet_id != transfer_id:
+                continue
+            if bit == expected_bit:   #a new chunk, duplicates are only acknowledged again
+                chunk = packet[DATA_HEADER.size:n]
+                write(chunk[:expected_length - received])   #hand the chunk over before acknowledging it
+                received += len(chunk)
+                expected_bit ^= 1
+            _send_ack(s, transfer_id, bit, addr)   #send acknowledgement ot sender
+    finally:
+        if transfer_id is not None:
+            finished.append(transfer_id)
+        s.settimeout(TIMEOUT)
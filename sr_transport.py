@@ -0,0 +1,226 @@
+"""
+The sr_transport.py file contains the utility functions required to process a file transfer using a sliding window
+(selective repeat) over UDP. It offers the same functions as snw_transport.py so client, cache and server can use either.
+1. Up to WINDOW_SIZE chunks are in flight, every ACK names its packet and the cumulative sequence number.
+2. Every packet has its own timer (congestion_control.py), DUPLICATE_ACKS later ACKs resend it early.
+3. The receiver buffers packets that arrive out of order and delivers them in sequence.
+Control messages are retransmitted until they are answered (udp_control.py).
+"""
+import random
+import socket
+import struct
+import time
+import weakref
+from collections import deque
+
+import congestion_control
+import file_utils
+import metrics
+import udp_control
+from snw_transport import create_udp_socket, bind_socket, send_data   #sockets and replies are the same as in snw
+
+CHUNK_SIZE = 1000   #payload bytes per data packet
+WINDOW_SIZE = 32    #packets in flight, can be changed by the applications (--window)
+TIMEOUT = 1         #seconds the socket is left waiting for control messages
+MAX_RETRIES = 10    #retransmissions of one packet before the transfer is given up
+IDLE_TIMEOUT = 60   #seconds a receiver waits for the next packet, longer than a sender retransmits
+DUPLICATE_ACKS = 3  #ACKs past a missing packet before it is sent again early
+REORDER_WINDOW = 1.25   #round trip times a packet may be late before later ACKs count as a sign of its loss
+
+DATA = 0xD5   #type byte of a data packet
+ACK = 0xA5    #type byte of an acknowledgement
+DATA_HEADER = struct.Struct("!BII")   #type, transfer id, sequence number
+ACK_PACKET = struct.Struct("!BIII")   #type, transfer id, sequence number, cumulative ack
+MAX_DATAGRAM = DATA_HEADER.size + CHUNK_SIZE
+
+_finished = weakref.WeakKeyDictionary()  #ids of transfers a socket already received, their late retransmissions are ignored
+
+def _resolve(address):  #turn a (host, port) pair into the form recvfrom reports it in
+    return (socket.gethostbyname(address[0]), address[1])
+
+def _send_ack(s, transfer_id, seq, cumulative, address):
+    s.sendto(ACK_PACKET.pack(ACK, transfer_id, seq, cumulative), address)
+
+def receive_data(s, buffer_size=1024):  #receive the next request or notice, re-acknowledging late data packets
+    return udp_control.receive(s, max(buffer_size, MAX_DATAGRAM), _late_packet)
+
+def request(s, data, address, timeout=None):  #send a request until it is answered and return the reply and the sender's address
+    return udp_control.request(s, data, address, MAX_DATAGRAM, _late_packet, "sr", timeout)
+
+def send_fin(s, address):  #send FIN message as an indication of the end of transmission, return the reply
+    return request(s, "FIN", address)
+
+def _late_packet(s, packet, address):  #a data packet outside of a transfer
+    if packet[0] == DATA:   #retransmission of a packet whose ACK was lost, late ACKs are dropped
+        transfer_id, seq = DATA_HEADER.unpack_from(packet)[1:]
+        if transfer_id in _finished.get(s, ()):   #packets of a transfer not received yet arrived early, the sender repeats them
+            _send_ack(s, transfer_id, seq, 0, address)
+
+def send_file(s, file_data, address, window_size=None):  #send file data with up to window_size packets in flight
+    view = memoryview(file_data)
+    send_stream(s, (view[i:i + CHUNK_SIZE] for i in range(0, len(view), CHUNK_SIZE)), address, window_size)
+
+def send_from_file(s, f, length, address, window_size=None):  #send length bytes of an open file, reading one chunk at a time
+    send_stream(s, file_utils.read_chunks(f, length, CHUNK_SIZE), address, window_size)
+
+def send_stream(s, chunks, address, window_size=None):  #send chunks of at most 1000 bytes as they are produced
+    window = congestion_control.AIMDWindow(window_size or WINDOW_SIZE)
+    rto = congestion_control.estimator(s)
+    peer = _resolve(address)
+    transfer_id = random.getrandbits(32)
+    chunks = iter(chunks)
+    in_flight = {}   #sequence number -> [payload, time sent, retransmissions]
+    acked = set()
+    base = next_seq = 0
+    duplicates = 0   #ACKs received while packet base was missing
+    exhausted = False
+
+    def transmit(seq):
+        s.sendto(DATA_HEADER.pack(DATA, transfer_id, seq) + in_flight[seq][0], address)
+
+    try:
+        while True:
+            while not exhausted and next_seq < base + window.size:   #fill the window
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                    break
+                in_flight[next_seq] = [chunk, time.monotonic(), 0]
+                transmit(next_seq)
+                next_seq += 1
+            if not in_flight:
+                break   #every chunk has been acknowledged
+
+            deadline = min(timer[1] for timer in in_flight.values()) + rto.rto
+            s.settimeout(max(deadline - time.monotonic(), 0.001))   #wait for an ACK until the oldest timer expires
+            try:
+                data, addr = s.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                now = time.monotonic()
+                expired = [seq for seq, timer in in_flight.items() if now - timer[1] >= rto.rto]
+                for seq in expired:
+                    timer = in_flight[seq]
+                    timer[2] += 1
+                    if timer[2] > MAX_RETRIES:
+                        print("Did not receive ACK. Terminating.")
+                        metrics.TRANSFERS_GIVEN_UP.inc(protocol="sr")
+                        raise
+                    metrics.RETRANSMISSIONS.inc(protocol="sr")
+                    transmit(seq)
+                    timer[1] = now
+                if expired:
+                    rto.backoff()
+                    window.on_timeout(next_seq)
+                continue
+
+            if data and data[0] == ACK:
+                ack_id, seq, cumulative = ACK_PACKET.unpack(data)[1:]
+                if ack_id != transfer_id or addr != peer:
+                    continue   #ACK of another transfer
+                timer = in_flight.get(seq)
+                if timer is not None and not timer[2]:   #only packets sent once give an unambiguous round trip time
+                    rto.sample(time.monotonic() - timer[1])
+                elif timer is not None:
+                    rto.restore()
+                for done in [seq] + [n for n in in_flight if n < cumulative]:
+                    if in_flight.pop(done, None) is not None:
+                        acked.add(done)
+                        window.on_ack()
+                while base in acked:   #slide the window over the acknowledged packets
+                    acked.discard(base)
+                    base += 1
+                    duplicates = 0
+                if seq > base and base in in_flight and time.monotonic() - in_flight[base][1] > (rto.srtt or rto.rto) * REORDER_WINDOW:
+                    duplicates += 1   #a later packet arrived while base is overdue, it is lost or reordered
+                    if duplicates == DUPLICATE_ACKS:
+                        window.on_loss(base, next_seq)
+                        in_flight[base][1] = time.monotonic()
+                        in_flight[base][2] += 1
+                        metrics.RETRANSMISSIONS.inc(protocol="sr")
+                        transmit(base)
+            elif data and data[0] == udp_control.CONTROL:   #control message for the application, keep it for receive_data
+                udp_control.accept(s, data, addr)
+    finally:
+        s.settimeout(TIMEOUT)   #leave the socket with the same timeout as snw_transport does
+
+def receive_file(s, expected_length, window_size=None):  #receive expected_length bytes sent with send_file
+    data = bytearray(expected_length)
+    receive_into(s, data, window_size)
+    return data  #return the complete received data
+
+def receive_file_to(s, file_path, expected_length, window_size=None):  #receive expected_length bytes straight into a memory-mapped file
+    with file_utils.mapped_file(file_path, expected_length) as buffer:
+        receive_into(s, buffer, window_size)
+
+def receive_into(s, buffer, window_size=None):  #fill a preallocated buffer (bytearray or mmap), every packet is copied to its offset
+    total = (len(buffer) + CHUNK_SIZE - 1) // CHUNK_SIZE
+    arrived = bytearray(total)   #1 for every packet that has been stored
+    expected = 0
+
+    def store(seq, payload):
+        nonlocal expected
+        view[seq * CHUNK_SIZE:seq * CHUNK_SIZE + len(payload)] = payload
+        arrived[seq] = 1
+        while expected < total and arrived[expected]:
+            expected += 1
+        return expected
+
+    with memoryview(buffer) as view:
+        _receive_packets(s, len(view), store, window_size)
+
+def receive_stream(s, expected_length, write, window_size=None):  #receive expected_length bytes, passing them to write in order
+    out_of_order = {}   #sequence number -> payload, for packets ahead of the next expected one
+    expected = 0
+
+    def store(seq, payload):
+        nonlocal expected
+        if seq == expected:   #the common case, no copy of the payload is kept
+            write(payload)
+            expected += 1
+        elif seq not in out_of_order:
+            out_of_order[seq] = bytes(payload)
+        while expected in out_of_order:   #deliver everything that is now in sequence
+            write(out_of_order.pop(expected))
+            expected += 1
+        return expected
+
+    _receive_packets(s, expected_length, store, window_size)
+
+def _receive_packets(s, expected_length, store, window_size):  #receive the data packets of one transfer and acknowledge them
+    window_size = window_size or WINDOW_SIZE   #store(seq, payload) keeps a packet and returns the next missing sequence number
+    total = (expected_length + CHUNK_SIZE - 1) // CHUNK_SIZE
+    finished = _finished.setdefault(s, deque(maxlen=64))
+    packet = memoryview(bytearray(MAX_DATAGRAM))   #reused for every packet, store must consume the payload before returning
+    transfer_id = None
+    expected = 0
+    s.settimeout(IDLE_TIMEOUT)
+    try:
+        while expected < total:
+            try:
+                n, addr = s.recvfrom_into(packet)
+            except socket.timeout:
+                print("Data transmission terminated prematurely.")
+                raise
+            if not n or packet[0] == ACK:
+                continue
+            if packet[0] == udp_control.CONTROL:
+                udp_control.accept(s, packet[:n], addr)
+                continue
+            if packet[0] != DATA:
+                continue
+            packet_id, seq = DATA_HEADER.unpack_from(packet)[1:]
+            if packet_id in finished:   #retransmission from an earlier transfer
+                _send_ack(s, packet_id, seq, 0, addr)
+                continue
+            if transfer_id is None:
+                transfer_id = packet_id
+            elif packet_id != transfer_id:
+                continue
+            if seq < min(expected + window_size, total):
+                if seq >= expected:
+                    expected = store(seq, packet[DATA_HEADER.size:n])
+                _send_ack(s, transfer_id, seq, expected, addr)
+    finally:
+        if transfer_id is not None:
+            finished.append(transfer_id)
+        s.settimeout(TIMEOUT)
@@ -3,55 +3,434 @@ The tcp_transport.py has utilty fucntions that can support the TCP type of commu
 The functions involve mechanisms for creation of sockets, binding sockets, listening for request, establishing connecitons,
 closing the TCP sockets.
 The functions in tcp_transport.py also handle the reception and sending of files.
+1. Every message is a header (type, flags, 64-bit length) and a payload: TEXT for commands, FILE for file contents.
+2. The flags byte of a file message names its compression, a file of unknown length is sent as chunks (CHUNKED).
+3. Files are sent with os.sendfile where it is available, otherwise through one reusable buffer of BUFFER_SIZE.
+4. serve_connections accepts connections and serves their (pipelined) commands, idle connections wait in a selector.
+5. ConnectionPool keeps idle connections to a host for reuse.
 """
 
+import os
+import queue
+import selectors
 import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-EOF_MARKER = b'EOF_MARKER'  #To denote the end of a file transmission
+try:
+    import resource   #file descriptor limit, Unix only
+except ImportError:
+    resource = None
+
+import compression_utils
+import metrics
+
+TEXT = 1   #message types
+FILE = 2
+MESSAGE_HEADER = struct.Struct("!BBQ")   #type, flags (encoding of a file message, otherwise 0), payload length
+CHUNKED = 2 ** 64 - 1   #payload length of a file message that is sent as a series of chunks
+CHUNK_HEADER = struct.Struct("!I")   #length of a chunk of a chunked file message, 0 ends the message
+BUFFER_SIZE = 256 * 1024   #bytes read from a file or a socket at a time (--buffer-size)
+USE_SENDFILE = hasattr(os, "sendfile")   #send files without copying them through Python (--no-sendfile turns it off)
+MAX_CONTROL_MESSAGE = 64 * 1024   #longest control message a peer may announce, only file messages are larger
 
 def create_tcp_socket():     #to create a TCP socket
-    return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    return set_no_delay(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+
+def set_no_delay(s):  #send small writes at once (TCP_NODELAY)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return s
 
 def bind_and_listen(s, host, port):  #to bind the socket to a host port and listen for connections
     s.bind((host, port)) 
-    s.listen(5)
+    s.listen(socket.SOMAXCONN)   #connections that arrive in a burst wait here
     return s
 
 def connect_to_host(s, host, port): #to connect to a remote host
     s.connect((host, port))  #establish a connection
     return s
 
-def send_data(s, data):  #function to send data
-    s.sendall(data.encode())
+def send_data(s, data):  #function to send a control message
+    payload = data.encode()
+    s.sendall(MESSAGE_HEADER.pack(TEXT, 0, len(payload)) + payload)
+
+def receive_data(s, max_length=MAX_CONTROL_MESSAGE):  #function to receive a control message, "" if the peer closed the connection
+    header = _receive_header(s)
+    if header is None:
+        return ""
+    message_type, _, length = header
+    if message_type != TEXT:
+        raise ConnectionError(f"Expected a control message, got message type {message_type}")
+    if length > max_length:   #the buffer is allocated before the payload arrives
+        raise ConnectionError(f"Control message of {length} bytes is longer than {max_length} bytes")
+    payload = _receive_exact(s, length)
+    if payload is None:
+        raise ConnectionError("Connection lost while receiving a control message")
+    return payload.decode()
 
-def receive_data(s, buffer_size=1024):  #function to receive data
-    return s.recv(buffer_size).decode()
+def parse_command(command):  #split a command such as 'get file1.txt etag=...' into its words and its key=value options
+    words, options = [], {}
+    for word in command.split():
+        if '=' in word:
+            key, value = word.split('=', 1)
+            options[key] = value
+        else:
+            words.append(word)
+    return words, options
 
-def send_file(s, file_path):   #to send file over a socket
+def send_file(s, file_path, encoding=None, stored_encoding=None):   #to send file over a socket (in encoding), returns the bytes sent
     with open(file_path, 'rb') as f:
-        while True:
-            chunk = f.read(1024)
-            if not chunk:
-                break   #end of file reached
+        if encoding != stored_encoding:
+            return send_transcoded(s, iter(lambda: f.read(compression_utils.BLOCK_SIZE), b""), stored_encoding, encoding)
+        return _send_whole_file(s, f, encoding)
+
+def send_transcoded(s, blocks, source, target):  #send file data in encoding source as a chunked file message in encoding target
+    return send_stream(s, compression_utils.transcode(blocks, source, target), None, target)
+
+def _send_whole_file(s, f, encoding):
+    length = os.fstat(f.fileno()).st_size   #size of the file that was opened, even if it is replaced meanwhile
+    s.sendall(MESSAGE_HEADER.pack(FILE, compression_utils.encoding_id(encoding), length))
+    send_file_data(s, f, 0, length)
+    return length
+
+def send_file_bytes(s, data, encoding=None, message=None):  #send a file held in memory, after an optional control message
+    parts = []
+    if message is not None:
+        payload = message.encode()
+        parts += [MESSAGE_HEADER.pack(TEXT, 0, len(payload)), payload]
+    parts += [MESSAGE_HEADER.pack(FILE, compression_utils.encoding_id(encoding), len(data)), data]
+    _send_parts(s, parts)
+    return len(data)
+
+def _send_parts(s, parts):  #send buffers with one gather write where possible
+    if not hasattr(s, "sendmsg"):   #e.g. Windows
+        s.sendall(b"".join(parts))
+        return
+    parts = [memoryview(part) for part in parts]
+    while parts:
+        sent = s.sendmsg(parts)
+        while parts and sent >= len(parts[0]):
+            sent -= len(parts[0])
+            parts.pop(0)
+        if parts:
+            parts[0] = parts[0][sent:]
+
+def send_file_ranges(s, f, ranges):  #send (offset, count) ranges of an open file as one file message
+    total = sum(count for _, count in ranges)
+    s.sendall(MESSAGE_HEADER.pack(FILE, 0, total))
+    for offset, count in ranges:
+        send_file_data(s, f, offset, count)
+    return total
+
+def send_file_data(s, f, offset, count):  #send count bytes of an open file starting at offset, without a header
+    if count <= 0:   #sendfile takes a count of 0 as an error, e.g. an empty file
+        return
+    if USE_SENDFILE:
+        sent = s.sendfile(f, offset, count)   #zero copy, handles socket timeouts itself
+    else:
+        sent = _send_file_buffered(s, f, offset, count)
+    if sent != count:   #the file was truncated while it was being sent
+        raise ConnectionError(f"File data ended after {sent} of {count} bytes")
+
+def _send_file_buffered(s, f, offset, count):  #fallback for send_file_data: read into one reusable buffer and send it
+    buffer = memoryview(bytearray(min(count, BUFFER_SIZE) or 1))
+    f.seek(offset)
+    sent = 0
+    while sent < count:
+        n = f.readinto(buffer[:min(count - sent, len(buffer))])
+        if not n:
+            break
+        s.sendall(buffer[:n])
+        sent += n
+    return sent
+
+def send_stream(s, chunks, length, encoding=None):   #to send file data as it is produced, chunked if length is None
+    s.sendall(MESSAGE_HEADER.pack(FILE, compression_utils.encoding_id(encoding), CHUNKED if length is None else length))
+    sent = 0
+    for chunk in chunks:
+        if length is None:
+            if chunk:
+                _send_parts(s, [CHUNK_HEADER.pack(len(chunk)), chunk])
+        else:
             s.sendall(chunk)
-        s.sendall(EOF_MARKER)
+        sent += len(chunk)
+    if length is None:
+        s.sendall(CHUNK_HEADER.pack(0))
+        return sent
+    if sent != length:   #the receiver can not be told that the file is shorter, drop the connection instead
+        raise ConnectionError(f"File data ended after {sent} of {length} bytes")
+    return sent
 
-def receive_file(s, file_path):  #to receive a file over socket
+def receive_file(s, file_path):  #to receive a file over socket, returns True if it arrived completely
     with open(file_path, 'wb') as f:
-        buffer = bytearray()
-        while True:   #receive data in chunks
-            chunk = s.recv(1024)
-            if not chunk:
-                print("Connection lost while receiving the file!")
-                return
-            buffer.extend(chunk)
-            if EOF_MARKER in buffer:   #check for EOF_MARKER in the buffer
-                buffer = buffer[:-len(EOF_MARKER)]
-                f.write(buffer)
-                break
-            else:
-                f.write(chunk)
-                buffer = bytearray()
+        return receive_stream(s, f.write)
+
+def receive_stream(s, write):  #to receive a file over socket, passing the (decompressed) data to write as it arrives
+    header = receive_file_header(s)
+    if header is None:
+        return False
+    length, encoding = header
+    if encoding is None:
+        return receive_body(s, length, write)
+    decoder = compression_utils.Decoder(encoding, write)
+    if not receive_body(s, length, decoder):
+        return False
+    decoder.finish()
+    return True
+
+def receive_body(s, length, write, on_chunk=None):  #receive the payload of a file message, True if it arrived completely
+    if length != CHUNKED:
+        return receive_exact(s, length, write)
+    while True:   #on_chunk(size) is told the length of every chunk, including the final 0
+        header = _receive_exact(s, CHUNK_HEADER.size)
+        if header is None:
+            print("Connection lost while receiving the file!")
+            return False
+        size, = CHUNK_HEADER.unpack(header)
+        if on_chunk is not None:
+            on_chunk(size)
+        if not size:
+            return True
+        if not receive_exact(s, size, write):
+            return False
+
+def relay_file(source, destination):  #forward a file message to another connection, True if it arrived completely
+    header = receive_file_header(source)
+    if header is None:
+        return False
+    length, encoding = header
+    destination.sendall(MESSAGE_HEADER.pack(FILE, compression_utils.encoding_id(encoding), length))
+    return receive_body(source, length, destination.sendall,   #chunks are passed on with their framing
+                        lambda size: destination.sendall(CHUNK_HEADER.pack(size)))
+
+def receive_bytes(s, length):  #receive the next length bytes of a message, raise if the connection closes first
+    data = _receive_exact(s, length)
+    if data is None:
+        raise ConnectionError("Connection lost while receiving the file!")
+    return data
+
+def receive_file_length(s):  #length of an uncompressed file message, None if the connection closed
+    header = receive_file_header(s)
+    if header is None:
+        return None
+    length, encoding = header
+    if encoding is not None or length == CHUNKED:
+        raise ConnectionError(f"Expected an uncompressed file of known length, got encoding {encoding}")
+    return length
+
+def receive_file_header(s):  #(length, encoding) of a file message, None if the connection closed
+    header = _receive_header(s)
+    if header is None:
+        print("Connection lost while receiving the file!")
+        return None
+    message_type, flags, length = header
+    if message_type != FILE:
+        raise ConnectionError(f"Expected a file, got message type {message_type}")
+    try:
+        return length, compression_utils.encoding_name(flags)
+    except ValueError as e:
+        raise ConnectionError(str(e)) from None
+
+def receive_exact(s, length, write):  #receive exactly length bytes of file data, returns True if they all arrived
+    buffer = memoryview(bytearray(min(length, BUFFER_SIZE) or 1))   #reused for every read, write must consume it
+    remaining = length
+    while remaining:
+        received = s.recv_into(buffer, min(remaining, len(buffer)))
+        if not received:
+            print("Connection lost while receiving the file!")
+            return False
+        write(buffer[:received])
+        remaining -= received
+    return True
+
+def _receive_header(s):  #read a message header, None if the peer closed the connection before sending one
+    header = _receive_exact(s, MESSAGE_HEADER.size)
+    return header and MESSAGE_HEADER.unpack(header)
+
+def _receive_exact(s, length):  #read exactly length bytes, None if the connection closed first
+    data = bytearray(length)
+    view = memoryview(data)
+    received = 0
+    while received < length:
+        n = s.recv_into(view[received:])
+        if not n:
+            return None
+        received += n
+    return bytes(data)
 
 def close_connection(s):  #close the socket
     s.close()
+
+class ConnectionPool:  #idle persistent connections to one host, reused for later commands
+    def __init__(self, host, port, max_idle=8, connect_timeout=None):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.connect_timeout = connect_timeout   #seconds to wait for a new connection
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):  #return (socket, reused), an idle connection if there is one, a new one otherwise
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        s = create_tcp_socket()
+        try:
+            s.settimeout(self.connect_timeout)
+            connect_to_host(s, self.host, self.port)
+            s.settimeout(None)
+        except OSError:
+            close_connection(s)
+            raise
+        return s, False
+
+    def release(self, s):  #give back a connection whose last answer was read completely
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(s)
+                return
+        close_connection(s)
+
+    def discard(self, s):  #close a connection that is in an unknown state
+        close_connection(s)
+
+    def request(self, command, send_body=None, max_length=MAX_CONTROL_MESSAGE):  #send a command and return (socket, answer), the caller releases the socket
+        while True:
+            s, reused = self.acquire()
+            try:
+                send_data(s, command)
+                if send_body is not None:
+                    send_body(s)
+                response = receive_data(s, max_length)
+                if not response:
+                    raise ConnectionError("Connection closed by peer")
+                return s, response
+            except OSError:
+                self.discard(s)
+                if not reused:
+                    raise
+                #the idle connection had been closed by the peer, try again with the next one
+
+    def close(self):  #close all idle connections
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for s in idle:
+            close_connection(s)
+
+SERVING_MODES = ("serial", "thread")   #supported ways of serving the commands of the connections
+MAX_OPEN_CONNECTIONS = 1024   #connections kept open at once, idle ones included (--max-open-connections)
+RESERVED_DESCRIPTORS = 64     #file descriptors left for files and origin connections
+ACCEPT_BACKOFF = 0.1          #seconds new connections wait in the backlog after accept failed
+
+def default_max_open():  #open connections that fit into the file descriptor limit of the process
+    if resource is None:
+        return MAX_OPEN_CONNECTIONS
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return MAX_OPEN_CONNECTIONS
+    return max(1, min(MAX_OPEN_CONNECTIONS, soft - min(RESERVED_DESCRIPTORS, soft // 2)))
+
+def serve_connections(listen_socket, handler, mode="thread", max_connections=64, idle_timeout=None, max_open=None):  #accept connections and serve their commands
+    if mode not in SERVING_MODES:   #handler returns False to close the connection
+        raise ValueError(f"Unknown serving mode: {mode}")
+    max_open = max_open or default_max_open()
+    open_connections = 0
+    accepting = True
+    paused_until = 0   #time.monotonic() until which accepting is paused because accept failed
+    executor = ThreadPoolExecutor(max_workers=max_connections) if mode == "thread" else None
+    selector = selectors.DefaultSelector()
+    wakeup, waker = socket.socketpair()   #a worker that hands a connection back wakes up the loop through this pair
+    waker.setblocking(False)
+    returned = queue.SimpleQueue()   #(connection, keep) of the connections whose commands were served
+    idle_since = {}   #connection waiting for its next command -> time.monotonic() when it became idle
+
+    def serve(client_socket):   #serve the commands that already arrived on a connection, then hand it back to the loop
+        try:
+            keep = handler(client_socket)
+            while keep and _command_waiting(client_socket):   #pipelined commands
+                keep = handler(client_socket)
+        except Exception as e:
+            print(f"Error while handling client: {e}")
+            keep = False
+        returned.put((client_socket, keep))
+        if executor is not None:
+            try:
+                waker.send(b"\0")
+            except BlockingIOError:   #the loop has not read the previous wake-ups yet, it is awake anyway
+                pass
+
+    def close(client_socket):
+        nonlocal open_connections
+        close_connection(client_socket)
+        open_connections -= 1
+        metrics.OPEN_CONNECTIONS.dec(protocol="tcp")
+
+    selector.register(listen_socket, selectors.EVENT_READ)
+    selector.register(wakeup, selectors.EVENT_READ)
+    try:
+        while True:
+            timeout = ACCEPT_BACKOFF if paused_until else 1 if idle_timeout else None
+            for key, _ in selector.select(timeout=timeout):
+                if key.fileobj is listen_socket:
+                    try:
+                        client_socket, _ = listen_socket.accept()
+                    except OSError as e:   #e.g. out of file descriptors (EMFILE), the connection waits in the backlog
+                        print(f"Could not accept a connection: {e}")
+                        paused_until = time.monotonic() + ACCEPT_BACKOFF
+                        continue
+                    set_no_delay(client_socket).settimeout(idle_timeout)
+                    open_connections += 1
+                    metrics.OPEN_CONNECTIONS.inc(protocol="tcp")
+                    returned.put((client_socket, True))
+                elif key.fileobj is wakeup:
+                    wakeup.recv(4096)
+                else:   #a command arrived on an idle connection, or the client closed it
+                    selector.unregister(key.fileobj)
+                    del idle_since[key.fileobj]
+                    if executor is not None:
+                        executor.submit(serve, key.fileobj)
+                    else:
+                        serve(key.fileobj)
+            while not returned.empty():   #idle connections wait here, not in a worker
+                client_socket, keep = returned.get()
+                if keep:
+                    selector.register(client_socket, selectors.EVENT_READ)
+                    idle_since[client_socket] = time.monotonic()
+                else:
+                    close(client_socket)
+            if idle_timeout:
+                now = time.monotonic()
+                for client_socket in [s for s, since in idle_since.items() if now - since > idle_timeout]:
+                    print("Closing idle client connection")
+                    selector.unregister(client_socket)
+                    del idle_since[client_socket]
+                    close(client_socket)
+            if paused_until and time.monotonic() >= paused_until:
+                paused_until = 0
+            if accepting != (open_connections < max_open and not paused_until):   #further connections wait in the listen backlog
+                accepting = not accepting
+                if accepting:
+                    selector.register(listen_socket, selectors.EVENT_READ)
+                else:
+                    selector.unregister(listen_socket)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        for client_socket in idle_since:
+            close(client_socket)
+        selector.close()
+        wakeup.close()
+        waker.close()
+
+def _command_waiting(s):  #whether data (or the end of the connection) is already there to be read
+    timeout = s.gettimeout()
+    s.settimeout(0)
+    try:
+        s.recv(1, socket.MSG_PEEK)
+        return True
+    except (BlockingIOError, InterruptedError):
+        return False
+    finally:
+        s.settimeout(timeout)
@@ -0,0 +1,50 @@
+"""
+The fetches of the cache: concurrent misses share one fetch, a file invalidated while it is fetched is not kept.
+"""
+import threading
+
+import cache
+import cache_manager
+
+def test_invalidate_during_fetch(tmp_path):
+    manager = cache_manager.CacheManager(str(tmp_path))
+    proceed = threading.Event()
+
+    def fetch(growing):   #the server sends the old version, the invalidate arrives in the middle of it
+        growing.start(6)
+        growing.write(b"old")
+        proceed.wait(5)
+        growing.write(b"old")
+        return True
+
+    growing = cache.fetch_once(manager, "file.txt", fetch)
+    cache.invalidate(manager, "file.txt")
+    proceed.set()
+    assert growing.wait_done()
+    assert b"".join(growing.chunks(4)) == b"oldold"   #the waiting client still gets its answer
+    assert manager.lookup("file.txt") is None
+    assert not (tmp_path / "file.txt").exists()
+    refetch = cache.fetch_once(manager, "file.txt", lambda g: False)
+    assert refetch is not growing   #the next miss fetches the new version
+    refetch.wait_done()
+
+def test_concurrent_misses_share_one_fetch(tmp_path):
+    manager = cache_manager.CacheManager(str(tmp_path))
+    proceed = threading.Event()
+    fetches = []
+
+    def fetch(growing):
+        fetches.append(growing)
+        growing.start(4)
+        proceed.wait(5)
+        growing.write(b"data")
+        return True
+
+    first = cache.fetch_once(manager, "file.txt", fetch)
+    second = cache.fetch_once(manager, "file.txt", fetch)
+    proceed.set()
+    assert second is first and first.urgent   #a second client waits for the fetch
+    assert first.wait_done() and len(fetches) == 1
+    assert b"".join(second.chunks(3)) == b"data"
+    assert manager.lookup("file.txt") is not None
+    assert (tmp_path / "file.txt").read_bytes() == b"data"
@@ -0,0 +1,79 @@
+"""
+Eviction order of the cache policies.
+"""
+import pytest
+
+import cache_manager
+
+@pytest.fixture
+def cache(tmp_path):  #cache(policy, **budget) -> (manager, store), store(name, size) puts a file into the cache
+    def create(policy, **budget):
+        manager = cache_manager.CacheManager(str(tmp_path), policy=policy, **budget)
+
+        def store(name, size=10):
+            (tmp_path / name).write_bytes(bytes(size))
+            manager.admit(name)
+        return manager, store
+    return create
+
+def cached(manager):
+    return sorted(manager.entries)
+
+def test_lru_evicts_least_recently_used(cache):
+    manager, store = cache("lru", max_entries=3)
+    for name in "abc":
+        store(name)
+    manager.lookup("a")
+    store("d")
+    assert cached(manager) == ["a", "c", "d"]
+    manager.lookup("c")
+    store("e")
+    assert cached(manager) == ["c", "d", "e"]
+
+def test_lfu_evicts_least_frequently_used(cache):
+    manager, store = cache("lfu", max_entries=3)
+    for name in "abc":
+        store(name)
+    for name in "aab":
+        manager.lookup(name)
+    store("d")   #c has the fewest hits
+    assert cached(manager) == ["a", "b", "d"]
+    store("e")   #d has one hit, b two
+    assert cached(manager) == ["a", "b", "e"]
+
+def test_gdsf_keeps_small_files(cache):
+    manager, store = cache("gdsf", max_bytes=1000)
+    store("small", 100)
+    store("large", 800)
+    store("new", 200)
+    assert cached(manager) == ["new", "small"]
+
+def test_removed_and_readded_files(cache):
+    manager, store = cache("lru", max_entries=2)
+    store("a")
+    store("b")
+    manager.remove("a")
+    store("a")   #now the most recent one
+    store("c")
+    assert cached(manager) == ["a", "c"]
+
+def test_many_accesses_keep_the_heap_small(cache):
+    manager, store = cache("lru", max_entries=10)
+    for name in "abcdefghij":
+        store(name)
+    for _ in range(1000):
+        for name in "abcdefghi":
+            manager.lookup(name)
+    assert len(manager.victims) <= 2 * len(manager.entries) + 64
+    store("k")   #j was not used since it was stored
+    assert "j" not in manager.entries and len(manager.entries) == 10
+
+def test_removed_and_evicted_files_are_reported(tmp_path):
+    removed = []
+    manager = cache_manager.CacheManager(str(tmp_path), max_entries=2, on_remove=removed.append)
+    for name in "abc":
+        (tmp_path / name).write_bytes(b"x")
+        manager.admit(name)
+    manager.admit("c")   #replaced by a new version, not removed
+    manager.remove("b")
+    assert removed == ["a", "b"]
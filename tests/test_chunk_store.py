@@ -0,0 +1,58 @@
+"""
+Delta transfers, manifests and the chunk index of a ChunkStore.
+"""
+import io
+import os
+import random
+
+import pytest
+
+import chunk_store
+
+def write(directory, name, data):
+    (directory / name).write_bytes(data)
+    with open(directory / name, 'rb') as f:
+        return chunk_store.compute_manifest(f)
+
+def test_discard_keeps_chunks_of_other_files(tmp_path):
+    shared = random.Random(1).randbytes(300_000)
+    store = chunk_store.ChunkStore(str(tmp_path))
+    for name, data in [("a", shared + b"a" * 1000), ("b", shared)]:
+        write(tmp_path, name, data)
+        store.manifest(name)
+    digest = store.manifests["b"][2][0][0]   #the first chunk of both files
+
+    os.remove(tmp_path / "a")
+    store.discard("a")
+    assert "a" not in store.manifests
+    assert not (tmp_path / chunk_store.MANIFEST_DIR / "a").exists()
+    assert store.has(digest) and store.read_chunk(digest) == shared[:store.manifests["b"][2][0][1]]
+
+    os.remove(tmp_path / "b")
+    store.discard("b")
+    assert store.manifests == {} and store.index == {}
+    assert os.listdir(tmp_path / chunk_store.MANIFEST_DIR) == []
+
+def test_manifest_sizes_are_bounded():
+    digest = "0" * 64
+    assert chunk_store.parse_manifest(f"{digest}:100") == [(digest, 100)]
+    for size in [0, chunk_store.MAX_CHUNK + 1, 2 ** 40]:   #a missing chunk is read into memory at once
+        with pytest.raises(ValueError):
+            chunk_store.parse_manifest(f"{digest}:{size}")
+
+def test_delta_sends_only_the_changed_chunks(tmp_path):
+    old = random.Random(2).randbytes(2_000_000)
+    new = old[:1_000_000] + b"inserted" + old[1_000_000:]
+    store = chunk_store.ChunkStore(str(tmp_path))
+    write(tmp_path, "file.bin", old)
+    store.manifest("file.bin")
+
+    manifest = chunk_store.compute_manifest(io.BytesIO(new))   #what the sender announces
+    missing = chunk_store.missing_digests(manifest, store.has)
+    assert 0 < len(missing) <= 3   #the chunks around the insertion
+    chunks = {digest: bytes(chunk) for digest, chunk in
+              zip((digest for digest, _ in manifest), chunk_store.iter_chunks(io.BytesIO(new)))}
+    sent = [chunks[digest] for digest in missing]
+    output = bytearray()
+    chunk_store.assemble(manifest, missing, store.read_chunk, lambda size: sent.pop(0), output.extend)
+    assert bytes(output) == new and not sent
@@ -0,0 +1,37 @@
+"""
+Placement of files on the caches of a cluster.
+"""
+import collections
+
+import cluster
+
+NODES = [("127.0.0.1", 8001), ("127.0.0.1", 8002), ("127.0.0.1", 8003)]
+FILES = [f"file{i}.txt" for i in range(3000)]
+
+def placement(ring):
+    return {name: ring.owner(name) for name in FILES}
+
+def test_every_cache_agrees_on_the_owner():
+    assert placement(cluster.HashRing(NODES)) == placement(cluster.HashRing(list(reversed(NODES)) + NODES[:1]))
+
+def test_files_are_spread_evenly():
+    shares = collections.Counter(placement(cluster.HashRing(NODES)).values())
+    assert set(shares) == set(NODES)
+    assert all(share > len(FILES) / len(NODES) * 0.7 for share in shares.values())
+
+def test_adding_a_node_only_moves_files_to_it():
+    before = placement(cluster.HashRing(NODES))
+    new = ("127.0.0.1", 8004)
+    after = placement(cluster.HashRing(NODES + [new]))
+    moved = [name for name in FILES if before[name] != after[name]]
+    assert moved and all(after[name] == new for name in moved)
+    assert len(moved) < len(FILES) / 2
+
+def test_removing_a_node_only_moves_its_files():
+    before = placement(cluster.HashRing(NODES))
+    after = placement(cluster.HashRing(NODES[1:]))
+    assert all(before[name] == after[name] for name in FILES if before[name] != NODES[0])
+
+def test_nodes_are_compared_by_address():
+    assert cluster.parse_nodes("localhost:8001, 127.0.0.1:8002") == NODES[:2]
+    assert ("127.0.0.1", 8001) in cluster.HashRing(cluster.parse_nodes("localhost:8001"))
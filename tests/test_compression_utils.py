@@ -0,0 +1,28 @@
+"""
+Choice of the encoding a file is sent in.
+"""
+import random
+
+import compression_utils
+
+def test_compressible_file_is_compressed(tmp_path):
+    path = tmp_path / "text.txt"
+    path.write_bytes(b"the same line again\n" * 10_000)
+    assert compression_utils.choose_for_file("zlib", str(path)) == "zlib"
+
+def test_incompressible_file_is_sent_as_it_is(tmp_path):
+    path = tmp_path / "bin.dat"
+    path.write_bytes(random.Random(1).randbytes(1_000_000))
+    assert compression_utils.choose_for_file("zlib", str(path)) is None
+    assert compression_utils.choose_for_file("zlib", str(path), "zlib") == "zlib"   #stored compressed, so it did shrink
+
+def test_empty_file_is_not_compressed(tmp_path):
+    path = tmp_path / "empty.txt"
+    path.write_bytes(b"")
+    assert compression_utils.choose_for_file("zlib", str(path)) is None
+
+def test_transcode_round_trip():
+    data = b"abc" * 100_000
+    compressed = b"".join(compression_utils.transcode([data], None, "zlib"))
+    assert len(compressed) < len(data)
+    assert b"".join(compression_utils.transcode([compressed[:1000], compressed[1000:]], "zlib", None)) == data
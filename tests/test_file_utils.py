@@ -0,0 +1,15 @@
+"""
+Temporary files that are published in place of the real file.
+"""
+import os
+import stat
+
+import pytest
+
+import file_utils
+
+@pytest.mark.skipif(not hasattr(os, "fchmod"), reason="no POSIX file modes")
+def test_temp_file_gets_the_usual_mode(tmp_path):
+    f, temp_path = file_utils.create_temp_file(str(tmp_path / "file.txt"))
+    f.close()
+    assert stat.S_IMODE(os.stat(temp_path).st_mode) == 0o666 & ~file_utils._UMASK
@@ -0,0 +1,16 @@
+"""
+Labels of the request metrics.
+"""
+import metrics
+
+def test_unknown_commands_share_one_label():
+    before = metrics.REQUESTS.value(command="other", result="ok")
+    for command in ["x1 file", "x2", "", "GETX:file"]:
+        with metrics.RequestTrace(command):
+            pass
+    assert metrics.REQUESTS.value(command="other", result="ok") == before + 4
+    assert all(key[0] in metrics.COMMANDS | {"other"} for key in metrics.REQUESTS.values)
+
+def test_known_commands_keep_their_label():
+    assert [metrics.RequestTrace(command).command for command in ["get a.txt", "GET:a.txt", "putdelta a", "FIN"]] == \
+        ["get", "get", "putdelta", "fin"]
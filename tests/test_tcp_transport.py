@@ -0,0 +1,126 @@
+"""
+File and control messages over a real TCP connection: framing, empty files and ranges at the end of a file.
+serve_connections and ConnectionPool: pipelined commands, reused and closed connections.
+"""
+import socket
+import threading
+
+import pytest
+
+import tcp_transport
+
+@pytest.fixture
+def connection():  #(sender, receiver), the two ends of a localhost TCP connection
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        sender = tcp_transport.create_tcp_socket()
+        sender.connect(listener.getsockname())
+        receiver, _ = listener.accept()
+    sender.settimeout(5)
+    receiver.settimeout(5)
+    with sender, receiver:
+        yield sender, receiver
+
+def receive(s):
+    received = bytearray()
+    assert tcp_transport.receive_stream(s, received.extend)
+    return bytes(received)
+
+@pytest.fixture(params=[True, False], ids=["sendfile", "buffered"])
+def sendfile(request, monkeypatch):
+    monkeypatch.setattr(tcp_transport, "USE_SENDFILE", request.param)
+
+def test_empty_file(connection, sendfile, tmp_path):
+    sender, receiver = connection
+    path = tmp_path / "empty.txt"
+    path.write_bytes(b"")
+    assert tcp_transport.send_file(sender, path) == 0
+    tcp_transport.send_data(sender, "next")   #the connection is still usable
+    assert receive(receiver) == b""
+    assert tcp_transport.receive_data(receiver) == "next"
+
+def test_ranges_at_and_past_the_end(connection, sendfile, tmp_path):
+    sender, receiver = connection
+    path = tmp_path / "file.bin"
+    path.write_bytes(bytes(range(256)) * 40)
+    with open(path, 'rb') as f:
+        assert tcp_transport.send_file_ranges(sender, f, [(10240, 0)]) == 0
+        assert tcp_transport.send_file_ranges(sender, f, [(100, 20), (10240, 0), (0, 3)]) == 23
+    assert receive(receiver) == b""
+    assert receive(receiver) == path.read_bytes()[100:120] + b"\x00\x01\x02"
+
+def test_control_messages_do_not_run_into_each_other(connection):
+    sender, receiver = connection
+    for text in ["get file1.txt", "", "x" * 70_000, "Stat:12:34:ab"]:
+        tcp_transport.send_data(sender, text)
+    assert tcp_transport.receive_data(receiver) == "get file1.txt"
+    assert tcp_transport.receive_data(receiver) == ""
+    assert tcp_transport.receive_data(receiver, 70_000) == "x" * 70_000
+    assert tcp_transport.receive_data(receiver) == "Stat:12:34:ab"
+
+def test_file_messages_round_trip(connection, tmp_path):
+    sender, receiver = connection
+    data = bytes(range(256)) * 3000
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+    tcp_transport.send_file(sender, path)
+    tcp_transport.send_stream(sender, [data[:1000], b"", data[1000:]], None)   #chunked, length unknown
+    tcp_transport.send_file_bytes(sender, data[:10], message="File delivered from Cache")
+    assert receive(receiver) == data
+    assert receive(receiver) == data
+    assert tcp_transport.receive_data(receiver) == "File delivered from Cache"
+    assert receive(receiver) == data[:10]
+
+def test_overlong_control_message_is_refused(connection):
+    sender, receiver = connection
+    sender.sendall(tcp_transport.MESSAGE_HEADER.pack(tcp_transport.TEXT, 0, 2 ** 40))   #no payload is allocated for it
+    with pytest.raises(ConnectionError):
+        tcp_transport.receive_data(receiver)
+
+def echo(client_socket):  #handler that answers every command, 'close' also ends the connection
+    command = tcp_transport.receive_data(client_socket)
+    if not command:
+        return False
+    tcp_transport.send_data(client_socket, f"echo {command}")
+    return command != "close"
+
+@pytest.fixture(params=tcp_transport.SERVING_MODES)
+def server(request):  #address of an echo server, left running in a daemon thread
+    listener = tcp_transport.bind_and_listen(tcp_transport.create_tcp_socket(), "127.0.0.1", 0)
+    threading.Thread(target=tcp_transport.serve_connections, args=(listener, echo, request.param, 4, None, 2),
+                     daemon=True).start()
+    return listener.getsockname()
+
+def test_pipelined_commands_are_answered_in_order(server):
+    with socket.create_connection(server, timeout=5) as s:
+        commands = [f"c{i}".encode() for i in range(20)]
+        s.sendall(b"".join(tcp_transport.MESSAGE_HEADER.pack(tcp_transport.TEXT, 0, len(c)) + c for c in commands))   #in one write
+        assert [tcp_transport.receive_data(s) for _ in range(20)] == [f"echo c{i}" for i in range(20)]
+
+def test_pool_reuses_connections(server):
+    pool = tcp_transport.ConnectionPool(*server)
+    first, answer = pool.request("one")
+    pool.release(first)
+    second, _ = pool.request("two")
+    pool.release(second)
+    assert answer == "echo one" and second is first
+    s, answer = pool.request("close")   #the server closes the connection after answering
+    pool.release(s)
+    other, answer = pool.request("three")   #the dead connection is replaced
+    assert answer == "echo three" and other is not s
+    pool.discard(other)
+    pool.close()
+
+def test_connections_beyond_the_limit_wait(server):
+    with socket.create_connection(server, timeout=5) as a, socket.create_connection(server, timeout=5) as b:
+        tcp_transport.send_data(a, "a")
+        tcp_transport.send_data(b, "b")
+        assert tcp_transport.receive_data(a) == "echo a"
+        assert tcp_transport.receive_data(b) == "echo b"
+        with socket.create_connection(server, timeout=5) as c:   #the third waits in the backlog (max_open=2)
+            tcp_transport.send_data(c, "c")
+            c.settimeout(0.3)
+            with pytest.raises(socket.timeout):
+                tcp_transport.receive_data(c)
+            a.close()
+            c.settimeout(5)
+            assert tcp_transport.receive_data(c) == "echo c"
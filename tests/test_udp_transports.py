@@ -0,0 +1,115 @@
+"""
+Transfers over snw and sr through a NetemProxy that drops, duplicates and reorders datagrams.
+A PUT-like exchange (request, data, FIN) has to deliver the file byte for byte and every control message exactly once,
+and a peer that never answers has to end the transfer with socket.timeout after a bounded number of retransmissions.
+"""
+import random
+import socket
+import threading
+import time
+
+import pytest
+
+import congestion_control
+import snw_transport
+import sr_transport
+import udp_control
+from netem_proxy import Impairment, NetemProxy
+
+TRANSPORTS = {"snw": snw_transport, "sr": sr_transport}
+IMPAIRMENTS = {
+    "loss": dict(loss=0.05),
+    "duplicate": dict(duplicate=0.3),
+    "reorder": dict(reorder=0.3, delay=0.002, jitter=0.002),
+    "all": dict(loss=0.03, duplicate=0.2, reorder=0.2, delay=0.002),
+}
+SIZE = 60_000   #bytes of the transferred file
+WAIT = 30       #seconds a test waits for the other side before it fails
+
+@pytest.fixture
+def proxy_to():  #start a proxy to a target with an impairment, return its address
+    proxies = []
+
+    def start(target, **impairment):
+        proxy = NetemProxy(0, target, Impairment(seed=7, **impairment), host="127.0.0.1")
+        threading.Thread(target=proxy.serve_forever, daemon=True).start()
+        proxies.append(proxy)
+        return proxy.listener.getsockname()
+
+    yield start
+    for proxy in proxies:
+        proxy.shutdown()
+
+def serve_put(transport, s, result):  #the receiving side of an upload, what it received is stored in result
+    s.settimeout(WAIT)
+    command, address = transport.receive_data(s)
+    result["command"] = command
+    length = int(command.split(":")[2])
+    transport.send_data(s, "Ready", address)
+    result["data"] = bytes(transport.receive_file(s, length))
+    s.settimeout(WAIT)
+    result["fin"], _ = transport.receive_data(s)
+    transport.send_data(s, "Message:stored", address)
+    s.settimeout(0.5)   #a duplicate of one of the requests must not be handed over again
+    try:
+        result["extra"] = transport.receive_data(s)[0]
+    except socket.timeout:
+        pass
+
+@pytest.mark.parametrize("impairment", IMPAIRMENTS)
+@pytest.mark.parametrize("protocol", TRANSPORTS)
+def test_transfer_through_impaired_link(protocol, impairment, proxy_to):
+    transport = TRANSPORTS[protocol]
+    data = random.Random(impairment).randbytes(SIZE)
+    receiver, sender = transport.create_udp_socket(), transport.create_udp_socket()
+    with receiver, sender:
+        transport.bind_socket(receiver, "127.0.0.1", 0)
+        proxy = proxy_to(receiver.getsockname(), **IMPAIRMENTS[impairment])
+        result = {}
+        thread = threading.Thread(target=serve_put, args=(transport, receiver, result), daemon=True)
+        thread.start()
+
+        reply, _ = transport.request(sender, f"PUT:file.bin:{SIZE}", proxy)
+        transport.send_file(sender, data, proxy)
+        message, _ = transport.send_fin(sender, proxy)
+        thread.join(WAIT)
+
+    assert not thread.is_alive()
+    assert (reply, message) == ("Ready", "Message:stored")
+    assert result["command"] == f"PUT:file.bin:{SIZE}"
+    assert result["fin"] == "FIN"
+    assert result["data"] == data
+    assert "extra" not in result
+
+@pytest.fixture
+def fast_give_up(monkeypatch):  #a short first timeout and few retransmissions, so giving up takes well under a second
+    monkeypatch.setattr(congestion_control, "INITIAL_RTO", 0.05)
+    for module in (udp_control, snw_transport, sr_transport):
+        monkeypatch.setattr(module, "MAX_RETRIES", 2)
+
+@pytest.mark.parametrize("protocol", TRANSPORTS)
+def test_request_to_silent_peer_gives_up(protocol, proxy_to, fast_give_up):
+    transport = TRANSPORTS[protocol]
+    with transport.create_udp_socket() as sender:
+        started = time.monotonic()
+        with pytest.raises(socket.timeout):
+            transport.request(sender, "GET:file.bin", proxy_to(("127.0.0.1", 9), loss=1.0))
+        assert time.monotonic() - started < WAIT / 3
+
+@pytest.mark.parametrize("protocol", TRANSPORTS)
+def test_send_to_silent_peer_gives_up(protocol, proxy_to, fast_give_up):
+    transport = TRANSPORTS[protocol]
+    with transport.create_udp_socket() as sender:
+        started = time.monotonic()
+        with pytest.raises(socket.timeout):
+            transport.send_file(sender, bytes(SIZE), proxy_to(("127.0.0.1", 9), loss=1.0))
+        assert time.monotonic() - started < WAIT / 3
+
+@pytest.mark.parametrize("protocol", TRANSPORTS)
+def test_receiver_gives_up_when_sender_goes_silent(protocol, monkeypatch):
+    transport = TRANSPORTS[protocol]
+    monkeypatch.setattr(transport, "IDLE_TIMEOUT", 0.3)
+    with transport.create_udp_socket() as receiver:
+        transport.bind_socket(receiver, "127.0.0.1", 0)
+        with pytest.raises(socket.timeout):
+            transport.receive_file(receiver, SIZE)
@@ -0,0 +1,128 @@
+"""
+The udp_control.py file makes the control messages of the snw and sr transports (GET, PUT, LEN, FIN, ...) reliable.
+1. A request is sent again on every retransmission timeout until its reply arrives, at most MAX_RETRIES times.
+2. A reply carries the id of its request, so late replies of earlier requests are dropped.
+3. Duplicated requests are not handed to the application again, a lost reply is sent again.
+4. Notices (SUBSCRIBE, INVALIDATE) are never answered, they are sent NOTICE_COPIES times.
+"""
+import random
+import socket
+import struct
+import time
+import weakref
+from collections import OrderedDict, deque
+
+import congestion_control
+import metrics
+
+CONTROL = 0xC7   #type byte of a control message, neither a DATA nor an ACK type byte of snw or sr
+REQUEST = 1      #a message that is sent until it is answered
+REPLY = 2        #the answer to a request, carries the id of the request
+NOTICE = 3       #a message that is never answered
+HEADER = struct.Struct("!BBI")   #type, kind, message id
+TIMEOUT = 1         #seconds the socket is left waiting, the same as the transports leave behind
+MAX_RETRIES = 10    #retransmissions of a request before it is given up
+NOTICE_COPIES = 3   #a notice is lost only if all of its copies are lost
+REMEMBERED = 64     #requests per socket whose ids (and replies) are kept to recognise their duplicates
+
+class _Messages:  #control message state of one socket
+    def __init__(self):
+        self.inbox = deque()        #(kind, id, text, address) not handed to the application yet
+        self.seen = OrderedDict()   #(address, id) of recent requests -> reply packet, None until answered
+        self.unanswered = {}        #address -> id of the last request handed to the application
+
+_messages = weakref.WeakKeyDictionary()   #socket -> _Messages
+
+def _state(s):
+    state = _messages.get(s)
+    if state is None:
+        state = _messages[s] = _Messages()
+    return state
+
+def _resolve(address):  #turn a (host, port) pair into the form recvfrom reports it in
+    return (socket.gethostbyname(address[0]), address[1])
+
+def accept(s, packet, address):  #keep a control message that arrived for receive_data, unless it is a duplicate
+    kind, message_id = HEADER.unpack_from(packet)[1:]
+    if kind == REPLY:   #the request it answers is no longer waiting for it
+        return
+    state = _state(s)
+    key = (address, message_id)
+    if key in state.seen:
+        reply = state.seen[key]
+        if reply is not None:   #the request was sent again, so the reply was lost
+            s.sendto(reply, address)
+        return
+    state.seen[key] = None
+    if len(state.seen) > REMEMBERED:
+        state.seen.popitem(last=False)
+    state.inbox.append((kind, message_id, bytes(packet[HEADER.size:]).decode(), address))
+
+def receive(s, buffer_size, late_packet):  #next request or notice (text, address), data packets go to late_packet
+    state = _state(s)
+    while not state.inbox:
+        packet, address = s.recvfrom(buffer_size)
+        if not packet:
+            continue
+        if packet[0] == CONTROL:
+            accept(s, packet, address)
+        else:
+            late_packet(s, packet, address)
+    kind, message_id, text, address = state.inbox.popleft()
+    if kind == REQUEST:
+        state.unanswered[address] = message_id
+    return text, address
+
+def send(s, text, address):  #answer the last request received from address, or send a notice if there is none
+    state = _state(s)
+    address = _resolve(address)
+    message_id = state.unanswered.pop(address, None)
+    if message_id is None:
+        packet = HEADER.pack(CONTROL, NOTICE, random.getrandbits(32)) + text.encode()
+        for _ in range(NOTICE_COPIES):
+            s.sendto(packet, address)
+        return
+    packet = HEADER.pack(CONTROL, REPLY, message_id) + text.encode()
+    if (address, message_id) in state.seen:   #kept to answer the duplicates of the request
+        state.seen[(address, message_id)] = packet
+    s.sendto(packet, address)
+
+def request(s, text, address, buffer_size, late_packet, protocol, timeout=None):  #send a request until it is answered, returns (reply, address)
+    rto = congestion_control.estimator(s)
+    message_id = random.getrandbits(32)
+    packet = HEADER.pack(CONTROL, REQUEST, message_id) + text.encode()
+    s.sendto(packet, address)
+    sent_at = time.monotonic()
+    deadline = sent_at + rto.rto
+    retries = 0
+    try:
+        while True:
+            s.settimeout(max(deadline - time.monotonic(), 0.001))   #wait for the reply until the retransmission timeout
+            try:
+                data, addr = s.recvfrom(buffer_size)
+            except socket.timeout:
+                retries += 1
+                if retries > MAX_RETRIES or (timeout is not None and time.monotonic() - sent_at >= timeout):
+                    print("Did not receive a reply. Terminating.")
+                    metrics.TRANSFERS_GIVEN_UP.inc(protocol=protocol)
+                    raise
+                metrics.RETRANSMISSIONS.inc(protocol=protocol)
+                rto.backoff()
+                s.sendto(packet, address)   #send the request again
+                deadline = time.monotonic() + rto.rto
+                continue
+            if not data:
+                continue
+            if data[0] != CONTROL:
+                late_packet(s, data, addr)
+                continue
+            kind, reply_id = HEADER.unpack_from(data)[1:]
+            if kind == REPLY and reply_id == message_id:
+                if not retries:   #the reply of a repeated request could answer either copy
+                    rto.sample(time.monotonic() - sent_at)
+                else:
+                    rto.restore()
+                return data[HEADER.size:].decode(), addr
+            accept(s, data, addr)
+    finally:
+        s.settimeout(TIMEOUT)
@@ -0,0 +1,117 @@
+"""
+The udp_dispatcher.py file lets the server and the cache serve many UDP (snw or sr) clients at the same time on one socket.
+1. A selector loop hands every datagram to the session of the address it came from.
+2. A session is a virtual socket that only receives the datagrams of its own peer.
+3. A session is served by a pooled worker while it has datagrams, and removed after SESSION_TIMEOUT of silence.
+"""
+import queue
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+MAX_DATAGRAM = 65535   #largest UDP payload
+QUEUE_SIZE = 1024      #datagrams buffered per session, more are dropped like a full socket buffer would
+SESSION_TIMEOUT = 5    #seconds a session without datagrams is kept before it is removed
+
+class Session:  #virtual UDP socket that receives the datagrams of one peer address
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.datagrams = queue.Queue(QUEUE_SIZE)
+        self.timeout = None
+        self.running = False   #a worker is serving the session
+        self.idle_since = time.monotonic()
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def sendto(self, data, address):  #sending goes straight out of the shared socket
+        return self.sock.sendto(data, address)
+
+    def recvfrom(self, buffer_size):
+        try:
+            data = self.datagrams.get(timeout=self.timeout)
+        except queue.Empty:
+            raise socket.timeout("timed out") from None
+        return data[:buffer_size], self.address
+
+    def recvfrom_into(self, buffer, nbytes=0):
+        data, address = self.recvfrom(nbytes or len(buffer))
+        buffer[:len(data)] = data
+        return len(data), address
+
+    def close(self):  #the shared socket stays open, the dispatcher removes the session
+        pass
+
+class UDPDispatcher:  #demultiplex the datagrams of a UDP socket into sessions, handler(session) serves one command of a session
+    def __init__(self, sock, handler, max_sessions=64):
+        self.sock = sock
+        self.handler = handler
+        self.sessions = {}   #peer address -> Session
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_sessions)   #sessions beyond the limit wait with their datagrams queued
+
+    def serve_forever(self):  #read datagrams and dispatch them until interrupted
+        self.sock.settimeout(None)
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.sock, selectors.EVENT_READ)
+            swept = time.monotonic()
+            try:
+                while True:
+                    if selector.select(timeout=1):
+                        data, address = self.sock.recvfrom(MAX_DATAGRAM)
+                        self.dispatch(data, address)
+                    if time.monotonic() - swept >= 1:
+                        self.remove_idle()
+                        swept = time.monotonic()
+            finally:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def dispatch(self, data, address):  #hand a datagram to the session of its sender, starting one if needed
+        with self.lock:
+            session = self.sessions.get(address)
+            if session is None:
+                session = self.sessions[address] = Session(self.sock, address)
+                metrics.OPEN_CONNECTIONS.inc(protocol="udp")
+            try:
+                session.datagrams.put_nowait(data)
+            except queue.Full:
+                pass   #dropped, the transports retransmit
+            if not session.running:
+                session.running = True
+                self.executor.submit(self._run, session)
+
+    def remove_idle(self):  #remove the sessions whose peer has been silent for SESSION_TIMEOUT seconds
+        now = time.monotonic()
+        with self.lock:
+            for address, session in list(self.sessions.items()):
+                if not session.running and now - session.idle_since > SESSION_TIMEOUT:
+                    del self.sessions[address]
+                    metrics.OPEN_CONNECTIONS.dec(protocol="udp")
+
+    def _run(self, session):  #serve the commands of a session until no datagram is left for it, then give the worker back
+        try:
+            while True:
+                try:
+                    self.handler(session)
+                except Exception as e:
+                    print(f"Error in session with {session.address[0]}:{session.address[1]}: {e}")
+                with self.lock:
+                    if session.datagrams.empty():
+                        session.running = False
+                        session.idle_since = time.monotonic()
+                        return
+        except BaseException:   #the handler was interrupted, the next datagram of the peer starts a new session
+            with self.lock:
+                session.running = False
+                if self.sessions.get(session.address) is session:
+                    del self.sessions[session.address]
+                    metrics.OPEN_CONNECTIONS.dec(protocol="udp")
+            raise